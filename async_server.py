@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import logging
+import queue
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from framing import (
+    FRAME_HEADER,
+    FRAME_MAGIC,
+    MAX_FRAME_SIZE,
+    MAX_PUSHES,
+    PUSH_REQUEST_ID,
+    PushOverflow,
+    pack_frame,
+)
+from responder import CommandHandler
+from services import Services, add_arguments, configure_logging
+
+TCP_IP = "127.0.0.1"  # '0.0.0.0'
+TCP_PORT = 2004
+# Threads that run the blocking (ORM/SQLite) part of the commands
+DB_WORKERS = 8
+# Commands allowed to wait for a DB worker before we stop reading sockets
+MAX_PENDING = 256
+
+
+class AsyncChessServer:
+    """Serve the chess commands from a single asyncio event loop.
+
+    Connections are handled as coroutines instead of one OS thread each.
+    The commands themselves block on the ORM, so they are run on a bounded
+    pool of DB worker threads.
+    """
+
+    def __init__(self, game_keeper, db_workers=DB_WORKERS, max_pending=MAX_PENDING):
+        self.logger = logging.getLogger("AsyncChessServer")
+        self.logger.debug("__init__")
+        self.game_keeper = game_keeper
+        self.executor = ThreadPoolExecutor(
+            max_workers=db_workers, thread_name_prefix="DBWorker"
+        )
+        self.max_pending = max_pending
+        self._pending = None
+
+    async def run_command(self, commands, text):
+        """Run a command on the DB worker pool.
+
+        Parameters
+        ----------
+        commands : CommandHandler
+            The command handler of the connection.
+        text : String
+            The raw command as send by the client.
+
+        Returns
+        -------
+        bytes
+            The response for the client.
+
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, commands.dispatch, text)
+        except Exception as e:
+            self.logger.exception(f"Command failed: {e}")
+            return "exception|server-error".encode("utf8")
+
+    async def handle_client(self, reader, writer):
+        """Handle one client connection, framed or plain text."""
+        commands = CommandHandler(self.game_keeper)
+        try:
+            data = await reader.read(4096)
+            if data.startswith(FRAME_MAGIC):
+                await self.handle_framed(
+                    commands, reader, writer, data[len(FRAME_MAGIC) :]
+                )
+            else:
+                async with self._pending:
+                    response = await self.run_command(commands, data.decode("utf-8"))
+                writer.write(response)
+                await writer.drain()
+        except (ConnectionResetError, asyncio.IncompleteReadError) as e:
+            self.logger.debug(f"Client went away: {e}")
+        finally:
+            writer.close()
+
+    async def handle_framed(self, commands, reader, writer, buffered):
+        """Serve frames until the client closes the connection.
+
+        Pushed frames are queued and written by a task of the connection,
+        a client that does not read them is unsubscribed.
+
+        """
+        pending = set()
+        loop = asyncio.get_running_loop()
+        pushes = queue.Queue(MAX_PUSHES)
+        pushed = asyncio.Event()
+
+        def push(payload):
+            # Called from the thread that made the move
+            if writer.is_closing():
+                raise ConnectionResetError("Subscriber disconnected")
+            try:
+                pushes.put_nowait(payload)
+            except queue.Full:
+                raise PushOverflow(f"{MAX_PUSHES} pushed frames not sent")
+            loop.call_soon_threadsafe(pushed.set)
+
+        async def send_pushes():
+            try:
+                while True:
+                    await pushed.wait()
+                    pushed.clear()
+                    while not pushes.empty():
+                        payload = pushes.get_nowait()
+                        writer.write(pack_frame(PUSH_REQUEST_ID, payload))
+                    # Frames stay in the queue while the client is behind
+                    await writer.drain()
+            except ConnectionError as e:
+                self.logger.debug(f"Stopping pushes: {e}")
+
+        pusher = asyncio.ensure_future(send_pushes())
+        commands.push = push
+
+        async def respond(request_id, payload):
+            try:
+                response = await self.run_command(commands, payload.decode("utf-8"))
+            finally:
+                self._pending.release()
+            writer.write(pack_frame(request_id, response))
+            await writer.drain()
+
+        async def read_exactly(size):
+            nonlocal buffered
+            if len(buffered) >= size:
+                data, buffered = buffered[:size], buffered[size:]
+                return data
+            data = buffered + await reader.readexactly(size - len(buffered))
+            buffered = b""
+            return data
+
+        try:
+            while True:
+                try:
+                    header = await read_exactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                length, request_id = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    self.logger.error(f"Dropping client, frame of {length} bytes")
+                    break
+                payload = await read_exactly(length)
+                # Stop reading from this client while all workers are busy
+                await self._pending.acquire()
+                task = asyncio.ensure_future(respond(request_id, payload))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            if pending:
+                await asyncio.wait(pending)
+            commands.close_subscriptions()
+            pusher.cancel()
+
+    async def serve_forever(self, host=TCP_IP, port=TCP_PORT):
+        self._pending = asyncio.Semaphore(self.max_pending)
+        server = await asyncio.start_server(self.handle_client, host, port)
+        self.logger.info("Handling requests, press <Ctrl-C> to quit")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="asyncio chess server")
+    parser.add_argument("--host", default=TCP_IP)
+    parser.add_argument("--port", type=int, default=TCP_PORT)
+    parser.add_argument("--db-workers", type=int, default=DB_WORKERS)
+    add_arguments(parser)
+    args = parser.parse_args()
+    # Terminated like interrupted, so the finally below writes the moves
+    # left and the snapshot, sharding.py terminates its workers
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    configure_logging(args.log_level)
+    SERVICES = Services(args)
+    SERVICES.start()
+    SERVER = AsyncChessServer(SERVICES.game_keeper, db_workers=args.db_workers)
+    try:
+        SERVER.logger.info(f"Server booted, tasks: {len(SERVICES.time_lord.TASKS)}")
+        asyncio.run(SERVER.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        SERVER.close()
+        SERVICES.stop()
@@ -0,0 +1,111 @@
+"""Search speed of the bot and how busy its worker pool gets.
+
+For every count in --workers a Bot with that many worker processes plays
+--games games at once against players that answer right away with a
+random move, for --seconds. Reports the nodes searched per second, the
+part of the worker time spent searching (saturation), how long the
+searches waited for a free worker and how long players waited for the
+reply. When the saturation nears 1 the replies slow down with the wait,
+more games need more workers.
+
+    python benchmarks/bench_bot.py --workers 1 2 4 --games 4 16 --level 3
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import time
+
+import chess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_db import percentile  # noqa: E402
+from bot import Bot  # noqa: E402
+from game_keeper import GameKeeper  # noqa: E402
+from storage import MemoryStorage  # noqa: E402
+
+
+def bench(workers, games, level, seconds):
+    keeper = GameKeeper(MemoryStorage())
+    bot = Bot(workers)
+    bot.start(keeper)
+    # Let the workers start, their start is not the bot's speed
+    time.sleep(2)
+    rng = random.Random(1)
+    replies = queue.Queue()
+    # guid => when the player moved, to time the reply
+    moved = {}
+    latencies = []
+    humans = [keeper.storage.register(f"human_{index}", "x") for index in range(games)]
+    owner = {}
+
+    def start_game(human):
+        live = keeper.new_game(human, bot.player(level))
+        owner[live.guid] = human
+        keeper.subscribe(live.guid, lambda event: replies.put(event))
+        if live.player_to_play_id == human.id:
+            replies.put({"guid": live.guid, "game_over": False, "start": True})
+
+    for human in humans:
+        start_game(human)
+    bot.searches = bot.nodes = 0
+    bot.search_seconds = bot.wait_seconds = 0.0
+    bot.started = time.monotonic()
+    end = time.monotonic() + seconds
+    finished = 0
+    while time.monotonic() < end:
+        try:
+            event = replies.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        guid = event["guid"]
+        human = owner[guid]
+        if event["game_over"]:
+            finished += 1
+            start_game(human)
+            continue
+        live = keeper.live_game(guid)
+        if live.player_to_play_id != human.id:
+            # The player's own move
+            continue
+        if guid in moved:
+            latencies.append(time.monotonic() - moved.pop(guid))
+        board = keeper.get_board(guid)
+        move = rng.choice(list(board.legal_moves))
+        moved[guid] = time.monotonic()
+        keeper.make_move(guid, human, move.uci())
+    stats = bot.stats()
+    bot.stop()
+    latencies.sort()
+    return dict(
+        stats,
+        games=games,
+        level=level,
+        bot_moves_per_s=round(len(latencies) / seconds, 1),
+        reply_p50_ms=round(percentile(latencies, 50) * 1000, 1),
+        reply_p99_ms=round(percentile(latencies, 99) * 1000, 1),
+        finished_games=finished,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--games", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--level", type=int, default=3)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    for workers in args.workers:
+        for games in args.games:
+            print(json.dumps(bench(workers, games, args.level, args.seconds)))
+
+
+if __name__ == "__main__":
+    main()
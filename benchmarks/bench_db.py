@@ -0,0 +1,47 @@
+"""Shared helpers for the benchmarks that need a database.
+
+Benchmarks never touch chess_server.db itself. They copy it to a
+throwaway file, run the migrations on the copy and point the models at it
+through the CHESS_SERVER_DB environment variable.
+"""
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def prepare_database(path, fresh=False):
+    """Create a migrated copy of chess_server.db at path.
+
+    Must be called before anything imports the models, as the database
+    connection is set up when the models package is imported.
+    """
+    path = os.path.abspath(path)
+    if fresh:
+        # The WAL of an earlier run would be replayed onto the new copy
+        for stale in (path, path + "-wal", path + "-shm"):
+            if os.path.exists(stale):
+                os.remove(stale)
+    if not os.path.exists(path):
+        shutil.copyfile(os.path.join(ROOT, "chess_server.db"), path)
+    os.environ["CHESS_SERVER_DB"] = path
+
+    from orator.migrations import DatabaseMigrationRepository, Migrator
+    from models import DATABASE
+
+    repository = DatabaseMigrationRepository(DATABASE, "migrations")
+    if not repository.repository_exists():
+        repository.create_repository()
+    Migrator(repository, DATABASE).run(os.path.join(ROOT, "migrations"))
+    return path
+
+
+def percentile(values, pct):
+    """Return the pct percentile of a sorted list."""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
@@ -0,0 +1,168 @@
+"""Concurrent moves and lookups against SQLite, per database setup.
+
+Runs the same load under every setup in SETUPS, each in its own process as
+the database layer is configured when the models are imported. Like the
+threaded server, every request runs in a thread of its own; up to
+--concurrency of them at once. A request either writes a move to one of
+--games games (Game.append_moves) or looks a game up by its guid.
+
+    python benchmarks/bench_db_writes.py --concurrency 32 --seconds 5
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from bench_db import percentile, prepare_database
+
+DB_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "bench_writes.db"
+)
+# Environment of the models for every setup
+SETUPS = {
+    # What the server ran with before: rollback journal, a fresh connection
+    # per request thread and every query logged
+    "legacy": {
+        "CHESS_SERVER_ENV": "development",
+        "CHESS_SERVER_DB_JOURNAL": "delete",
+        "CHESS_SERVER_DB_SYNCHRONOUS": "full",
+        "CHESS_SERVER_DB_POOL": "0",
+    },
+    "wal": {
+        "CHESS_SERVER_ENV": "production",
+        "CHESS_SERVER_DB_JOURNAL": "wal",
+        "CHESS_SERVER_DB_SYNCHRONOUS": "normal",
+        "CHESS_SERVER_DB_POOL": "0",
+    },
+    "wal+pool": {
+        "CHESS_SERVER_ENV": "production",
+        "CHESS_SERVER_DB_JOURNAL": "wal",
+        "CHESS_SERVER_DB_SYNCHRONOUS": "normal",
+        "CHESS_SERVER_DB_POOL": "16",
+    },
+}
+
+
+class BenchGame:
+    def __init__(self, model):
+        self.model = model
+        self.board = model.board
+        self.guid = model.guid
+        self.lock = threading.Lock()
+
+    def move(self, rng):
+        with self.lock:
+            if self.board.is_game_over() or len(self.board.move_stack) > 200:
+                self.board = self.board.root()
+            move = rng.choice(list(self.board.legal_moves))
+            self.board.push(move)
+            self.model.append_moves(self.board, [move])
+
+
+def run(concurrency, seconds, games, write_share, seed):
+    """Run the load in this process, returns the results."""
+    logging.getLogger("orator.connection.queries").setLevel(logging.ERROR)
+    from models import POOL
+    from models.game import Game
+    from models.player import Player
+
+    players = Player.limit(2).get()
+    bench_games = []
+    for _ in range(games):
+        game = Game()
+        game.white_player_id = players[0].id
+        game.black_player_id = players[-1].id
+        game.setup_new()
+        bench_games.append(BenchGame(game))
+
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    latencies = []
+    errors = {}
+    slots = threading.Semaphore(concurrency)
+
+    def request(write, game, seed):
+        started = time.perf_counter()
+        try:
+            if write:
+                game.move(random.Random(seed))
+            else:
+                Game.where("guid", game.guid).first()
+        except Exception as e:
+            error = str(e).split(" (SQL")[0]
+            with lock:
+                errors[error] = errors.get(error, 0) + 1
+        else:
+            with lock:
+                latencies.append(time.perf_counter() - started)
+        finally:
+            slots.release()
+
+    threads = []
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        slots.acquire()
+        thread = threading.Thread(
+            target=request,
+            args=(rng.random() < write_share, rng.choice(bench_games), rng.random()),
+        )
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return {
+        "requests_per_s": round(len(latencies) / seconds),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "errors": errors,
+        "idle_connections": len(POOL),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--games", type=int, default=64)
+    parser.add_argument("--write-share", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--setup", choices=sorted(SETUPS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.setup:
+        # One setup, in the process started below
+        prepare_database(DB_PATH)
+        result = run(
+            args.concurrency, args.seconds, args.games, args.write_share, args.seed
+        )
+        print(json.dumps(result))
+        return
+
+    # Migrate once, the journal mode of the file is set per setup. That
+    # needs the only connection to the file, close ours.
+    prepare_database(DB_PATH, fresh=True)
+    from models import DATABASE
+
+    DATABASE.purge()
+    for name, environment in SETUPS.items():
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--setup", name] + sys.argv[1:],
+            env=dict(os.environ, **environment),
+            capture_output=True,
+            text=True,
+        )
+        if process.returncode:
+            sys.exit(process.stderr)
+        result = json.loads(process.stdout.splitlines()[-1])
+        print(json.dumps({"setup": name, **result}))
+
+
+if __name__ == "__main__":
+    main()
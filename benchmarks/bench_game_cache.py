@@ -0,0 +1,170 @@
+"""Memory and lookup time of the game tiers, per hot budget.
+
+Fills the database with --games games in progress, --plies moves into
+each, and measures the memory a hot game (LiveGame) and a warm game
+(compact record) take. Then for every budget in --hot a GameKeeper with
+that many hot games and --warm warm games serves --lookups lookups, most
+of them to a few active games: --active of the games get --share of the
+lookups. demote_idle runs every --demote-every lookups, as the TimeLord
+would. Reports the hit rates, the time of a lookup per tier and the
+memory the games in memory take.
+
+    python benchmarks/bench_game_cache.py --games 20000 --hot 500 2000 20000
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+import tracemalloc
+
+import chess
+
+from bench_db import ROOT, percentile, prepare_database
+
+DB_PATH = os.path.join(ROOT, "bench_game_cache.db")
+
+
+def fill(count, plies, white, black):
+    """Insert [count] games in progress straight into the database."""
+    from models.move_log import pack_moves
+
+    board = chess.Board()
+    rng = random.Random(1)
+    for _ in range(plies):
+        board.push(rng.choice(list(board.legal_moves)))
+    move_log = pack_moves(board.move_stack)
+    now = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    connection = sqlite3.connect(DB_PATH)
+    with connection:
+        connection.execute("DELETE FROM games")
+        connection.executemany(
+            "INSERT INTO games (guid, white_player_id, black_player_id, "
+            "board_state, move_log, checkpoint_ply, state, created_at, "
+            "updated_at) VALUES (?, ?, ?, ?, ?, 0, 'in_progress', ?, ?)",
+            (
+                (f"bench-{index:08d}", white.id, black.id, chess.STARTING_FEN)
+                + (move_log, now, now)
+                for index in range(count)
+            ),
+        )
+    connection.close()
+
+
+def guid(index):
+    return f"bench-{index:08d}"
+
+
+def tier_sizes(storage, count):
+    """Bytes per hot and per warm game, over [count] games."""
+    from game_keeper import GameKeeper
+
+    keeper = GameKeeper(storage, hot_games=0, warm_games=count)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = storage.load_games([guid(index) for index in range(count)])
+    for record in records:
+        live = keeper._register(record)
+        # Boards keep the legal moves of the position once asked for
+        live.game_state()
+    # The models of the records are in reference cycles
+    gc.collect()
+    hot = tracemalloc.get_traced_memory()[0] - before
+    del records, record, live
+    keeper.demote_idle()
+    gc.collect()
+    warm = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return hot / count, warm / count
+
+
+def bench(storage, games, hot, warm, lookups, active, share, demote_every):
+    from game_keeper import GameKeeper
+
+    keeper = GameKeeper(storage, hot_games=hot, warm_games=warm)
+    rng = random.Random(2)
+    active_games = max(1, int(games * active))
+    # Seconds per lookup, by where the game came from
+    timings = {"hot": [], "warm": [], "cold": []}
+    for index in range(lookups):
+        if rng.random() < share:
+            wanted = guid(rng.randrange(active_games))
+        else:
+            wanted = guid(rng.randrange(games))
+        if wanted in keeper._current_games:
+            tier = "hot"
+        elif wanted in keeper.warm:
+            tier = "warm"
+        else:
+            tier = "cold"
+        started = time.perf_counter()
+        live = keeper.live_game(wanted)
+        with live.lock:
+            live.game_state()
+        timings[tier].append(time.perf_counter() - started)
+        if index % demote_every == 0:
+            keeper.demote_idle()
+    stats = keeper.cache_stats()
+    result = {"lookups": lookups}
+    result.update(stats)
+    for tier, seconds in timings.items():
+        seconds.sort()
+        result[f"{tier}_lookups"] = len(seconds)
+        result[f"{tier}_p50_us"] = round(percentile(seconds, 50) * 1e6, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--games", type=int, default=20000)
+    parser.add_argument("--plies", type=int, default=40)
+    parser.add_argument("--hot", type=int, nargs="+", default=[500, 2000, 20000])
+    parser.add_argument("--warm", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=50000)
+    parser.add_argument("--active", type=float, default=0.02)
+    parser.add_argument("--share", type=float, default=0.9)
+    parser.add_argument("--demote-every", type=int, default=1000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("CHESS_SERVER_ENV", "production")
+    prepare_database(DB_PATH, fresh=True)
+    logging.getLogger("orator.connection.queries").setLevel(logging.ERROR)
+    from storage import SQLiteStorage
+
+    storage = SQLiteStorage()
+    white = storage.register(f"cache_white_{time.time()}", "x")
+    black = storage.register(f"cache_black_{time.time()}", "x")
+    fill(args.games, args.plies, white, black)
+    hot_bytes, warm_bytes = tier_sizes(storage, min(args.games, 2000))
+    print(
+        json.dumps(
+            {
+                "plies": args.plies,
+                "hot_bytes_per_game": round(hot_bytes),
+                "warm_bytes_per_game": round(warm_bytes),
+            }
+        )
+    )
+    for hot in args.hot:
+        result = bench(
+            storage,
+            args.games,
+            hot,
+            args.warm,
+            args.lookups,
+            args.active,
+            args.share,
+            args.demote_every,
+        )
+        result["memory_mb"] = round(
+            (result["hot"] * hot_bytes + result["warm"] * warm_bytes) / 2**20, 1
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
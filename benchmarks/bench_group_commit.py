@@ -0,0 +1,124 @@
+"""Moves per second against move latency, per group commit window.
+
+--threads players keep making moves in games of their own through
+GameKeeper.make_move, which returns once the move is committed. For every
+window in --windows (milliseconds) the WriteCoordinator commits the moves
+of all games together; `each` commits every move in a transaction of its
+own instead. Reports the moves per second, the latency of make_move and
+how many moves went into a commit.
+
+Commits are synced to disk (synchronous=FULL) unless
+CHESS_SERVER_DB_SYNCHRONOUS says otherwise.
+
+    python benchmarks/bench_group_commit.py --threads 32 --windows each 0 2 5 10
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from bench_db import ROOT, percentile, prepare_database
+
+DB_PATH = os.path.join(ROOT, "bench_group_commit.db")
+
+
+class CommitEach:
+    """Stands in for the WriteCoordinator: a transaction per move."""
+
+    def __init__(self, game_keeper):
+        self.game_keeper = game_keeper
+
+    def commit(self, guid):
+        self.game_keeper.write_games([guid])
+
+    def stats(self):
+        return {"moves_per_commit": 1.0}
+
+
+def bench(window, threads, games_per_thread, seconds):
+    from game_keeper import GameKeeper
+    from storage import SQLiteStorage
+    from write_coordinator import WriteCoordinator
+
+    storage = SQLiteStorage()
+    keeper = GameKeeper(storage)
+    white = storage.register(f"commit_white_{time.time()}", "x")
+    black = storage.register(f"commit_black_{time.time()}", "x")
+    players = {white.id: white, black.id: black}
+    if window == "each":
+        writer = CommitEach(keeper)
+        keeper.attach_writer(writer)
+    else:
+        writer = WriteCoordinator(float(window) / 1000)
+        writer.start(keeper)
+
+    lock = threading.Lock()
+    latencies = []
+    end = time.monotonic() + seconds
+
+    def play(seed):
+        rng = random.Random(seed)
+        guids = [
+            storage.create_game(white, black).guid for _ in range(games_per_thread)
+        ]
+        own = []
+        while time.monotonic() < end:
+            guid = rng.choice(guids)
+            live = keeper.live_game(guid)
+            with live.lock:
+                if live.state != "in_progress":
+                    move = None
+                else:
+                    move = rng.choice(list(live.board.legal_moves)).uci()
+                    player = players[live.player_to_play_id]
+            if move is None:
+                guids.remove(guid)
+                guids.append(storage.create_game(white, black).guid)
+                continue
+            started = time.perf_counter()
+            keeper.make_move(guid, player, move)
+            own.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=play, args=(seed,)) for seed in range(threads)]
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+    if window != "each":
+        writer.stop()
+    latencies.sort()
+    return {
+        "window_ms": window,
+        "threads": threads,
+        "moves_per_s": round(len(latencies) / elapsed),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "moves_per_commit": writer.stats()["moves_per_commit"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--games", type=int, default=4, help="games per thread")
+    parser.add_argument("--windows", nargs="+", default=["each", "0", "2", "5", "10"])
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    os.environ.setdefault("CHESS_SERVER_ENV", "production")
+    prepare_database(DB_PATH, fresh=True)
+    logging.getLogger("orator.connection.queries").setLevel(logging.ERROR)
+    for window in args.windows:
+        print(json.dumps(bench(window, args.threads, args.games, args.seconds)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Time the Responder commands with and without the lookup indexes.
+
+Fills a throwaway copy of chess_server.db with synthetic players and games,
+then runs every command against it twice: once with the indexes of the
+add_lookup_indexes and add_history_indexes migrations dropped and once with
+them in place.
+
+    python benchmarks/bench_indexes.py --players 20000 --games 300000
+"""
+
+import argparse
+import hashlib
+import logging
+import random
+import sqlite3
+import time
+import uuid
+
+from bench_db import percentile, prepare_database
+
+# Same indexes as migrations/2026_10_17_100000_add_lookup_indexes.py and
+# migrations/2026_10_17_130000_add_history_indexes.py
+INDEXES = {
+    "players_guid_unique": "CREATE UNIQUE INDEX players_guid_unique ON players (guid)",
+    "players_name_unique": "CREATE UNIQUE INDEX players_name_unique ON players (name)",
+    "games_guid_unique": "CREATE UNIQUE INDEX games_guid_unique ON games (guid)",
+    "games_white_player_id_updated_at_index": "CREATE INDEX "
+    "games_white_player_id_updated_at_index "
+    "ON games (white_player_id, updated_at, id, state, guid)",
+    "games_black_player_id_updated_at_index": "CREATE INDEX "
+    "games_black_player_id_updated_at_index "
+    "ON games (black_player_id, updated_at, id, state, guid, white_player_id)",
+}
+# A few players play a large share of all games
+HEAVY_PLAYERS = 10
+HEAVY_SHARE = 0.1
+PASSWORD_HASH = hashlib.sha224(b"bench").hexdigest()
+
+
+def fill(path, players, games):
+    """Add synthetic players and games until the tables hold enough rows."""
+    db = sqlite3.connect(path)
+    have = db.execute("SELECT COUNT(*) FROM players").fetchone()[0]
+    db.executemany(
+        "INSERT INTO players (name, hashed_password, guid) VALUES (?, ?, ?)",
+        (
+            (f"bench_{uuid.uuid4().hex}", PASSWORD_HASH, uuid.uuid4().hex)
+            for _ in range(max(0, players - have))
+        ),
+    )
+    ids = [row[0] for row in db.execute("SELECT id FROM players")]
+    heavy = ids[:HEAVY_PLAYERS]
+
+    def pair():
+        first = (
+            random.choice(heavy)
+            if random.random() < HEAVY_SHARE
+            else random.choice(ids)
+        )
+        second = random.choice(ids)
+        return first, second
+
+    def game_rows(count):
+        for _ in range(count):
+            white, black = pair()
+            state = (
+                "in_progress"
+                if random.random() < 0.02
+                else random.choice(["white_won", "black_won", "draw"])
+            )
+            yield (
+                white,
+                black,
+                "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+                state,
+                str(uuid.uuid4()),
+                b"",
+            )
+
+    have = db.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+    db.executemany(
+        "INSERT INTO games (white_player_id, black_player_id, board_state, state, "
+        "guid, move_log) VALUES (?, ?, ?, ?, ?, ?)",
+        game_rows(max(0, games - have)),
+    )
+    db.commit()
+    db.close()
+
+
+def set_indexes(path, enabled):
+    db = sqlite3.connect(path)
+    for name, sql in INDEXES.items():
+        db.execute(f"DROP INDEX IF EXISTS {name}")
+        if enabled:
+            db.execute(sql)
+    db.execute("ANALYZE")
+    db.commit()
+    db.close()
+
+
+def time_commands(handler, game_keeper, samples, rounds):
+    """Run every command `rounds` times, return {command: [seconds]}."""
+    from sessions import SessionCache
+
+    # Every call must go to the database, not to the caches
+    game_keeper.sessions = SessionCache(ttl=0)
+    timings = {}
+    for _ in range(rounds):
+        for player_guid, player_name, game_guid in samples:
+            commands = {
+                "login": f"login|{player_name}|{PASSWORD_HASH}",
+                "current_games": f"current_games|{player_guid}",
+                "all_games": f"all_games|{player_guid}",
+                "done_games": f"done_games|{player_guid}",
+                # The first page, as a client scrolling the history asks for
+                "done_games_page": f"done_games|limit=50|{player_guid}",
+                "myturn": f"myturn|{game_guid}|{player_guid}",
+                "getboardstate": f"getboardstate|{game_guid}|{player_guid}",
+            }
+            for name, command in commands.items():
+                game_keeper._current_games.clear()
+                start = time.perf_counter()
+                handler.dispatch(command)
+                timings.setdefault(name, []).append(time.perf_counter() - start)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default="bench_chess_server.db")
+    parser.add_argument("--fresh", action="store_true", help="start from an empty copy")
+    parser.add_argument("--players", type=int, default=20000)
+    parser.add_argument("--games", type=int, default=300000)
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    path = prepare_database(args.database, args.fresh)
+    fill(path, args.players, args.games)
+
+    from game_keeper import GameKeeper
+    from responder import CommandHandler
+
+    db = sqlite3.connect(path)
+    samples = []
+    for player_id, guid, name in db.execute(
+        "SELECT id, guid, name FROM players WHERE guid IS NOT NULL ORDER BY id LIMIT ?",
+        (args.samples,),
+    ):
+        game = db.execute(
+            "SELECT guid FROM games WHERE white_player_id = ? OR black_player_id = ? LIMIT 1",
+            (player_id, player_id),
+        ).fetchone()
+        if game:
+            samples.append((guid, name, game[0]))
+    db.close()
+
+    results = {}
+    for label, enabled in (("without indexes", False), ("with indexes", True)):
+        set_indexes(path, enabled)
+        game_keeper = GameKeeper()
+        results[label] = time_commands(
+            CommandHandler(game_keeper), game_keeper, samples, args.rounds
+        )
+
+    print(
+        f"{'command':>15} {'no index p50':>13} {'p99':>9} {'index p50':>10} {'p99':>9}  (ms)"
+    )
+    for name in results["with indexes"]:
+        before = sorted(results["without indexes"][name])
+        after = sorted(results["with indexes"][name])
+        print(
+            f"{name:>15} {percentile(before, 50) * 1000:>13.2f} "
+            f"{percentile(before, 99) * 1000:>9.2f} "
+            f"{percentile(after, 50) * 1000:>10.2f} {percentile(after, 99) * 1000:>9.2f}"
+        )
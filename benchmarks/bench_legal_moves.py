@@ -0,0 +1,91 @@
+"""Hit rate and cost of the legal move cache over many games.
+
+Plays --games games the way clients ask for legal moves: every position
+is looked up once. The openings come from a small set of common lines
+(--book-plies deep), after that the moves are random, so the cache hits
+in the openings and misses later on. Reports the hit rate and the time
+of a lookup against generating and packing the moves without a cache.
+
+    python benchmarks/bench_legal_moves.py --games 5000 --cache-size 50000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import chess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from legal_moves import LegalMoveCache, LegalMoves  # noqa: E402
+
+OPENINGS = [
+    "e2e4 e7e5 g1f3 b8c6 f1b5 a7a6 b5a4 g8f6",
+    "e2e4 c7c5 g1f3 d7d6 d2d4 c5d4 f3d4 g8f6",
+    "d2d4 d7d5 c2c4 e7e6 b1c3 g8f6 c1g5 f8e7",
+    "d2d4 g8f6 c2c4 g7g6 b1c3 f8g7 e2e4 d7d6",
+    "e2e4 e7e6 d2d4 d7d5 b1c3 g8f6 c1g5 f8e7",
+    "c2c4 e7e5 b1c3 g8f6 g1f3 b8c6 g2g3 d7d5",
+    "e2e4 c7c6 d2d4 d7d5 b1c3 d5e4 c3e4 c8f5",
+    "g1f3 d7d5 g2g3 g8f6 f1g2 e7e6 e1g1 f8e7",
+]
+
+
+def play(rng, book_plies, plies):
+    """The positions of one game, as boards."""
+    board = chess.Board()
+    line = rng.choice(OPENINGS).split()[: rng.randint(2, book_plies)]
+    positions = []
+    for ply in range(plies):
+        positions.append(board.copy(stack=False))
+        if ply < len(line):
+            move = chess.Move.from_uci(line[ply])
+        else:
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = rng.choice(moves)
+        board.push(move)
+    return positions
+
+
+def run(games, cache_size, book_plies, plies, seed):
+    rng = random.Random(seed)
+    positions = [board for _ in range(games) for board in play(rng, book_plies, plies)]
+    cache = LegalMoveCache(cache_size)
+    started = time.perf_counter()
+    for board in positions:
+        cache.get(board)
+    cached = time.perf_counter() - started
+    started = time.perf_counter()
+    for board in positions:
+        LegalMoves(list(board.legal_moves))
+    uncached = time.perf_counter() - started
+    return dict(
+        cache.stats(),
+        lookups=len(positions),
+        cached_us=round(cached / len(positions) * 1e6, 2),
+        uncached_us=round(uncached / len(positions) * 1e6, 2),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--games", type=int, default=5000)
+    parser.add_argument("--cache-size", type=int, default=50000)
+    parser.add_argument("--book-plies", type=int, default=8)
+    parser.add_argument("--plies", type=int, default=40, help="plies per game")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(
+        json.dumps(
+            run(args.games, args.cache_size, args.book_plies, args.plies, args.seed)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
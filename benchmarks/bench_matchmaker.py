@@ -0,0 +1,133 @@
+"""Simulate queue wait times for the matchmaker at several arrival rates.
+
+Players arrive as a Poisson process with normally distributed ratings, on
+a simulated clock. Reports the wait percentiles of the Matchmaker (pairs
+on enqueue, sweeps every second) next to the old queue (one sweep every
+20 seconds, sleeping a second per game created).
+
+    python benchmarks/bench_matchmaker.py --rates 0.2 1 5 25 --buckets 3
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_db import percentile  # noqa: E402
+from matchmaker import Matchmaker  # noqa: E402
+from sessions import PlayerRecord  # noqa: E402
+
+TIME_CONTROLS = ["1+0", "3+2", "5+3", "10+5", "15+10"]
+SWEEP_INTERVAL = 1.0
+OLD_SWEEP_INTERVAL = 20.0
+
+
+def arrivals(rate, duration, buckets, seed):
+    rng = random.Random(seed)
+    now = 0.0
+    player_id = 0
+    while True:
+        now += rng.expovariate(rate)
+        if now > duration:
+            return
+        player_id += 1
+        yield (
+            now,
+            PlayerRecord(player_id, f"player{player_id}", str(player_id)),
+            rng.gauss(1500, 300),
+            rng.choice(TIME_CONTROLS[:buckets]) if buckets else None,
+        )
+
+
+def simulate_matchmaker(rate, duration, buckets, seed):
+    clock = [0.0]
+    matchmaker = Matchmaker(clock=lambda: clock[0])
+    queued_at = {}
+    waits = []
+    next_sweep = SWEEP_INTERVAL
+
+    def sweep_until(moment):
+        nonlocal next_sweep
+        while next_sweep <= moment:
+            clock[0] = next_sweep
+            for player, opponent, _ in matchmaker.sweep():
+                waits.append(next_sweep - queued_at.pop(player.id))
+                waits.append(next_sweep - queued_at.pop(opponent.id))
+            next_sweep += SWEEP_INTERVAL
+
+    for now, player, rating, time_control in arrivals(rate, duration, buckets, seed):
+        sweep_until(now)
+        clock[0] = now
+        opponent = matchmaker.enqueue(player, rating, time_control)
+        if opponent is None:
+            queued_at[player.id] = now
+        else:
+            waits.append(0.0)
+            waits.append(now - queued_at.pop(opponent.id))
+    return sorted(waits), len(queued_at)
+
+
+def simulate_old_queue(rate, duration, seed):
+    """The 20 second sweep that sleeps a second for every game it creates."""
+    queue = []
+    waits = []
+    busy_until = 0.0
+    next_sweep = OLD_SWEEP_INTERVAL
+    for now, player, rating, time_control in arrivals(rate, duration, 0, seed):
+        while next_sweep <= now:
+            moment = max(next_sweep, busy_until)
+            while len(queue) > 1:
+                for queued in (queue.pop(0), queue.pop(0)):
+                    waits.append(moment - queued)
+                moment += 1.0
+            busy_until = moment
+            next_sweep += OLD_SWEEP_INTERVAL
+        queue.append(now)
+    return sorted(waits), len(queue)
+
+
+def report(name, rate, waits, left):
+    return {
+        "queue": name,
+        "arrivals_per_s": rate,
+        "paired": len(waits),
+        "still_waiting": left,
+        "p50_s": round(percentile(waits, 50), 2),
+        "p90_s": round(percentile(waits, 90), 2),
+        "p99_s": round(percentile(waits, 99), 2),
+        "max_s": round(waits[-1], 2) if waits else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.2, 1, 5, 25])
+    parser.add_argument("--duration", type=float, default=3600, help="seconds")
+    parser.add_argument(
+        "--buckets", type=int, default=0, help="number of time controls, 0 for none"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print json lines")
+    args = parser.parse_args()
+
+    for rate in args.rates:
+        rows = [
+            report(
+                "matchmaker",
+                rate,
+                *simulate_matchmaker(rate, args.duration, args.buckets, args.seed),
+            ),
+            report("old", rate, *simulate_old_queue(rate, args.duration, args.seed)),
+        ]
+        for row in rows:
+            if args.json:
+                print(json.dumps(row))
+            else:
+                print(
+                    f"{row['queue']:>10} {rate:>6}/s  paired {row['paired']:>6}  "
+                    f"p50 {row['p50_s']:>7}s  p90 {row['p90_s']:>7}s  "
+                    f"p99 {row['p99_s']:>7}s  max {row['max_s']:>8}s"
+                )
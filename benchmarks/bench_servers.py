@@ -0,0 +1,171 @@
+"""Compare the threaded server.py with the asyncio async_server.py.
+
+Both servers are started as a subprocess on their own port, on a copy of
+the database with a game in it, then hammered with one-shot plain text
+connections from an asyncio client asking for the state of that game.
+Reports the connections per second and the latency percentiles for each
+server.
+
+    python benchmarks/bench_servers.py --connections 20000 --concurrency 500
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from bench_db import ROOT, prepare_database
+
+DB_PATH = os.path.join(ROOT, "bench_servers.db")
+SNAPSHOT_PATH = os.path.join(ROOT, "bench_servers.snapshot")
+
+SERVERS = {
+    "threaded": os.path.join(ROOT, "server.py"),
+    "asyncio": os.path.join(ROOT, "async_server.py"),
+}
+
+
+def percentile(values, pct):
+    """Return the pct percentile of a sorted list."""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def seed_game():
+    """Create two players and a game between them, returns (player guid,
+    game guid)."""
+    from models import DATABASE
+    from storage import SQLiteStorage
+
+    storage = SQLiteStorage()
+    white = storage.register(f"server_bench_white_{time.time()}", "x")
+    black = storage.register(f"server_bench_black_{time.time()}", "x")
+    game = storage.create_game(white, black)
+    # The servers need the only connection to switch the journal mode
+    DATABASE.purge()
+    return white.guid, game.guid
+
+
+def wait_for_port(host, port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on {host}:{port} did not come up")
+
+
+async def one_shot(host, port, command, latencies, errors):
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(command)
+        await writer.drain()
+        await reader.read()
+        writer.close()
+        latencies.append(time.perf_counter() - start)
+    except OSError:
+        errors.append(1)
+
+
+async def run_load(host, port, command, connections, concurrency):
+    latencies = []
+    errors = []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def worker():
+        async with limit:
+            await one_shot(host, port, command, latencies, errors)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "connections": connections,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "elapsed_s": round(elapsed, 3),
+        "conn_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def bench_server(name, args, port, command):
+    proc = subprocess.Popen(
+        [
+            sys.executable,
+            SERVERS[name],
+            "--host",
+            args.host,
+            "--port",
+            str(port),
+            "--snapshot",
+            SNAPSHOT_PATH,
+        ],
+        cwd=ROOT,
+        env=dict(os.environ, CHESS_SERVER_DB=DB_PATH, CHESS_SERVER_ENV="production"),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(args.host, port)
+        result = asyncio.run(
+            run_load(
+                args.host,
+                port,
+                command.encode("utf8"),
+                args.connections,
+                args.concurrency,
+            )
+        )
+        result["server"] = name
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+        if os.path.exists(SNAPSHOT_PATH):
+            os.remove(SNAPSHOT_PATH)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2104)
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument(
+        "--command",
+        default="getboardstate|{game}|{player}",
+        help="plain text command every connection sends, {game} and {player} "
+        "are the guids of a game and a logged in player in it",
+    )
+    parser.add_argument(
+        "--servers", nargs="+", default=list(SERVERS), choices=list(SERVERS)
+    )
+    parser.add_argument("--json", action="store_true", help="print json lines")
+    args = parser.parse_args()
+
+    os.environ.setdefault("CHESS_SERVER_ENV", "production")
+    prepare_database(DB_PATH, fresh=True)
+    player, game = seed_game()
+    command = args.command.format(game=game, player=player)
+    for offset, name in enumerate(args.servers):
+        result = bench_server(name, args, args.port + offset, command)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(
+                f"{name:>9}: {result['conn_per_s']:>8} conn/s  "
+                f"p50 {result['p50_ms']:>7} ms  p99 {result['p99_ms']:>7} ms  "
+                f"errors {result['errors']}"
+            )
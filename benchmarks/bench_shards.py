@@ -0,0 +1,176 @@
+"""Throughput of the sharded server for a growing number of shards.
+
+For every count in --shards, sharding.py is started with that many shard
+workers and as many router processes. Client processes then keep
+--connections framed connections each busy with getboardstate requests
+for random games, through the router. Reports the requests per second, the
+latency percentiles and the speedup over the first count.
+
+Every process takes a core, so the speedup levels off when workers,
+routers and clients together need more cores than the host has.
+
+    python benchmarks/bench_shards.py --shards 1 2 4 --clients 4
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+
+from bench_db import ROOT, percentile, prepare_database
+from bench_servers import wait_for_port
+
+DB_PATH = os.path.join(ROOT, "bench_shards.db")
+SHARDING = os.path.join(ROOT, "sharding.py")
+
+
+def seed_games(games):
+    """Create the players and [games] games to ask for, returns
+    (player guid, [game guid, ..])."""
+    from models import DATABASE
+    from storage import SQLiteStorage
+
+    storage = SQLiteStorage()
+    white = storage.register(f"shard_bench_white_{time.time()}", "x")
+    black = storage.register(f"shard_bench_black_{time.time()}", "x")
+    guids = [storage.create_game(white, black).guid for _ in range(games)]
+    # The shards need the only connection to switch the journal mode
+    DATABASE.purge()
+    return white.guid, guids
+
+
+async def run_connection(host, port, commands, end, latencies, errors):
+    from framing import FRAME_HEADER, FRAME_MAGIC, pack_frame
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(FRAME_MAGIC)
+    request_id = 0
+    while time.monotonic() < end:
+        request_id += 1
+        started = time.perf_counter()
+        writer.write(pack_frame(request_id, random.choice(commands)))
+        length, _ = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        payload = await reader.readexactly(length)
+        if payload.startswith(b"exception|"):
+            errors.append(payload)
+        else:
+            latencies.append(time.perf_counter() - started)
+    writer.close()
+
+
+def run_client(host, port, commands, connections, seconds, results):
+    """One client process, puts its latencies and error count on results."""
+    sys.path.insert(0, ROOT)
+    latencies = []
+    errors = []
+    end = time.monotonic() + seconds
+
+    async def main():
+        await asyncio.gather(
+            *(
+                run_connection(host, port, commands, end, latencies, errors)
+                for _ in range(connections)
+            )
+        )
+
+    asyncio.run(main())
+    results.put((latencies, len(errors)))
+
+
+def bench(shards, args, commands):
+    worker_port = args.port + 1
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            SHARDING,
+            "--host",
+            args.host,
+            "--port",
+            str(args.port),
+            "--workers",
+            str(shards),
+            "--worker-port",
+            str(worker_port),
+            "--routers",
+            str(shards),
+        ],
+        cwd=ROOT,
+        env=dict(os.environ, CHESS_SERVER_DB=DB_PATH, CHESS_SERVER_ENV="production"),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(args.host, args.port)
+        for shard in range(shards):
+            wait_for_port(args.host, worker_port + shard)
+        results = multiprocessing.Queue()
+        clients = [
+            multiprocessing.Process(
+                target=run_client,
+                args=(
+                    args.host,
+                    args.port,
+                    commands,
+                    args.connections,
+                    args.seconds,
+                    results,
+                ),
+            )
+            for _ in range(args.clients)
+        ]
+        for client in clients:
+            client.start()
+        latencies = []
+        errors = 0
+        for _ in clients:
+            client_latencies, client_errors = results.get()
+            latencies.extend(client_latencies)
+            errors += client_errors
+        for client in clients:
+            client.join()
+    finally:
+        process.terminate()
+        process.wait()
+    latencies.sort()
+    return {
+        "shards": shards,
+        "requests_per_s": round(len(latencies) / args.seconds),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument(
+        "--port", type=int, default=2200, help="router port, the workers follow"
+    )
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=4, help="client processes")
+    parser.add_argument(
+        "--connections", type=int, default=16, help="connections per client"
+    )
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    prepare_database(DB_PATH, fresh=True)
+    player, guids = seed_games(args.games)
+    commands = [f"getboardstate|{guid}|format=json|{player}" for guid in guids]
+    first = None
+    for shards in args.shards:
+        result = bench(shards, args, commands)
+        first = first or result["requests_per_s"]
+        result["speedup"] = round(result["requests_per_s"] / max(1, first), 2)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Restart time with and without a snapshot, per number of games in progress.
+
+For every count in --games the database is filled with that many games in
+progress, --plies moves into each. Reports how long load_games takes to
+load them all from the database, how long save_snapshot takes and how
+big the snapshot is, how long a restore from the snapshot takes and how
+long the first access to a game takes afterwards, against loading it
+from the database.
+
+    python benchmarks/bench_snapshot.py --games 1000 10000 50000
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+
+import chess
+
+from bench_db import ROOT, percentile, prepare_database
+
+DB_PATH = os.path.join(ROOT, "bench_snapshot.db")
+SNAPSHOT_PATH = os.path.join(ROOT, "bench_snapshot.snapshot")
+
+
+def fill(count, plies, white, black):
+    """Insert [count] games in progress straight into the database."""
+    from models.move_log import pack_moves
+
+    board = chess.Board()
+    rng = random.Random(1)
+    for _ in range(plies):
+        board.push(rng.choice(list(board.legal_moves)))
+    move_log = pack_moves(board.move_stack)
+    # Written before the snapshots are taken
+    now = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - 60))
+    connection = sqlite3.connect(DB_PATH)
+    with connection:
+        connection.execute("DELETE FROM games")
+        connection.executemany(
+            "INSERT INTO games (guid, white_player_id, black_player_id, "
+            "board_state, move_log, checkpoint_ply, state, created_at, "
+            "updated_at) VALUES (?, ?, ?, ?, ?, 0, 'in_progress', ?, ?)",
+            (
+                (f"bench-{index:08d}", white.id, black.id, chess.STARTING_FEN)
+                + (move_log, now, now)
+                for index in range(count)
+            ),
+        )
+    connection.close()
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+def bench(count, plies, storage, white, black, samples=200):
+    from game_keeper import GameKeeper
+
+    fill(count, plies, white, black)
+    keeper = GameKeeper(storage)
+    _, load_seconds = timed(keeper.load_games)
+    size, save_seconds = timed(keeper.save_snapshot, SNAPSHOT_PATH)
+
+    restored = GameKeeper(storage)
+    _, restore_seconds = timed(restored.load_games, SNAPSHOT_PATH)
+    guids = [f"bench-{index:08d}" for index in random.sample(range(count), samples)]
+    from_snapshot = sorted(timed(restored.live_game, guid)[1] for guid in guids)
+    from_storage = sorted(timed(storage.load_game, guid)[1] for guid in guids)
+    restored.snapshot.close()
+    return {
+        "games": count,
+        "load_games_s": round(load_seconds, 3),
+        "save_snapshot_s": round(save_seconds, 3),
+        "snapshot_bytes": size,
+        "restore_s": round(restore_seconds, 4),
+        "first_access_p50_us": round(percentile(from_snapshot, 50) * 1e6),
+        "storage_load_p50_us": round(percentile(from_storage, 50) * 1e6),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--games", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--plies", type=int, default=40)
+    args = parser.parse_args()
+
+    os.environ.setdefault("CHESS_SERVER_ENV", "production")
+    prepare_database(DB_PATH, fresh=True)
+    logging.getLogger("orator.connection.queries").setLevel(logging.ERROR)
+    from storage import SQLiteStorage
+
+    storage = SQLiteStorage()
+    white = storage.register(f"snapshot_white_{time.time()}", "x")
+    black = storage.register(f"snapshot_black_{time.time()}", "x")
+    try:
+        for count in args.games:
+            print(json.dumps(bench(count, args.plies, storage, white, black)))
+    finally:
+        if os.path.exists(SNAPSHOT_PATH):
+            os.remove(SNAPSHOT_PATH)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Track the clocks of many games from the single TimeLord thread.
+
+Every game gets a flag deadline a few seconds out. For a while moves come
+in at random games, each one cancels the deadline of its game and
+schedules the next, like make_move does. Then the deadlines are left to
+fall. Reports the cost of a reschedule, how late the flags fell and the
+threads used.
+
+    python benchmarks/bench_time_lord.py --games 100000 --moves-per-s 20000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_db import percentile  # noqa: E402
+from time_lord import TimeLord  # noqa: E402
+
+
+def run(games, moves_per_s, move_seconds, think, seed):
+    rng = random.Random(seed)
+    lord = TimeLord()
+    lock = threading.Lock()
+    lateness = []
+    flagged = set()
+    fell = threading.Event()
+
+    def flag(game, deadline):
+        late = time.monotonic() - deadline
+        with lock:
+            lateness.append(late)
+            flagged.add(game)
+            if len(flagged) == games:
+                fell.set()
+
+    lord.start()
+    calls = []
+    started = time.perf_counter()
+    for game in range(games):
+        deadline = time.monotonic() + move_seconds + rng.uniform(0, think)
+        calls.append(lord.call_at(deadline, flag, game, deadline))
+    schedule_seconds = time.perf_counter() - started
+
+    moves = 0
+    reschedule_seconds = 0.0
+    end = time.monotonic() + move_seconds
+    while time.monotonic() < end:
+        batch_started = time.monotonic()
+        for _ in range(max(1, moves_per_s // 100)):
+            game = rng.randrange(games)
+            started = time.perf_counter()
+            lord.cancel(calls[game])
+            deadline = time.monotonic() + rng.uniform(1, think)
+            calls[game] = lord.call_at(deadline, flag, game, deadline)
+            reschedule_seconds += time.perf_counter() - started
+            moves += 1
+        time.sleep(max(0, 0.01 - (time.monotonic() - batch_started)))
+    threads = threading.active_count()
+    fell.wait(think + 10)
+    lord.stop()
+    lateness.sort()
+    return {
+        "games": games,
+        "moves": moves,
+        "threads": threads,
+        "schedule_us": round(schedule_seconds / games * 1e6, 2),
+        "reschedule_us": round(reschedule_seconds / max(1, moves) * 1e6, 2),
+        "flags": len(flagged),
+        # Moves go to random games, also to ones whose flag fell already
+        "flagged_again": len(lateness) - len(flagged),
+        "late_p50_ms": round(percentile(lateness, 50) * 1000, 2),
+        "late_p99_ms": round(percentile(lateness, 99) * 1000, 2),
+        "late_max_ms": round(lateness[-1] * 1000, 2) if lateness else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--games", type=int, default=100000)
+    parser.add_argument("--moves-per-s", type=int, default=20000)
+    parser.add_argument(
+        "--move-seconds", type=float, default=5, help="seconds moves come in"
+    )
+    parser.add_argument(
+        "--think", type=float, default=5, help="deadlines are up to this far out"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(
+        json.dumps(
+            run(args.games, args.moves_per_s, args.move_seconds, args.think, args.seed)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
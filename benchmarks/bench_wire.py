@@ -0,0 +1,85 @@
+"""Bytes and encode time per poll for each wire format.
+
+Plays random games of a few lengths and encodes the board and the state
+of the final position the way getboard / getboardstate would.
+
+    python benchmarks/bench_wire.py --lengths 20 80 200
+"""
+
+import argparse
+import os
+import pickle
+import random
+import sys
+import timeit
+
+import chess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wire  # noqa: E402
+from game_keeper import GameKeeper, LiveGame  # noqa: E402
+from models.move_log import pack_moves  # noqa: E402
+from storage import GameRecord, MemoryStorage  # noqa: E402
+
+
+def bench_record(board):
+    """A stored game with the moves of [board]."""
+    return GameRecord(
+        id=1,
+        guid="bench",
+        white_player_id=1,
+        black_player_id=2,
+        white_name="white",
+        black_name="black",
+        state="in_progress",
+        started="2018-04-25 10:37:32",
+        last_move="2018-04-25 10:37:32",
+        start_fen=chess.STARTING_FEN,
+        move_log=pack_moves(board.move_stack),
+    )
+
+
+def random_board(length):
+    board = chess.Board()
+    while board.ply() < length and not board.is_game_over():
+        board.push(random.choice(list(board.legal_moves)))
+    return board
+
+
+def measure(encode, number):
+    payload = encode()
+    seconds = timeit.timeit(encode, number=number) / number
+    return len(payload), seconds * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[20, 80, 200])
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    print(f"{'plies':>5} {'encoding':>22} {'bytes':>7} {'us/encode':>10}")
+    for length in args.lengths:
+        board = random_board(length)
+        live = LiveGame(bench_record(board))
+        keeper = GameKeeper(MemoryStorage())
+        keeper._current_games[live.guid] = live
+        state = keeper.get_game_state(live.guid)
+        last = keeper.get_moves(live.guid, live.version - 1)
+        everything = keeper.get_moves(live.guid, 0)
+        encodings = {
+            "getboard pickle": lambda: pickle.dumps(board),
+            "getboard json": lambda: wire.encode_board(everything, "json"),
+            "getboard packed": lambda: wire.encode_board(everything, "packed"),
+            "getboard json delta": lambda: wire.encode_board(last, "json"),
+            "getboard packed delta": lambda: wire.encode_board(last, "packed"),
+            "state pickle": lambda: pickle.dumps(state),
+            "state json": lambda: wire.encode_state(state, "json"),
+            "state packed": lambda: wire.encode_state(state, "packed"),
+            "state packed delta": lambda: wire.encode_state(state, "packed", last),
+        }
+        for name, encode in encodings.items():
+            size, micros = measure(encode, args.number)
+            print(f"{board.ply():>5} {name:>22} {size:>7} {micros:>10.1f}")
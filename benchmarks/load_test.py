@@ -0,0 +1,406 @@
+"""Load a chess server with simulated clients and report per command.
+
+Every client goes through what a player does: register, log in, queue up
+and poll until a game is handed out, then poll the board and play random
+legal moves until the game ends, it played --plies moves or the opponent
+did not move for --patience seconds, and queue up again. Clients start spread over --ramp seconds, poll every
+--poll-interval and think up to --think seconds before a move, all with
+some jitter. Each command is a plain text connection of its own, like
+the old clients, or a request on one framed connection per client.
+
+The server is started as a subprocess on a throwaway database, or given
+with --connect. The report is one json document: requests, errors,
+throughput and latency percentiles per command. Pass the report of an
+earlier run as --baseline to fail when a command got slower or fails
+more often.
+
+    python benchmarks/load_test.py --server asyncio --clients 2000 --seconds 60
+    python benchmarks/load_test.py --output new.json --baseline old.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+import time
+
+import chess
+
+from bench_db import ROOT, percentile, prepare_database
+from bench_servers import wait_for_port
+
+DB_PATH = os.path.join(ROOT, "bench_load.db")
+# Workers of the sharded server, on the ports after --port
+SHARDS = 2
+SERVERS = {
+    "threaded": [os.path.join(ROOT, "server.py")],
+    "asyncio": [os.path.join(ROOT, "async_server.py")],
+    "sharded": [os.path.join(ROOT, "sharding.py"), "--workers", str(SHARDS)],
+}
+PASSWORD = "load_test"
+# Responses that are a failed command
+ERROR_RESPONSES = (b"exception|", b"invalid", b"NOT LOGGED IN!", b"register_failed")
+
+
+class Recorder:
+    """Latencies and errors per command, for every client of the run."""
+
+    def __init__(self):
+        # command => [seconds]
+        self.latencies = {}
+        # command => {error: count}
+        self.errors = {}
+        self.counts = {"games": 0, "moves": 0, "games_finished": 0}
+
+    def record(self, command, seconds, error=None):
+        if error is None:
+            self.latencies.setdefault(command, []).append(seconds)
+        else:
+            errors = self.errors.setdefault(command, {})
+            errors[error] = errors.get(error, 0) + 1
+
+    def report(self, seconds):
+        commands = {}
+        for command in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies.get(command, []))
+            errors = sum(self.errors.get(command, {}).values())
+            requests = len(latencies) + errors
+            commands[command] = {
+                "requests": requests,
+                "errors": errors,
+                "error_rate": round(errors / requests, 4) if requests else 0.0,
+                "per_s": round(len(latencies) / seconds, 1),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+                "error_kinds": self.errors.get(command, {}),
+            }
+        return commands
+
+
+class PlainConnection:
+    """Sends every command on a connection of its own."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    async def request(self, command):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(command.encode("utf8"))
+            await writer.drain()
+            return await reader.read()
+        finally:
+            writer.close()
+
+    def close(self):
+        pass
+
+
+class FramedConnection:
+    """Sends the commands of a client over one framed connection."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._streams = None
+        self._next_id = 1
+
+    async def request(self, command):
+        from framing import FRAME_HEADER, FRAME_MAGIC, pack_frame
+
+        if self._streams is None:
+            self._streams = await asyncio.open_connection(self.host, self.port)
+            self._streams[1].write(FRAME_MAGIC)
+        reader, writer = self._streams
+        request_id = self._next_id
+        self._next_id += 1
+        writer.write(pack_frame(request_id, command))
+        try:
+            # One request at a time, nothing is subscribed to
+            length, _ = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+            return await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            raise ConnectionResetError("Server closed the connection")
+
+    def close(self):
+        if self._streams is not None:
+            self._streams[1].close()
+            self._streams = None
+
+
+class SimulatedClient:
+    """One player, see the module docstring for what it does."""
+
+    def __init__(self, name, connection, recorder, args, rng):
+        self.name = name
+        self.connection = connection
+        self.recorder = recorder
+        self.args = args
+        self.rng = rng
+        self.guid = None
+
+    async def command(self, name, text):
+        """Run a command, returns the response or None if it failed."""
+        started = time.perf_counter()
+        try:
+            response = await self.connection.request(text)
+        except OSError as e:
+            self.recorder.record(name, 0, type(e).__name__)
+            return None
+        elapsed = time.perf_counter() - started
+        if response.startswith(ERROR_RESPONSES):
+            self.recorder.record(name, elapsed, response[:40].decode("utf8", "replace"))
+            return None
+        self.recorder.record(name, elapsed)
+        return response
+
+    async def pause(self, seconds):
+        await asyncio.sleep(seconds * self.rng.uniform(0.5, 1.5))
+
+    async def run(self, start, end):
+        await asyncio.sleep(max(0, start - time.monotonic()))
+        try:
+            if not await self.log_in():
+                return
+            while time.monotonic() < end:
+                game = await self.find_game(end)
+                if game is not None:
+                    await self.play(game, end)
+        finally:
+            self.connection.close()
+
+    async def log_in(self):
+        response = await self.command(
+            "register", f"register|{self.name}|{PASSWORD}|{PASSWORD}"
+        )
+        if response is None:
+            return False
+        hashed = hashlib.sha224(PASSWORD.encode("utf8")).hexdigest()
+        response = await self.command("login", f"login|{self.name}|{hashed}")
+        if response is None:
+            return False
+        self.guid = response.decode("utf8")
+        return True
+
+    async def find_game(self, end):
+        tc = f"|tc={self.args.time_control}" if self.args.time_control else ""
+        while time.monotonic() < end:
+            response = await self.command("queue_up", f"queue_up{tc}|{self.guid}")
+            if response is not None and response != b"queued_for_game":
+                self.recorder.counts["games"] += 1
+                return response.decode("utf8")
+            await self.pause(self.args.poll_interval)
+        return None
+
+    async def play(self, game, end):
+        side = await self.command("myside", f"myside|{game}|{self.guid}")
+        if side is None:
+            return
+        turn = chess.WHITE if side == b"White" else chess.BLACK
+        etag = None
+        state = None
+        plies = 0
+        changed = time.monotonic()
+        while time.monotonic() < end and plies < self.args.plies:
+            option = f"|etag={etag}" if etag else ""
+            response = await self.command(
+                "getboardstate", f"getboardstate|{game}{option}|format=json|{self.guid}"
+            )
+            if response is not None and response != b"not_modified":
+                state = json.loads(response)
+                etag = state["etag"]
+                changed = time.monotonic()
+            if state is not None and state["game_over"]:
+                self.recorder.counts["games_finished"] += 1
+                return
+            board = chess.Board(state["fen"]) if state is not None else None
+            if board is None or board.turn != turn:
+                if time.monotonic() - changed > self.args.patience:
+                    # The opponent left, find another game
+                    return
+                await self.pause(self.args.poll_interval)
+                continue
+            await self.pause(self.args.think)
+            move = self.rng.choice(list(board.legal_moves))
+            if await self.command("move", f"move|{game}|{move.uci()}|{self.guid}"):
+                self.recorder.counts["moves"] += 1
+                plies += 1
+
+
+async def run_clients(args, recorder):
+    run = secrets.token_hex(4)
+    rng = random.Random(args.seed)
+    start = time.monotonic()
+    end = start + args.ramp + args.seconds
+    connection = FramedConnection if args.protocol == "framed" else PlainConnection
+    clients = [
+        SimulatedClient(
+            f"load_{run}_{index}",
+            connection(args.host, args.port),
+            recorder,
+            args,
+            random.Random(rng.random()),
+        )
+        for index in range(args.clients)
+    ]
+    await asyncio.gather(
+        *(
+            client.run(start + args.ramp * index / args.clients, end)
+            for index, client in enumerate(clients)
+        )
+    )
+    return time.monotonic() - start
+
+
+def server_stats(host, port, token):
+    """The stats command of the server, None if it does not answer."""
+
+    async def ask():
+        return await PlainConnection(host, port).request(f"stats|{token}")
+
+    try:
+        return json.loads(asyncio.run(ask()))
+    except (OSError, ValueError):
+        return None
+
+
+def version():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline, tolerance):
+    """The regressions of a report against a baseline report."""
+    regressions = []
+    for command, before in baseline["commands"].items():
+        after = report["commands"].get(command)
+        if after is None:
+            continue
+        for metric in ("p50_ms", "p99_ms"):
+            if after[metric] > before[metric] * (1 + tolerance) + 1:
+                regressions.append(
+                    f"{command} {metric} {before[metric]} -> {after[metric]}"
+                )
+        if after["error_rate"] > before["error_rate"] + tolerance / 10:
+            regressions.append(
+                f"{command} error_rate {before['error_rate']} -> {after['error_rate']}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--server", choices=sorted(SERVERS), default="asyncio")
+    parser.add_argument("--connect", help="host:port of a running server instead")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2300)
+    parser.add_argument("--protocol", choices=["plain", "framed"], default="plain")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument(
+        "--seconds", type=float, default=30, help="after all clients started"
+    )
+    parser.add_argument(
+        "--ramp", type=float, default=10, help="seconds the clients start over"
+    )
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--think", type=float, default=2.0)
+    parser.add_argument("--plies", type=int, default=40, help="moves per game")
+    parser.add_argument(
+        "--patience", type=float, default=30, help="seconds to wait for a move"
+    )
+    parser.add_argument("--time-control", help="queue for timed games, like 5+3")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the report here, else stdout")
+    parser.add_argument("--baseline", help="report of an earlier run to compare to")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="share a latency may grow"
+    )
+    args = parser.parse_args()
+
+    process = None
+    token = secrets.token_hex(8)
+    if args.connect:
+        args.host, port = args.connect.rsplit(":", 1)
+        args.port = int(port)
+    else:
+        prepare_database(DB_PATH, fresh=True)
+        from models import DATABASE
+
+        # The server needs the only connection to switch the journal mode
+        DATABASE.purge()
+        process = subprocess.Popen(
+            [sys.executable]
+            + SERVERS[args.server]
+            + ["--host", args.host, "--port", str(args.port)]
+            + (
+                ["--worker-port", str(args.port + 1)]
+                if args.server == "sharded"
+                else []
+            ),
+            cwd=ROOT,
+            env=dict(
+                os.environ,
+                CHESS_SERVER_DB=DB_PATH,
+                CHESS_SERVER_ENV="production",
+                CHESS_SERVER_ADMIN_TOKEN=token,
+            ),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+    try:
+        wait_for_port(args.host, args.port)
+        if args.server == "sharded" and process is not None:
+            for shard in range(SHARDS):
+                wait_for_port(args.host, args.port + 1 + shard)
+        recorder = Recorder()
+        elapsed = asyncio.run(run_clients(args, recorder))
+        stats = server_stats(args.host, args.port, token) if process else None
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "version": version(),
+        "server": args.connect or args.server,
+        "protocol": args.protocol,
+        "clients": args.clients,
+        "seconds": round(elapsed, 1),
+        "counts": recorder.counts,
+        "commands": recorder.report(elapsed),
+        "server_stats": stats,
+    }
+    document = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(document)
+    else:
+        print(document)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(report, json.load(baseline), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
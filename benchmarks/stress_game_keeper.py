@@ -0,0 +1,198 @@
+"""Hammer one GameKeeper with queue_up, dequeue and move from many threads.
+
+Every player runs in its own thread and goes through the commands the way
+the responder threads would: queue up, poll until a game is handed out,
+sometimes give up and dequeue, play random legal moves, queue up again.
+Meanwhile the TimeLord jobs (match sweeps and flushes) run in their own
+threads. At the end the keeper state is checked:
+
+- no command raised,
+- every game was handed to its two players, once each,
+- no player is queued and matched at the same time,
+- every accepted move is on the board of its game, and in the database
+  after the last flush.
+
+Exits non zero when a check fails.
+
+    python benchmarks/stress_game_keeper.py --players 64 --seconds 10
+    python benchmarks/stress_game_keeper.py --storage memory
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+from bench_db import prepare_database
+
+DB_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "bench_stress.db"
+)
+# Plies after which the players leave a game and queue up again
+GAME_PLIES = 12
+# Seconds to wait for the opponent before leaving a game
+GAME_PATIENCE = 2.0
+DEQUEUE_CHANCE = 0.1
+
+
+def register(commands, name):
+    response = commands.dispatch(f"register|{name}|secret|secret").decode("utf8")
+    if not response.startswith("register_success|"):
+        raise RuntimeError(f"Could not register {name}: {response}")
+    return response.split("|")[1]
+
+
+class Stress:
+    def __init__(self, keeper, seconds, seed):
+        self.keeper = keeper
+        self.deadline = time.monotonic() + seconds
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.errors = []
+        # guid => player guids the game was handed to
+        self.handed_out = {}
+        # guid => moves answered with move_made
+        self.accepted = {}
+        self.counts = {"queue_up": 0, "dequeue": 0, "move": 0}
+
+    def running(self):
+        return time.monotonic() < self.deadline
+
+    def record(self, command):
+        with self.lock:
+            self.counts[command] += 1
+
+    def play(self, commands, pguid, gguid, rng):
+        started = time.monotonic()
+        while self.running() and time.monotonic() - started < GAME_PATIENCE:
+            board = self.keeper.get_board(gguid)
+            if board.is_game_over() or len(board.move_stack) >= GAME_PLIES:
+                return
+            move = rng.choice(list(board.legal_moves)).uci()
+            response = commands.dispatch(f"move|{gguid}|{move}|{pguid}")
+            self.record("move")
+            if response == b"move_made":
+                with self.lock:
+                    self.accepted[gguid] = self.accepted.get(gguid, 0) + 1
+            elif response in (b"exception|not-players-turn", b"exception|illegal_move"):
+                # The opponent moved in between, or it is not our turn yet
+                time.sleep(0.001)
+            else:
+                raise RuntimeError(f"Unexpected move response {response}")
+
+    def player(self, commands, pguid, index):
+        rng = random.Random(self.seed + index)
+        try:
+            while self.running():
+                response = commands.dispatch(f"queue_up|{pguid}").decode("utf8")
+                self.record("queue_up")
+                if response == "queued_for_game":
+                    if rng.random() < DEQUEUE_CHANCE:
+                        commands.dispatch(f"dequeue|{pguid}")
+                        self.record("dequeue")
+                    time.sleep(0.002)
+                    continue
+                with self.lock:
+                    self.handed_out.setdefault(response, []).append(pguid)
+                self.play(commands, pguid, response, rng)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(f"{pguid[:8]}: {e!r}")
+
+    def background(self, job, interval):
+        try:
+            while self.running():
+                job()
+                time.sleep(interval)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(f"{job.__name__}: {e!r}")
+
+
+def check(stress, keeper, players):
+    from models.move_log import MOVE
+
+    problems = list(stress.errors)
+    for gguid, pguids in stress.handed_out.items():
+        live = keeper.live_game(gguid)
+        expected = {
+            players[live.white_player_id],
+            players[live.black_player_id],
+        }
+        if len(pguids) != len(set(pguids)) or not set(pguids) <= expected:
+            problems.append(f"Game {gguid[:8]} handed to {pguids}")
+    for player_id in players:
+        if keeper.storage.has_offer(player_id) and player_id in keeper.matchmaker:
+            problems.append(f"Player {player_id} is queued and matched")
+    for gguid, accepted in stress.accepted.items():
+        live = keeper.live_game(gguid)
+        if live.version != accepted:
+            problems.append(
+                f"Game {gguid[:8]}: {accepted} moves, version {live.version}"
+            )
+        stored = len(keeper.storage.load_game(gguid).move_log) // MOVE.size
+        if stored != accepted:
+            problems.append(f"Game {gguid[:8]}: {accepted} moves, {stored} stored")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--players", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--storage", choices=["sqlite", "memory"], default="sqlite")
+    args = parser.parse_args()
+
+    prepare_database(DB_PATH, fresh=True)
+    from game_keeper import GameKeeper
+    from responder import CommandHandler
+    from storage import MemoryStorage
+
+    keeper = GameKeeper(MemoryStorage() if args.storage == "memory" else None)
+    players = {}
+    for index in range(args.players):
+        commands = CommandHandler(keeper)
+        pguid = register(commands, f"stress{args.seed}_{index}")
+        players[keeper.sessions.get(pguid).id] = pguid
+
+    stress = Stress(keeper, args.seconds, args.seed)
+    threads = [
+        threading.Thread(target=stress.background, args=(job, interval))
+        for job, interval in (
+            (keeper.create_games_for_queue, 0.05),
+            (keeper.flush_games, 0.05),
+        )
+    ]
+    for index, pguid in enumerate(players.values()):
+        threads.append(
+            threading.Thread(
+                target=stress.player, args=(CommandHandler(keeper), pguid, index)
+            )
+        )
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    keeper.flush_games()
+
+    counts = keeper.counts()
+    print(
+        f"{args.players} players, {args.seconds}s: "
+        f"{stress.counts['queue_up']} queue_up, {stress.counts['dequeue']} dequeue, "
+        f"{stress.counts['move']} move, {len(stress.handed_out)} games, "
+        f"{sum(stress.accepted.values())} moves made"
+    )
+    print(f"keeper: {counts}")
+    problems = check(stress, keeper, players)
+    for problem in problems:
+        print(f"FAIL {problem}")
+    if problems:
+        sys.exit(1)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
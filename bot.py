@@ -0,0 +1,577 @@
+"""The computer opponent, an alpha-beta search on python-chess boards.
+
+The searches run in a pool of worker processes, so a thinking bot holds
+neither a Responder thread nor the GIL of the server. Every worker keeps
+its own transposition table between searches, the next move of a game
+mostly meets positions the last search already scored.
+"""
+
+import functools
+import logging
+import multiprocessing
+import random
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import chess
+
+from game_keeper import GameFinished, GameNotFound, IllegalMove, NotPlayersTurn
+from write_coordinator import WriteTimeout
+
+# Worker processes thinking for the bots
+BOT_WORKERS = 2
+# Threads making the moves the workers come back with
+MOVE_THREADS = 2
+# Names of the bot players, one per level
+BOT_NAME = "Computer (level {})"
+# Entries of the transposition table of a worker, it is cleared when full
+TABLE_SIZE = 200000
+# Nodes searched between two looks at the clock
+CHECK_EVERY = 512
+# In timed games a move gets the time left over this many moves..
+MOVES_TO_GO = 30
+# ..but at least this many seconds
+MIN_BUDGET = 0.05
+MATE = 100000
+# Bounds of transposition table scores
+EXACT, LOWER, UPPER = 0, 1, 2
+
+PIECE_VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 320,
+    chess.BISHOP: 330,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0,
+}
+# Bonus of a piece per square, as white sees the board: a8 first, h1 last
+# fmt: off
+PIECE_SQUARES = {
+    chess.PAWN: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ),
+    chess.KNIGHT: (
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ),
+    chess.BISHOP: (
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ),
+    chess.ROOK: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ),
+    chess.QUEEN: (
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ),
+    chess.KING: (
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ),
+}
+# fmt: on
+# piece type => value plus square bonus of a piece on every square (a1 = 0).
+# A white piece on a square is at square ^ 56 of the table, a black piece
+# sees the board mirrored.
+WHITE_SCORES = {
+    piece_type: [
+        PIECE_VALUES[piece_type] + table[square ^ 56] for square in chess.SQUARES
+    ]
+    for piece_type, table in PIECE_SQUARES.items()
+}
+BLACK_SCORES = {
+    piece_type: [PIECE_VALUES[piece_type] + table[square] for square in chess.SQUARES]
+    for piece_type, table in PIECE_SQUARES.items()
+}
+
+
+class BotLevel:
+    """How strong a bot plays."""
+
+    __slots__ = ("depth", "seconds", "noise", "rating")
+
+    def __init__(self, depth, seconds, noise, rating):
+        # Deepest iteration of the search
+        self.depth = depth
+        # Most seconds a move may take
+        self.seconds = seconds
+        # Up to this many centipawns are added to or taken off evaluations
+        self.noise = noise
+        # The rating of the queued players that get this level
+        self.rating = rating
+
+
+LEVELS = {
+    1: BotLevel(1, 0.1, 300, 800),
+    2: BotLevel(2, 0.2, 150, 1100),
+    3: BotLevel(3, 0.5, 60, 1400),
+    4: BotLevel(4, 1.0, 20, 1700),
+    5: BotLevel(6, 2.0, 0, 2000),
+}
+BOT_NAMES = {BOT_NAME.format(level) for level in LEVELS}
+
+
+class OutOfTime(Exception):
+    """Raised inside a search when its deadline has passed."""
+
+
+def evaluate(board):
+    """The material and square bonus of a position, for the side to move."""
+    score = 0
+    white = board.occupied_co[chess.WHITE]
+    for piece_type, pieces in (
+        (chess.PAWN, board.pawns),
+        (chess.KNIGHT, board.knights),
+        (chess.BISHOP, board.bishops),
+        (chess.ROOK, board.rooks),
+        (chess.QUEEN, board.queens),
+        (chess.KING, board.kings),
+    ):
+        white_scores = WHITE_SCORES[piece_type]
+        black_scores = BLACK_SCORES[piece_type]
+        for square in chess.scan_forward(pieces & white):
+            score += white_scores[square]
+        for square in chess.scan_forward(pieces & ~white):
+            score -= black_scores[square]
+    return score if board.turn == chess.WHITE else -score
+
+
+class AlphaBeta:
+    """An iterative deepening negamax search with alpha-beta pruning.
+
+    Positions are scored with `evaluate` after the captures have been
+    played out. Scored positions go in [table], keyed by the transposition
+    key python-chess detects repetitions with, and their best move is
+    tried first when the position comes up again.
+    """
+
+    def __init__(self, board, level, deadline, table, rng=random):
+        self.board = board
+        self.level = level
+        # time.time() the search has to stop at
+        self.deadline = deadline
+        self.table = table
+        self.rng = rng
+        self.nodes = 0
+        self.iteration = 0
+        self.best_move = None
+        # Keys of the positions from the root down to the current one
+        self._path = set()
+
+    def run(self):
+        """Search until the deadline or the depth of the level.
+
+        The first iteration always finishes, a late search still moves.
+
+        Returns
+        -------
+        tuple
+            (chess.Move, score in centipawns, depth of the last finished
+            iteration).
+
+        """
+        moves = list(self.board.legal_moves)
+        if len(moves) == 1:
+            return moves[0], 0, 0
+        best, score, depth = moves[0], 0, 0
+        for iteration in range(1, self.level.depth + 1):
+            self.iteration = iteration
+            try:
+                score = self._negamax(iteration, -MATE - 1, MATE + 1, 0)
+            except OutOfTime:
+                break
+            best, depth = self.best_move, iteration
+            if abs(score) >= MATE - 100 or time.time() >= self.deadline:
+                break
+        return best, score, depth
+
+    def _evaluate(self):
+        score = evaluate(self.board)
+        if self.level.noise:
+            score += self.rng.randint(-self.level.noise, self.level.noise)
+        return score
+
+    def _count_node(self):
+        self.nodes += 1
+        if (
+            self.nodes % CHECK_EVERY == 0
+            and self.iteration > 1
+            and time.time() >= self.deadline
+        ):
+            raise OutOfTime()
+
+    def _ordered(self, moves, first=None):
+        """The moves, [first] first, then captures of the most valuable
+        pieces by the least valuable ones, then the rest."""
+        board = self.board
+
+        def rank(move):
+            if move == first:
+                return 1000
+            victim = board.piece_type_at(move.to_square)
+            if victim is None:
+                if board.is_en_passant(move):
+                    victim = chess.PAWN
+                elif move.promotion:
+                    return 50
+                else:
+                    return 0
+            return 100 + 10 * victim - board.piece_type_at(move.from_square)
+
+        return sorted(moves, key=rank, reverse=True)
+
+    def _negamax(self, depth, alpha, beta, ply):
+        self._count_node()
+        board = self.board
+        key = board._transposition_key()
+        if ply and (key in self._path or board.halfmove_clock >= 100):
+            # Repeating a position of the search is a draw
+            return 0
+        if depth <= 0:
+            return self._quiesce(alpha, beta)
+        best_move = None
+        entry = self.table.get(key)
+        if entry is not None:
+            entry_depth, score, bound, best_move = entry
+            if ply and entry_depth >= depth:
+                if (
+                    bound == EXACT
+                    or (bound == LOWER and score >= beta)
+                    or (bound == UPPER and score <= alpha)
+                ):
+                    return score
+        original_alpha = alpha
+        best = -MATE - 1
+        self._path.add(key)
+        for move in self._ordered(board.generate_legal_moves(), best_move):
+            board.push(move)
+            try:
+                score = -self._negamax(depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.pop()
+            if score > best:
+                best, best_move = score, move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+        self._path.discard(key)
+        if best == -MATE - 1:
+            # No legal moves: mated, the sooner the worse, or stalemate
+            return -(MATE - ply) if board.is_check() else 0
+        if best <= original_alpha:
+            bound = UPPER
+        elif best >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        if len(self.table) >= TABLE_SIZE:
+            self.table.clear()
+        self.table[key] = (depth, best, bound, best_move)
+        if ply == 0:
+            self.best_move = best_move
+        return best
+
+    def _quiesce(self, alpha, beta):
+        """Play out the captures, so no position is scored mid exchange."""
+        self._count_node()
+        board = self.board
+        standing = self._evaluate()
+        if standing >= beta:
+            return standing
+        alpha = max(alpha, standing)
+        for move in self._ordered(board.generate_legal_captures()):
+            board.push(move)
+            try:
+                score = -self._quiesce(-beta, -alpha)
+            finally:
+                board.pop()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+
+# The transposition table of this worker process, kept between searches
+_TABLE = {}
+
+
+def search(fen, level, deadline):
+    """Find a move for a position, run in the worker processes.
+
+    Parameters
+    ----------
+    fen : String
+        The position.
+    level : Integer
+        A key of LEVELS.
+    deadline : float
+        The time.time() to stop searching at.
+
+    Returns
+    -------
+    Hash
+        The uci `move`, its `score` and `depth`, the `nodes` searched and
+        when the search `started` and how many `seconds` it took.
+
+    """
+    started = time.time()
+    searcher = AlphaBeta(chess.Board(fen), LEVELS[level], deadline, _TABLE)
+    move, score, depth = searcher.run()
+    return {
+        "move": move.uci(),
+        "score": score,
+        "depth": depth,
+        "nodes": searcher.nodes,
+        "started": started,
+        "seconds": time.time() - started,
+    }
+
+
+def _warm_up():
+    """Submitted once per worker on start, so the first move does not wait
+    for a process to start."""
+
+
+class Bot:
+    """Plays the bot players in the games of a GameKeeper.
+
+    Every level has a player of its own. When one of them is to move, the
+    position goes to the worker pool and the move it comes back with is
+    made on a move thread of the bot, like the move of any player. Making
+    a move waits for its commit, the result thread of the pool does not.
+    """
+
+    def __init__(self, workers=BOT_WORKERS, after=None):
+        """Set up a bot, it plays once started.
+
+        Parameters
+        ----------
+        workers : Integer
+            Worker processes thinking at the same time.
+        after : float
+            Optional, seconds a queued player waits before a bot takes
+            the game. Only players that ask for a bot get one if None.
+
+        """
+        self.logger = logging.getLogger("Bot")
+        self.workers = workers
+        self.after = after
+        self.game_keeper = None
+        self._pool = None
+        self._movers = None
+        # player id => (PlayerRecord, level) of the bot players
+        self.players = {}
+        # level => PlayerRecord
+        self._by_level = {}
+        # guid => version of the games a search is running for
+        self._thinking = {}
+        # Futures of the searches not done yet
+        self._searches = set()
+        # Set by stop, no searches are started after
+        self.stopped = False
+        self._lock = threading.Lock()
+        self.started = None
+        self.searches = 0
+        self.nodes = 0
+        self.search_seconds = 0.0
+        # Seconds the searches waited for a free worker
+        self.wait_seconds = 0.0
+
+    def start(self, game_keeper):
+        """Set up the bot players and the workers, and play the games of
+        [game_keeper]."""
+        self.game_keeper = game_keeper
+        for level in LEVELS:
+            record = self._account(game_keeper.storage, level)
+            if record is None:
+                self.logger.error(
+                    f"{BOT_NAME.format(level)} is the name of a player, "
+                    f"no bot plays level {level}"
+                )
+                continue
+            self.players[record.id] = (record, level)
+            self._by_level[level] = record
+        # Spawned, not forked: the server has threads holding locks by now
+        self._pool = ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        for _ in range(self.workers):
+            self._pool.submit(_warm_up)
+        self._movers = ThreadPoolExecutor(MOVE_THREADS, thread_name_prefix="BotMove")
+        self.started = time.monotonic()
+        game_keeper.attach_bot(self)
+
+    def stop(self):
+        """Stop the workers, the searches still queued are dropped."""
+        if self._pool is None:
+            return
+        with self._lock:
+            self.stopped = True
+            searches = list(self._searches)
+        # Cancelling runs _done, which takes the lock
+        for future in searches:
+            future.cancel()
+        self._pool.shutdown(wait=False)
+        self._movers.shutdown(wait=False)
+
+    def _account(self, storage, level):
+        """The bot player of a level, None if a player has its name."""
+        name = BOT_NAME.format(level)
+        record = storage.bot_by_name(name)
+        if record is None:
+            # Nobody knows the password, the bot players cannot log in
+            record = storage.register(name, secrets.token_hex(28), bot=True)
+        if record is None:
+            # Shards register together on boot, one of them wins the name
+            record = storage.bot_by_name(name)
+        return record
+
+    def player(self, level):
+        """The PlayerRecord of a level, raises KeyError for unknown levels."""
+        return self._by_level[level]
+
+    def player_for(self, rating):
+        """The PlayerRecord of the level closest to a rating."""
+        level = min(
+            self._by_level, key=lambda level: abs(LEVELS[level].rating - rating)
+        )
+        return self._by_level[level]
+
+    def play(self, live):
+        """Start thinking if a bot is to move in a game.
+
+        Returns right away, the move is made once the search is done. The
+        caller holds the lock of the game. Does nothing once stopped.
+
+        Parameters
+        ----------
+        live : LiveGame
+            A game of the GameKeeper.
+
+        """
+        bot = self.players.get(live.player_to_play_id)
+        if bot is None or live.state != "in_progress":
+            return
+        record, level = bot
+        submitted = time.time()
+        with self._lock:
+            if self.stopped or self._thinking.get(live.guid) == live.version:
+                return
+            self._thinking[live.guid] = live.version
+            # Under the lock, stop shuts the pool down once it has the lock
+            future = self._pool.submit(
+                search, live.board.fen(), level, submitted + self._budget(live, level)
+            )
+            self._searches.add(future)
+        # Runs _done right away if the search is done already
+        future.add_done_callback(
+            functools.partial(self._done, live.guid, live.version, record, submitted)
+        )
+
+    def _budget(self, live, level):
+        """Seconds the move may take, the level's or less on a clock."""
+        seconds = LEVELS[level].seconds
+        clock = live.clock
+        if clock is not None and clock.deadline() is not None:
+            left = clock.deadline() - clock.clock()
+            seconds = min(
+                seconds, max(MIN_BUDGET, left / MOVES_TO_GO + clock.increment / 2)
+            )
+        return seconds
+
+    def _done(self, guid, version, record, submitted, future):
+        with self._lock:
+            self._searches.discard(future)
+            if self._thinking.get(guid) == version:
+                del self._thinking[guid]
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except Exception as e:
+            self.logger.exception(f"Search in {guid} failed: {e}")
+            return
+        with self._lock:
+            self.searches += 1
+            self.nodes += result["nodes"]
+            self.search_seconds += result["seconds"]
+            self.wait_seconds += max(0.0, result["started"] - submitted)
+        try:
+            self._movers.submit(self._move, guid, record, result["move"])
+        except RuntimeError as e:
+            # Stopped while the search ran
+            self.logger.debug(f"Dropping move of {record.name} in {guid}: {e}")
+
+    def _move(self, guid, record, move):
+        try:
+            self.game_keeper.make_move(guid, record, move)
+        except (GameNotFound, GameFinished, NotPlayersTurn, IllegalMove) as e:
+            # The game ended while the bot was thinking
+            self.logger.debug(f"Dropping move of {record.name} in {guid}: {e}")
+        except WriteTimeout as e:
+            # Made, the WriteCoordinator writes it with the next commit
+            self.logger.warning(f"Move of {record.name} in {guid} not saved: {e}")
+
+    def stats(self):
+        """Searches, speed and how busy the workers are.
+
+        `saturation` is the part of the worker time since start spent
+        searching, near 1 the games wait for workers: see `mean_wait_ms`.
+        """
+        with self._lock:
+            searches = max(1, self.searches)
+            uptime = time.monotonic() - self.started if self.started else 0.0
+            return {
+                "workers": self.workers,
+                "thinking": len(self._thinking),
+                "searches": self.searches,
+                "nodes": self.nodes,
+                "nodes_per_s": round(self.nodes / max(self.search_seconds, 1e-9)),
+                "mean_search_ms": round(self.search_seconds / searches * 1000, 1),
+                "mean_wait_ms": round(self.wait_seconds / searches * 1000, 1),
+                "saturation": round(
+                    self.search_seconds / max(uptime * self.workers, 1e-9), 3
+                ),
+            }
@@ -0,0 +1,126 @@
+import math
+import time
+
+import chess
+
+# Longest base time and increment of a time control, in seconds
+MAX_BASE = 24 * 60 * 60
+MAX_INCREMENT = 60 * 60
+
+
+class InvalidTimeControl(Exception):
+    """Raise when a time control can not be parsed."""
+
+
+def parse_time_control(time_control):
+    """Parse a time control like "5+3".
+
+    Parameters
+    ----------
+    time_control : String
+        Base time in minutes and increment in seconds, "{base}+{increment}".
+        The base is over 0 and at most MAX_BASE seconds, the increment at
+        most MAX_INCREMENT.
+
+    Returns
+    -------
+    tuple
+        (base, increment), both in seconds.
+
+    """
+    try:
+        base, increment = time_control.split("+")
+        base, increment = float(base) * 60, float(increment)
+    except (AttributeError, ValueError):
+        raise InvalidTimeControl(f"Invalid time control {time_control}")
+    if not (math.isfinite(base) and math.isfinite(increment)):
+        raise InvalidTimeControl(f"Invalid time control {time_control}")
+    if not 0 < base <= MAX_BASE or not 0 <= increment <= MAX_INCREMENT:
+        raise InvalidTimeControl(f"Invalid time control {time_control}")
+    return base, increment
+
+
+class ChessClock:
+    """The two clocks of a timed game.
+
+    The clock of the side to move runs from the moment their turn started.
+    `remaining` only changes when a move is made, so it can be stored and
+    sent to clients as is; the time used in the current turn is taken off
+    when asked for.
+    """
+
+    def __init__(self, time_control, white=None, black=None, clock=time.monotonic):
+        """Set up the clocks, stopped.
+
+        Parameters
+        ----------
+        time_control : String
+            The time control of the game, see parse_time_control.
+        white : Integer
+            Optional, milliseconds white has left. The full base time if None.
+        black : Integer
+            Optional, milliseconds black has left. The full base time if None.
+        clock : callable
+            Returns the current time in seconds.
+
+        """
+        self.time_control = time_control
+        self.base, self.increment = parse_time_control(time_control)
+        self.remaining = {
+            chess.WHITE: self.base if white is None else white / 1000,
+            chess.BLACK: self.base if black is None else black / 1000,
+        }
+        self.clock = clock
+        self.turn = chess.WHITE
+        self.turn_started = None
+
+    def start(self, turn, now=None):
+        """Start the clock of [turn]."""
+        self.turn = turn
+        self.turn_started = self.clock() if now is None else now
+
+    def press(self, now=None):
+        """End the turn of the side to move and start the other clock.
+
+        Returns
+        -------
+        float
+            Seconds the side that moved has left, increment included.
+
+        """
+        now = self.clock() if now is None else now
+        self.remaining[self.turn] -= now - self.turn_started
+        self.remaining[self.turn] += self.increment
+        moved = self.turn
+        self.start(not self.turn, now)
+        return self.remaining[moved]
+
+    def stop(self, now=None):
+        """Stop the running clock, after the game ended."""
+        if self.turn_started is None:
+            return
+        now = self.clock() if now is None else now
+        self.remaining[self.turn] = max(
+            0.0, self.remaining[self.turn] - (now - self.turn_started)
+        )
+        self.turn_started = None
+
+    def deadline(self):
+        """The clock time the side to move runs out of time at."""
+        if self.turn_started is None:
+            return None
+        return self.turn_started + self.remaining[self.turn]
+
+    def flagged(self, now=None):
+        """Has the side to move run out of time?"""
+        deadline = self.deadline()
+        if deadline is None:
+            return False
+        return (self.clock() if now is None else now) >= deadline
+
+    def millis(self):
+        """The remaining time of (white, black) in milliseconds, to store."""
+        return (
+            int(self.remaining[chess.WHITE] * 1000),
+            int(self.remaining[chess.BLACK] * 1000),
+        )
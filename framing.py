@@ -0,0 +1,136 @@
+import struct
+
+# A framed client opens the connection with this preamble. Legacy clients
+# always start with a plain text command, so the leading NUL byte can never
+# be mistaken for one.
+FRAME_MAGIC = b"\x00CSF1"
+
+# Every frame: payload length + request id, both unsigned 32 bit big endian.
+FRAME_HEADER = struct.Struct(">II")
+
+# Frames the server pushes without a request (subscriptions) carry this id,
+# clients number their requests from 1.
+PUSH_REQUEST_ID = 0
+
+# Refuse anything bigger than this, a client sending more is broken.
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Pushed frames a connection holds for a client that does not read them,
+# one more and the client is unsubscribed.
+MAX_PUSHES = 256
+
+
+class FrameError(Exception):
+    """Raise when a peer sends a frame we can not handle."""
+
+
+class PushOverflow(Exception):
+    """Raise when a client falls too far behind the frames pushed to it."""
+
+
+def pack_frame(request_id, payload):
+    """Pack a payload into a frame.
+
+    Parameters
+    ----------
+    request_id : Integer
+        The id the client tagged the request with.
+    payload : bytes or String
+        The body of the frame.
+
+    Returns
+    -------
+    bytes
+        Header and payload ready to be sent.
+
+    """
+    if isinstance(payload, str):
+        payload = payload.encode("utf8")
+    return FRAME_HEADER.pack(len(payload), request_id) + payload
+
+
+class FrameReader:
+    """Read frames from a blocking socket."""
+
+    def __init__(self, sock, buffered=b""):
+        self.sock = sock
+        self._buffer = bytearray(buffered)
+
+    def _fill(self, size):
+        while len(self._buffer) < size:
+            chunk = self.sock.recv(max(4096, size - len(self._buffer)))
+            if not chunk:
+                return False
+            self._buffer.extend(chunk)
+        return True
+
+    def read_frame(self):
+        """Read the next frame.
+
+        Returns
+        -------
+        tuple
+            (request_id, payload) or None when the peer closed the connection.
+
+        """
+        if not self._fill(FRAME_HEADER.size):
+            return None
+        length, request_id = FRAME_HEADER.unpack_from(self._buffer)
+        if length > MAX_FRAME_SIZE:
+            raise FrameError(f"Frame of {length} bytes is too big")
+        if not self._fill(FRAME_HEADER.size + length):
+            return None
+        payload = bytes(self._buffer[FRAME_HEADER.size : FRAME_HEADER.size + length])
+        del self._buffer[: FRAME_HEADER.size + length]
+        return request_id, payload
+
+
+class FramedClient:
+    """A small client for the framed protocol.
+
+    Requests are sent one after the other on the same connection, the
+    responses are matched to the requests by their id.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sock.sendall(FRAME_MAGIC)
+        self._reader = FrameReader(sock)
+        self._next_id = 1
+        self._responses = {}
+        self.pushes = []
+
+    def send(self, command):
+        """Send a command and return the request id it was tagged with."""
+        request_id = self._next_id
+        self._next_id += 1
+        self.sock.sendall(pack_frame(request_id, command))
+        return request_id
+
+    def _read(self):
+        frame = self._reader.read_frame()
+        if frame is None:
+            raise ConnectionResetError("Server closed the connection")
+        if frame[0] == PUSH_REQUEST_ID:
+            self.pushes.append(frame[1])
+        else:
+            self._responses[frame[0]] = frame[1]
+
+    def receive(self, request_id):
+        """Wait for the response to a request send earlier."""
+        while request_id not in self._responses:
+            self._read()
+        return self._responses.pop(request_id)
+
+    def wait_push(self):
+        """Wait for the next frame pushed by the server."""
+        while not self.pushes:
+            self._read()
+        return self.pushes.pop(0)
+
+    def request(self, command):
+        """Send a command and wait for its response."""
+        return self.receive(self.send(command))
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,70 @@
+"""The tiers the GameKeeper keeps its games in.
+
+Recently played games are hot: a LiveGame with its board, in the current
+games of the keeper. The least recently used games over the hot budget
+are demoted to warm: the storage fields of their record and their move
+log. 40 moves into a game that is under a kilobyte, where the LiveGame
+takes about 25, see benchmarks/bench_game_cache.py. The oldest warm
+games over the warm budget are dropped, they are cold and loaded from
+the storage again when asked for. A warm or cold game is promoted back
+to hot on its first access.
+"""
+
+import collections
+import threading
+
+# LiveGames kept in memory
+HOT_GAMES = 10000
+# Demoted games kept as compact records
+WARM_GAMES = 100000
+
+
+class WarmGames:
+    """A bounded LRU of the compact records of demoted games.
+
+    Taking a game out of it promotes the game, so the order is the order
+    the games were demoted in.
+    """
+
+    def __init__(self, size=WARM_GAMES):
+        self.size = size
+        # guid => (fields, move log), fields JSON encoded
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.evictions = 0
+
+    def put(self, guid, fields, move_log):
+        """Keep a demoted game, dropping the oldest ones over the size."""
+        with self._lock:
+            self._entries[guid] = (fields, move_log)
+            self._entries.move_to_end(guid)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def take(self, guid):
+        """Take a game out to promote it.
+
+        Returns
+        -------
+        tuple
+            (fields, move log) or None if the game is not warm.
+
+        """
+        with self._lock:
+            entry = self._entries.pop(guid, None)
+            if entry is not None:
+                self.hits += 1
+            return entry
+
+    def items(self):
+        """A list of guid, (fields, move log) of all warm games."""
+        with self._lock:
+            return list(self._entries.items())
+
+    def __contains__(self, guid):
+        return guid in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,10 +1,20 @@
 import chess
+import heapq
+import json
 import logging
 import random
+import threading
+import time
 
-from models.game import Game
-from models.player import Player
-from time import sleep
+from datetime import datetime
+from clock import ChessClock, parse_time_control
+from game_cache import HOT_GAMES, WARM_GAMES, WarmGames
+from legal_moves import NO_MOVES, LegalMoveCache
+from models.move_log import MOVE, pack_move, replay
+from matchmaker import Matchmaker
+from sessions import PlayerRecord, SessionCache
+from snapshot import InvalidSnapshot, Snapshot, write_snapshot
+from storage import SQLiteStorage
 
 
 class GameNotFound(Exception):
@@ -19,20 +29,376 @@ class NotPlayersTurn(Exception):
     """Raise when its not the players turn to move."""
 
 
+class GameFinished(Exception):
+    """Raise when a move is made in a game that has ended."""
+
+
+# Game state => the result shown to clients, for games that did not end on
+# the board
+RESULTS = {"white_won": "White won", "black_won": "Black won", "draw": "Draw"}
+SCORES = {"white_won": "1-0", "black_won": "0-1", "draw": "1/2-1/2"}
+WINNERS = {chess.WHITE: "white_won", chess.BLACK: "black_won", None: "draw"}
+
+
+def _timestamp():
+    """Format now the way the game timestamps are shown to clients."""
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class LiveGame:
+    """An in progress game kept in memory by the GameKeeper.
+
+    Holds the live chess.Board so moves are checked without touching the
+    database. All access to the board must hold the lock of the game.
+    """
+
+    def __init__(self, record):
+        self.record = record
+        self.guid = record.guid
+        self.id = record.id
+        self.white_player_id = record.white_player_id
+        self.black_player_id = record.black_player_id
+        self.white_name = record.white_name
+        self.black_name = record.black_name
+        self.state = record.state
+        self.started = record.started
+        self.last_move = record.last_move
+        self.board = record.load_board()
+        self.start_fen = record.start_fen
+        # All moves of the game packed, to send clients the moves they miss
+        self.move_log = bytearray(record.move_log or b"")
+        # Counts the moves made, clients use it to skip unchanged states
+        self.version = len(self.move_log) // MOVE.size
+        # Moves made since the game was last written to the database
+        self.unsaved_moves = []
+        self._state = None
+        # LegalMoves of the current position, once asked for
+        self._legal_moves = None
+        self.lock = threading.Lock()
+        # Only timed games have a clock, it runs from when the game is live
+        self.clock = None
+        if record.time_control:
+            self.clock = ChessClock(
+                record.time_control, record.white_clock, record.black_clock
+            )
+            self.clock.start(self.board.turn)
+        # The TimeLord call that flags the side to move
+        self.flag_call = None
+        # When the game was last asked for, the least recently used games
+        # are demoted first
+        self.last_access = time.monotonic()
+        # Set once the game is demoted, moves must be made on the LiveGame
+        # it is promoted to
+        self.demoted = False
+
+    @property
+    def player_to_play_id(self):
+        if self.board.turn:
+            return self.white_player_id
+        else:
+            return self.black_player_id
+
+    @property
+    def etag(self):
+        return f"{self.guid}:{self.version}:{self.state}"
+
+    def push(self, move):
+        """Make a move on the board, the caller must hold the lock."""
+        self.board.push(move)
+        self.move_log += pack_move(move)
+        self.unsaved_moves.append(move)
+        self.last_move = _timestamp()
+        self.version += 1
+        self._state = None
+        self._legal_moves = None
+
+    def full_board(self):
+        """A copy of the board with every move of the game on its move
+        stack, the caller must hold the lock.
+
+        The board of a reloaded game starts at its last checkpoint, the
+        pickled boards clients get carry the whole game.
+        """
+        if len(self.board.move_stack) == self.version:
+            return self.board.copy()
+        return replay(self.start_fen, bytes(self.move_log))
+
+    def legal_moves(self, cache):
+        """The LegalMoves of the position, the caller must hold the lock.
+
+        Looked up in [cache] once per position.
+        """
+        if self._legal_moves is None:
+            self._legal_moves = cache.get(self.board)
+        return self._legal_moves
+
+    def is_legal(self, move):
+        """Check a move, the caller must hold the lock.
+
+        Uses the legal moves of the position if a client asked for them
+        already. Otherwise only this move is checked, python-chess does
+        that without generating all moves.
+        """
+        if self._legal_moves is not None:
+            return move in self._legal_moves
+        return move in self.board.legal_moves
+
+    def end_on_board(self):
+        """Take the result from the board, the caller must hold the lock.
+
+        Returns
+        -------
+        Boolean
+            True if the last move ended the game.
+
+        """
+        outcome = self.board.outcome()
+        if outcome is None:
+            return False
+        if self.clock is not None:
+            self.clock.stop()
+        self.state = WINNERS[outcome.winner]
+        self._state = None
+        return True
+
+    def time_out(self):
+        """End the game on time, the caller must hold the lock.
+
+        The side to move loses, unless the other side has no way to mate:
+        then it is a draw.
+        """
+        self.clock.stop()
+        flagged = self.board.turn
+        if self.board.has_insufficient_material(not flagged):
+            self.state = "draw"
+        else:
+            self.state = "black_won" if flagged == chess.WHITE else "white_won"
+        self._state = None
+
+    def game_state(self):
+        """Return the state dict of the current position.
+
+        The state is computed once per position and kept until the next
+        move, the caller must hold the lock.
+        """
+        if self._state is not None:
+            return self._state
+        board = self.board
+        game_state = {}
+        game_state["guid"] = self.guid
+        game_state["version"] = self.version
+        game_state["etag"] = self.etag
+        game_state["white_player"] = self.white_name
+        game_state["black_player"] = self.black_name
+        game_state["started"] = self.started
+        game_state["last_move"] = self.last_move
+        game_state["fen"] = board.fen()
+        game_state["checkmate"] = board.is_checkmate()
+        game_state["stalemate"] = board.is_stalemate()
+        game_state["insufficient_material"] = board.is_insufficient_material()
+        game_state["seventyfive_moves"] = board.is_seventyfive_moves()
+        game_state["fivefold_repetition"] = board.is_fivefold_repetition()
+        game_state["can_claim_fifty_moves"] = board.can_claim_fifty_moves()
+        game_state[
+            "can_claim_threefold_repetition"
+        ] = board.can_claim_threefold_repetition()
+        game_state["can_claim_draw"] = (
+            game_state["can_claim_fifty_moves"]
+            or game_state["can_claim_threefold_repetition"]
+        )
+        # The same checks board.is_game_over() would run again
+        game_state["game_over"] = (
+            game_state["checkmate"]
+            or game_state["stalemate"]
+            or game_state["insufficient_material"]
+            or game_state["seventyfive_moves"]
+            or game_state["fivefold_repetition"]
+        )
+        game_state["result"] = None
+        game_state["timeout"] = False
+        if game_state["checkmate"]:
+            # The side to move has been mated
+            game_state["result"] = "Black won" if board.turn else "White won"
+        elif game_state["game_over"]:
+            game_state["result"] = "Draw"
+        elif self.state in RESULTS:
+            game_state["game_over"] = True
+            game_state["timeout"] = True
+            game_state["result"] = RESULTS[self.state]
+        game_state["time_control"] = None
+        if self.clock is not None:
+            # Seconds left as of the last move, the clock of the side to
+            # move has been running since last_move
+            game_state["time_control"] = self.clock.time_control
+            game_state["white_clock"] = round(self.clock.remaining[chess.WHITE], 3)
+            game_state["black_clock"] = round(self.clock.remaining[chess.BLACK], 3)
+        self._state = game_state
+        return game_state
+
+
 class GameKeeper:
     """A keeper of games between players."""
 
-    def __init__(self):
-        """Initialize a new GameKeeper."""
+    def __init__(
+        self, storage=None, owns=None, hot_games=HOT_GAMES, warm_games=WARM_GAMES
+    ):
+        """Initialize a new GameKeeper.
+
+        Parameters
+        ----------
+        storage : Storage
+            Where the players and games are kept, SQLiteStorage if None.
+        owns : callable
+            Optional, called with a game guid, True for the games this
+            keeper plays. Set when the games are sharded over several
+            keepers, see sharding.py. All games if None.
+        hot_games : Integer
+            The games kept as LiveGames, demote_idle demotes the least
+            recently used ones over it. See game_cache.py.
+        warm_games : Integer
+            The demoted games kept as compact records.
+
+        """
         self.logger = logging.getLogger("GameKeeper")
         self.logger.debug("__init__")
-        self._current_games = set()
-        self._current_player_queue = set()
-        self._games_to_start = {}
+        # guid => LiveGame of the games being played, the hot games
+        self._current_games = {}
+        self.hot_games = hot_games
+        # The games demoted from _current_games
+        self.warm = WarmGames(warm_games)
+        # Lookups of the games served from _current_games, and of the games
+        # loaded from the snapshot or the storage. Counted without a lock,
+        # a count may get lost now and then.
+        self.hits = 0
+        self.misses = 0
+        self.demotions = 0
+        self.storage = storage if storage is not None else SQLiteStorage()
+        self.owns = owns
+        self.matchmaker = Matchmaker()
+        # The games made for queued players are offered through the storage.
+        # Offers and the matchmaker are guarded together by _queue_lock, so
+        # a player is always either queued, matched or neither.
+        self._queue_lock = threading.Lock()
+        # guids of games with moves not yet written to the database
+        self._dirty_games = set()
+        self._registry_lock = threading.Lock()
+        # guid => callbacks to push the moves of a game to
+        self._subscribers = {}
+        # guid => PlayerRecord of the players that are logged in
+        self.sessions = SessionCache()
+        self.storage.watch_players(self.sessions)
+        # Flushes must not overlap or the moves could be appended out of order
+        self._flush_lock = threading.Lock()
+        # Schedules the flag fall of timed games, see attach_time_lord
+        self.time_lord = None
+        # Legal moves of the positions of all games, for the legal_moves
+        # command
+        self.legal_move_cache = LegalMoveCache()
+        # Plays the bot players, see attach_bot
+        self.bot = None
+        # Commits the moves before they are confirmed, see attach_writer
+        self.writer = None
+        # The Snapshot the keeper was restored from, see load_games. Its
+        # games are loaded from it once they are asked for.
+        self.snapshot = None
+        # guids of the games the snapshot is no longer up to date for:
+        # loaded already, or written since it was taken
+        self._off_snapshot = set()
+
+    def attach_time_lord(self, time_lord):
+        """Let [time_lord] end the timed games whose clock runs out.
+
+        Without a TimeLord a flag only falls when the player moves too late.
+        """
+        self.time_lord = time_lord
+        with self._registry_lock:
+            games = list(self._current_games.values())
+        for live in games:
+            with live.lock:
+                self._schedule_flag(live)
+
+    def attach_writer(self, writer):
+        """Confirm moves only once [writer] committed them.
+
+        Without a WriteCoordinator moves are confirmed right away and
+        written behind by flush_games.
+        """
+        self.writer = writer
+
+    def attach_bot(self, bot):
+        """Let [bot] make the moves of the bot players.
+
+        Without a Bot, games against bot players wait for moves forever.
+        """
+        self.bot = bot
+        with self._registry_lock:
+            games = list(self._current_games.values())
+        for live in games:
+            with live.lock:
+                self._bot_turn(live)
+
+    def _keeps_running(self, live):
+        """Does something happen in a game without the players asking for
+        it? Its clock runs or the bot is to move. The caller holds the lock.
+        """
+        return live.clock is not None or (
+            self.bot is not None and live.player_to_play_id in self.bot.players
+        )
+
+    def _bot_turn(self, live):
+        """Let the bot think if it is to move, the caller holds the lock."""
+        if self.bot is not None:
+            self.bot.play(live)
+
+    def _schedule_flag(self, live):
+        """(Re)schedule the flag fall of a game, the caller holds its lock."""
+        if self.time_lord is None or live.clock is None:
+            return
+        if live.flag_call is not None:
+            self.time_lord.cancel(live.flag_call)
+            live.flag_call = None
+        if live.state == "in_progress":
+            live.flag_call = self.time_lord.call_at(
+                live.clock.deadline(), self._flag_fall, live.guid
+            )
+
+    def _flag_fall(self, guid):
+        """Called by the TimeLord when the clock of a game ran out."""
+        live = self._current_games.get(guid)
+        if live is None:
+            return
+        with live.lock:
+            live.flag_call = None
+            if live.state != "in_progress" or not live.clock.flagged():
+                # A move came in just before, it scheduled the new deadline
+                return
+            event = self._time_out(live)
+        self._finish(live, event)
+
+    def _time_out(self, live):
+        """End a game on time, the caller holds its lock.
+
+        Returns
+        -------
+        Hash
+            The event for the subscribers of the game.
+
+        """
+        flagged = "white" if live.board.turn == chess.WHITE else "black"
+        live.time_out()
+        self.logger.info(f"{flagged} ran out of time in {live.guid}: {live.state}")
+        return {
+            "kind": "flag",
+            "guid": live.guid,
+            "move": flagged,
+            "fen": live.board.fen(),
+            "game_over": True,
+            "result": SCORES[live.state],
+        }
 
     def player_in_queue(self, player):
         """Check if a player is in the current queue for a new game."""
-        return player.id in self._current_player_queue
+        return player.id in self.matchmaker
 
     def dequeue_player(self, player):
         """
@@ -48,76 +414,237 @@ class GameKeeper:
             boolean: True if the player was in the queue. False if (s)he wasn't
 
         """
-        was_in_q = player.id in self._current_player_queue
-        self.remove_player(player)
-        if was_in_q:
-            return True
-        else:
-            return False
+        return self.matchmaker.remove(player.id)
 
-    def new_game(self, player, opponent=None):
-        """Start a new game between players."""
+    def new_game(self, player, opponent=None, time_control=None):
+        """Start a new game between players.
+
+        Without an opponent the player is queued, and gets a game as soon
+        as the matchmaker finds an opponent with the same time control.
+        """
         game = None
+        if time_control is not None:
+            # Raises InvalidTimeControl before anyone is queued
+            parse_time_control(time_control)
         if opponent:
             # Premade game, not adding player to the queue
             # This allows player vs self??
-            game = self._setup_game(player, opponent)
+            game = self._setup_game(player, opponent, time_control)
             return game
-        if player in self._current_player_queue:
+        with self._queue_lock:
+            # The game made for the player, if it is ready
+            gguid = self.storage.claim_game(player.id)
+        if gguid is not None:
+            return self.live_game(gguid)
+        if player.id in self.matchmaker:
             return None  # 'queued'
-        if player.id in self._games_to_start.keys():
-            # Game has been created, return to client
-            gguid = self._games_to_start[player.id]
-            # Remove from list
-            del self._games_to_start[player.id]
-            return self._lookup_game(gguid)
-        # We can't create a game, adding player to queue and return none
-        self.add_player(player)
-        return None
+        # Queue the player, this returns the game if an opponent is waiting
+        return self.add_player(player, time_control)
 
     def create_games_for_queue(self):
         """
         Create new games for the players in queue.
 
-        This will be called once in a while to check the queue. When there are
-        enough players in the queue (2 or more) we start making new games.
+        Players are paired as soon as they queue up when an opponent is
+        waiting. This is called once in a while for the players whose
+        rating windows only meet after waiting for some time.
         """
-        while len(self._current_player_queue) > 1:
+        with self._queue_lock:
+            pairs = self.matchmaker.sweep()
+            for player, opponent, _ in pairs:
+                self.storage.offer_game(player.id, None)
+                self.storage.offer_game(opponent.id, None)
+        for player, opponent, time_control in pairs:
             self.logger.debug("Creating game for clients.")
-            player1 = Player.find(random.choice(list(self._current_player_queue)))
-            # Prevent player vs self
-            available = [p for p in self._current_player_queue if player1.id != p]
-            player2 = Player.find(random.choice(available))
-            game = self._setup_game(player1, player2)
-            self._games_to_start[player1.id] = game.guid
-            self._games_to_start[player2.id] = game.guid
-            self.logger.debug(
-                f"Create another one? {len(self._current_player_queue) > 1}"
-            )
-            sleep(1)
+            try:
+                game = self._start_game(player, opponent, time_control)
+            except Exception as e:
+                self.logger.exception(f"Could not start a game: {e}")
+                continue
+            with self._queue_lock:
+                self.storage.offer_game(player.id, game.guid)
+                self.storage.offer_game(opponent.id, game.guid)
+        if self.bot is not None and self.bot.after is not None:
+            self._pair_with_bot(self.bot.after)
+
+    def _pair_with_bot(self, after):
+        """Give the players queued for more than [after] seconds a game
+        against the bot player closest to their rating."""
+        with self._queue_lock:
+            waiting = self.matchmaker.take_waiting(after)
+            for entry in waiting:
+                self.storage.offer_game(entry.player.id, None)
+        for entry in waiting:
+            opponent = self.bot.player_for(entry.rating)
+            try:
+                game = self._start_game(entry.player, opponent, entry.time_control)
+            except Exception as e:
+                self.logger.exception(f"Could not start a game: {e}")
+                continue
+            with self._queue_lock:
+                self.storage.offer_game(entry.player.id, game.guid)
 
-    def _setup_game(self, player, opponent):
+    def _start_game(self, player, opponent, time_control=None):
+        """Set up the game of a pair with offers being set up.
+
+        On failure the reservations are dropped, so the players can queue
+        up again.
+        """
+        try:
+            return self._setup_game(player, opponent, time_control)
+        except Exception:
+            with self._queue_lock:
+                self.storage.withdraw_offer(player.id)
+                self.storage.withdraw_offer(opponent.id)
+            raise
+
+    def _setup_game(self, player, opponent, time_control=None):
         self.logger.debug(f"Setting up game between {player.name} and {opponent.name}")
-        new_game = Game()
         # Randomize starting player
         if random.randint(1, 100) % 2 == 0:
             self.logger.debug(f"{player.name} starts with white")
-            new_game.white_player_id = player.id
-            new_game.black_player_id = opponent.id
+            white, black = player, opponent
         else:
             self.logger.debug(f"{opponent.name} starts with white")
-            new_game.white_player_id = opponent.id
-            new_game.black_player_id = player.id
-        # Sets up a new game and saves to the DB
-        new_game.setup_new()
-
+            white, black = opponent, player
+        clock = None
+        if time_control is not None:
+            base, _ = parse_time_control(time_control)
+            clock = int(base * 1000)
+        live = LiveGame(self.storage.create_game(white, black, time_control, clock))
         self.remove_player(player)
         self.remove_player(opponent)
-        self._current_games.add(new_game)
-        return new_game
+        if not self._owned(live.guid):
+            # Played by another shard, it loads the game from the storage
+            return live
+        with self._registry_lock:
+            self._current_games[live.guid] = live
+        with live.lock:
+            self._schedule_flag(live)
+            self._bot_turn(live)
+        return live
+
+    def live_game(self, guid):
+        """Return the in memory game for a guid.
+
+        Warm games are promoted, other games not in memory yet are loaded
+        from the snapshot or the database once. Later calls are served
+        from memory, until the game is demoted again.
+
+        Parameters
+        ----------
+        guid : String
+            The id of a game.
+
+        Returns
+        -------
+        LiveGame
+            The game, or None if there is no game with that guid.
+
+        """
+        live = self._current_games.get(guid)
+        if live is not None:
+            live.last_access = time.monotonic()
+            self.hits += 1
+            return live
+        record = self._from_warm(guid)
+        if record is None:
+            self.misses += 1
+            record = self._from_snapshot(guid)
+        if record is None:
+            record = self.storage.load_game(guid)
+        if record is None:
+            return None
+        return self._register(record)
+
+    def live_games(self, guids):
+        """Return the in memory games for a list of guids.
+
+        Warm games are promoted, the games not in memory or the snapshot
+        are loaded from the storage at once.
+
+        Parameters
+        ----------
+        guids : list
+            The ids of the games.
+
+        Returns
+        -------
+        Hash
+            guid => LiveGame, guids without a game are left out.
+
+        """
+        games = {}
+        missing = []
+        now = time.monotonic()
+        for guid in guids:
+            live = self._current_games.get(guid)
+            if live is None:
+                record = self._from_warm(guid)
+                if record is None:
+                    self.misses += 1
+                    record = self._from_snapshot(guid)
+                if record is None:
+                    missing.append(guid)
+                else:
+                    games[guid] = self._register(record)
+            else:
+                live.last_access = now
+                self.hits += 1
+                games[guid] = live
+        if missing:
+            for record in self.storage.load_games(missing):
+                games[record.guid] = self._register(record)
+        return games
+
+    def _from_warm(self, guid):
+        """The GameRecord of a warm game, taken out of the warm games.
+
+        Returns None if the game is not warm.
+        """
+        entry = self.warm.take(guid)
+        if entry is None:
+            return None
+        fields, move_log = entry
+        return self.storage.restore_record(json.loads(fields), move_log)
+
+    def _from_snapshot(self, guid):
+        """The GameRecord of a game in the snapshot, the first time only.
+
+        Returns None if the game is not in the snapshot or it is not up to
+        date for it, the game is loaded from the storage then.
+        """
+        if self.snapshot is None:
+            return None
+        with self._registry_lock:
+            if guid in self._off_snapshot:
+                return None
+        entry = self.snapshot.entry(guid)
+        if entry is None:
+            return None
+        with self._registry_lock:
+            # Only the first of the threads asking at once restores it
+            if guid in self._off_snapshot:
+                return None
+            self._off_snapshot.add(guid)
+        fields, move_log = entry
+        return self.storage.restore_record(json.loads(fields), move_log)
 
-    def _lookup_game(self, guid):
-        return Game.where("guid", guid).first()
+    def _owned(self, guid):
+        return self.owns is None or self.owns(guid)
+
+    def _register(self, record):
+        live = LiveGame(record)
+        if live.state != "in_progress" or not self._owned(live.guid):
+            # Finished games and the games of other shards are not kept around
+            return live
+        with self._registry_lock:
+            registered = self._current_games.setdefault(live.guid, live)
+        if registered is live:
+            with live.lock:
+                self._schedule_flag(live)
+                self._bot_turn(live)
+        return registered
 
     def make_move(self, guid, player, move):
         """Make a [move] for a [player] in a chess game.
@@ -138,24 +665,208 @@ class GameKeeper:
 
         """
         # self.logger.debug(f"Recieved move for game {guid}")
-        game = self._lookup_game(guid)
-        if game is None:
-            self.logger.warn(f"No game with guid {guid} found!")
-            raise GameNotFound(f"No game with guid {guid} found!")
-        board = game.board
-        if player.id == game.player_to_play.id:
-            # Ok, player may move
-            chess_move = chess.Move.from_uci(move)
-            if chess_move in board.legal_moves:
-                board.push(chess_move)
-                game.save_board(board)
-            else:
-                self.logger.info("Illegal move!")
-                raise IllegalMove(f"Illegal move {move}")
+        while True:
+            live = self.live_game(guid)
+            if live is None:
+                self.logger.warn(f"No game with guid {guid} found!")
+                raise GameNotFound(f"No game with guid {guid} found!")
+            with live.lock:
+                if live.demoted:
+                    # Demoted since we got it, make the move on the game
+                    # it is promoted to
+                    continue
+                if live.state != "in_progress":
+                    raise GameFinished(f"Game {guid} has ended: {live.state}")
+                if live.clock is not None and live.clock.flagged():
+                    # Too late, the TimeLord did not get to it yet
+                    event = self._time_out(live)
+                else:
+                    event = self._apply_move(live, player, move)
+                # Taken under the lock, the next move may be made as soon
+                # as it is released
+                state = live.state
+                if state == "in_progress":
+                    if self.writer is None:
+                        with self._registry_lock:
+                            self._dirty_games.add(guid)
+                    self._bot_turn(live)
+            break
+        if state != "in_progress":
+            self._finish(live, event)
         else:
+            if self.writer is not None:
+                # Raises WriteTimeout, the move stays made and is written later
+                self.writer.commit(guid)
+            self._notify(guid, event)
+        if event["kind"] == "flag":
+            raise GameFinished(f"Game {guid} has ended: {state}")
+
+    def _finish(self, live, event):
+        """Write an ended game right away and drop it from memory.
+
+        Parameters
+        ----------
+        live : LiveGame
+            The game, its state is no longer in_progress.
+        event : Hash
+            The last event of the game, sent to the subscribers.
+
+        """
+        with self._flush_lock:
+            self._save(live)
+        self._notify(live.guid, event)
+        with self._registry_lock:
+            self._current_games.pop(live.guid, None)
+            self._dirty_games.discard(live.guid)
+            self._subscribers.pop(live.guid, None)
+        self.logger.debug(f"Game {live.guid} ended: {live.state}")
+
+    def _apply_move(self, live, player, move):
+        """Check and make a move, the caller holds the lock of the game.
+
+        Returns
+        -------
+        Hash
+            The event for the subscribers of the game.
+
+        """
+        if player.id != live.player_to_play_id:
             raise NotPlayersTurn(
-                f"It is not the turn for player {player.id} in game {guid}"
+                f"It is not the turn for player {player.id} in game {live.guid}"
             )
+        # Ok, player may move
+        try:
+            chess_move = chess.Move.from_uci(move)
+        except ValueError:
+            raise IllegalMove(f"Illegal move {move}")
+        if not live.is_legal(chess_move):
+            self.logger.info("Illegal move!")
+            raise IllegalMove(f"Illegal move {move}")
+        live.push(chess_move)
+        if live.clock is not None:
+            live.clock.press()
+        live.end_on_board()
+        # Cancels the flag fall if the game just ended
+        self._schedule_flag(live)
+        # Computed right away, the players will poll for it
+        state = live.game_state()
+        return {
+            "kind": "move",
+            "guid": live.guid,
+            "move": chess_move.uci(),
+            "fen": state["fen"],
+            "game_over": state["game_over"],
+            "result": live.board.result() if state["game_over"] else "*",
+        }
+
+    def subscribe(self, guid, callback):
+        """Call [callback] with every move made in a game.
+
+        Parameters
+        ----------
+        guid : String
+            The id of a game.
+        callback : callable
+            Called with a dict holding the guid, the uci move, the new fen,
+            the game_over flag and the result after every move.
+
+        """
+        live = self.live_game(guid)
+        if live is None:
+            raise GameNotFound(f"No game with guid {guid} found!")
+        if live.state != "in_progress":
+            # Ended games are not kept, nothing would be pushed
+            raise GameFinished(f"Game {guid} has ended: {live.state}")
+        with self._registry_lock:
+            self._subscribers.setdefault(guid, set()).add(callback)
+
+    def unsubscribe(self, guid, callback):
+        """Stop calling [callback] for moves in a game."""
+        with self._registry_lock:
+            callbacks = self._subscribers.get(guid)
+            if callbacks is None:
+                return
+            callbacks.discard(callback)
+            if not callbacks:
+                del self._subscribers[guid]
+
+    def _notify(self, guid, event):
+        with self._registry_lock:
+            callbacks = list(self._subscribers.get(guid, ()))
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                # The subscriber went away or fell behind, stop pushing to it
+                self.logger.debug(f"Dropping subscriber of {guid}: {e}")
+                self.unsubscribe(guid, callback)
+
+    def flush_games(self):
+        """Write the moves made since the last flush to the database.
+
+        Moves are only made on the in memory boards, this writes them
+        behind to the database. Called periodically by the TimeLord and
+        on shutdown.
+        """
+        with self._registry_lock:
+            dirty = self._dirty_games
+            self._dirty_games = set()
+        self.write_games(dirty)
+
+    def write_games(self, guids):
+        """Write the unsaved moves of games in one transaction.
+
+        If it fails none of the games is written: their moves are kept
+        to be written again and their records, which are ahead of the
+        database now, are loaded again.
+
+        Parameters
+        ----------
+        guids : iterable
+            The ids of the games.
+
+        """
+        with self._flush_lock:
+            written = []
+            try:
+                with self.storage.transaction():
+                    for guid in guids:
+                        live = self._current_games.get(guid)
+                        if live is None:
+                            # Ended, and written by _finish
+                            continue
+                        written.append((live, self._save(live)))
+            except Exception:
+                for live, moves in written:
+                    with live.lock:
+                        live.unsaved_moves[:0] = moves
+                        live.record = self.storage.load_game(live.guid) or live.record
+                with self._registry_lock:
+                    self._dirty_games.update(live.guid for live, _ in written)
+                raise
+
+    def _save(self, live):
+        """Write the unsaved moves of a game, the caller holds the flush lock.
+
+        Returns
+        -------
+        list
+            The moves written. They are kept as unsaved if writing fails.
+
+        """
+        with live.lock:
+            board = live.board.copy()
+            moves = live.unsaved_moves
+            live.unsaved_moves = []
+            state = live.state
+            clocks = live.clock.millis() if live.clock is not None else None
+        try:
+            self.storage.append_moves(live.record, board, moves, state, clocks)
+        except Exception:
+            with live.lock:
+                live.unsaved_moves[:0] = moves
+            raise
+        return moves
 
     def get_game_state(self, guid):
         """Return the state of a game.
@@ -168,42 +879,37 @@ class GameKeeper:
         Returns
         -------
         Hash
-            A hash with the state of a game.
+            A hash with the state of a game. Its `version` and `etag` only
+            change when the game changes.
 
         """
-        game = self._lookup_game(guid)
-        if not game:
+        live = self.live_game(guid)
+        if not live:
             return {}
 
-        board = game.board
-        game_state = {}
-        game_state["guid"] = guid
-        game_state["white_player"] = game.white_player.name
-        game_state["black_player"] = game.black_player.name
-        game_state["started"] = game.created_at.to_datetime_string()
-        game_state["last_move"] = game.updated_at.to_datetime_string()
-        game_state["fen"] = board.fen()
-        game_state["game_over"] = board.is_game_over()
-        game_state["checkmate"] = board.is_checkmate()
-        game_state["stalemate"] = board.is_stalemate()
-        game_state["insufficient_material"] = board.is_insufficient_material()
-        game_state["seventyfive_moves"] = board.is_seventyfive_moves()
-        game_state["fivefold_repetition"] = board.is_fivefold_repetition()
-        game_state["can_claim_draw"] = board.can_claim_draw()
-        game_state["can_claim_fifty_moves"] = board.can_claim_fifty_moves()
-        game_state[
-            "can_claim_threefold_repetition"
-        ] = board.can_claim_threefold_repetition()
-        game_state["result"] = None
-        if board.is_game_over():
-            if board.result()[-1] == "1":
-                game_state["result"] = "Black won"
-            elif board.result()[0] == "1":
-                game_state["result"] = "White won"
-            else:
-                game_state["result"] = "Draw"
+        with live.lock:
+            return dict(live.game_state())
 
-        return game_state
+    def get_game_states(self, guids):
+        """Return the states of several games at once.
+
+        Parameters
+        ----------
+        guids : list
+            The unique identifiers of the games.
+
+        Returns
+        -------
+        Hash
+            guid => state hash as get_game_state returns it, unknown
+            guids are left out.
+
+        """
+        states = {}
+        for guid, live in self.live_games(guids).items():
+            with live.lock:
+                states[guid] = dict(live.game_state())
+        return states
 
     def get_board(self, guid):
         """Return a board object for a game.
@@ -216,28 +922,68 @@ class GameKeeper:
         Returns
         -------
         chess.Board
-            The current board for a chess game.
+            The current board for a chess game, with all its moves.
 
         """
-        game = self._lookup_game(guid)
-        if not game:
+        live = self.live_game(guid)
+        if not live:
             return None
-        return game.board
+        with live.lock:
+            return live.full_board()
 
-    def check_current_games(self):
-        """Check all current games for events.
+    def get_moves(self, guid, since=0):
+        """Return the moves of a game made after a version.
+
+        Parameters
+        ----------
+        guid : String
+            An unique identifier for a chess game.
+        since : Integer
+            The version the client already has, 0 for all moves.
+
+        Returns
+        -------
+        Hash
+            The guid, version, start_fen and current fen of the game, and
+            `moves`: the moves after `since` packed as in the move log.
+
+        """
+        live = self.live_game(guid)
+        if not live:
+            return None
+        with live.lock:
+            since = min(max(since, 0), live.version)
+            return {
+                "guid": guid,
+                "version": live.version,
+                "since": since,
+                "start_fen": live.start_fen,
+                "fen": live.board.fen(),
+                "moves": bytes(live.move_log[since * MOVE.size :]),
+            }
+
+    def get_legal_moves(self, guid):
+        """Return the legal moves in the current position of a game.
+
+        Parameters
+        ----------
+        guid : String
+            An unique identifier for a chess game.
 
         Returns
         -------
-        None
-            Returns nothing.
+        tuple
+            (version, LegalMoves) or None if there is no such game. Ended
+            games have no legal moves.
 
         """
-        for game in self._current_games:
-            if not game.state == "in_progress":
-                self.logger.debug(f"Checking game {game.id} | {game.state}")
-                self.logger.debug(f"  Game ended in {game.state}")
-                self._current_games.discard(game)
+        live = self.live_game(guid)
+        if not live:
+            return None
+        with live.lock:
+            if live.state != "in_progress":
+                return live.version, NO_MOVES
+            return live.version, live.legal_moves(self.legal_move_cache)
 
     def current_game_count(self):
         """Return the count of current games.
@@ -248,25 +994,168 @@ class GameKeeper:
             The amount of currently running games.
 
         """
-        self.check_current_games()
         return len(self._current_games)
 
-    def load_games(self):
-        """Load all games from database to the current games array."""
+    def counts(self):
+        """Return a snapshot of the sizes of the keeper state.
+
+        Reads the sizes without taking any lock, the numbers may be a move
+        behind but reading them never blocks the players.
+
+        Returns
+        -------
+        Hash
+            games, queued, starting, dirty and sessions counts.
+
+        """
+        return {
+            "games": len(self._current_games),
+            "queued": len(self.matchmaker),
+            "starting": self.storage.offer_count(),
+            "dirty": len(self._dirty_games),
+            "sessions": len(self.sessions),
+            "warm": len(self.warm),
+        }
+
+    def cache_stats(self):
+        """Sizes, budgets and hit rate of the game tiers, see game_cache.py.
+
+        Returns
+        -------
+        Hash
+            `hits` are lookups of hot games, `warm_hits` promotions of warm
+            games and `misses` lookups that went to the snapshot or the
+            storage. `demotions` counts the games made warm and `evictions`
+            the warm games dropped.
+
+        """
+        lookups = self.hits + self.warm.hits + self.misses
+        return {
+            "hot": len(self._current_games),
+            "hot_games": self.hot_games,
+            "warm": len(self.warm),
+            "warm_games": self.warm.size,
+            "hits": self.hits,
+            "warm_hits": self.warm.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "demotions": self.demotions,
+            "evictions": self.warm.evictions,
+        }
+
+    def demote_idle(self):
+        """Demote the least recently used games over the hot budget to warm.
+
+        Games with moves waiting to be written and the games that keep
+        running without their players are not demoted. Holds the flush
+        lock, so no game is being written meanwhile. Called periodically by
+        the TimeLord.
+
+        Returns
+        -------
+        Integer
+            The number of games demoted.
+
+        """
+        excess = len(self._current_games) - self.hot_games
+        if excess <= 0:
+            return 0
+        with self._registry_lock:
+            current = list(self._current_games.values())
+        idle = heapq.nsmallest(excess, current, key=lambda live: live.last_access)
+        demoted = 0
+        with self._flush_lock:
+            for live in idle:
+                with live.lock:
+                    if (
+                        live.demoted
+                        or live.state != "in_progress"
+                        or live.unsaved_moves
+                        or self._keeps_running(live)
+                    ):
+                        continue
+                    fields = json.dumps(self.storage.record_fields(live.record))
+                    live.demoted = True
+                    with self._registry_lock:
+                        # Warm as it stops being hot, a lookup finds it in
+                        # either
+                        self.warm.put(
+                            live.guid, fields.encode("utf8"), bytes(live.move_log)
+                        )
+                        self._current_games.pop(live.guid, None)
+                demoted += 1
+        self.demotions += demoted
+        self.logger.debug(f"Demoted {demoted} of {len(current)} games")
+        return demoted
+
+    def load_games(self, snapshot_path=None):
+        """Load all games in progress from the storage.
+
+        The most recently moved games are loaded hot, up to the hot budget,
+        the others warm up to the warm budget and the rest stay cold. With
+        the path of a snapshot written by save_snapshot the keeper is
+        restored from it instead, see _restore. The games are loaded from
+        the storage if there is no usable snapshot at that path.
+        """
+        if snapshot_path is not None and self._restore(snapshot_path):
+            return
         self.logger.debug("Loading games...")
-        for game in Game.where("state", "in_progress").get():
-            self._current_games.add(game)
+        bots = self.storage.bot_ids()
+        records = [
+            record for record in self.storage.live_games() if self._owned(record.guid)
+        ]
+        records.sort(key=lambda record: record.last_move, reverse=True)
+        idle = []
+        for record in records:
+            live = LiveGame(record)
+            # Hot over the budget too, as demote_idle keeps them: their
+            # clocks run or the bot is to move, it is attached later
+            if (
+                len(self._current_games) < self.hot_games
+                or live.clock is not None
+                or live.player_to_play_id in bots
+            ):
+                with self._registry_lock:
+                    self._current_games[live.guid] = live
+            else:
+                idle.append(record)
+        # The least recently moved first, they go cold over the warm budget
+        for record in reversed(idle):
+            fields = json.dumps(self.storage.record_fields(record))
+            self.warm.put(record.guid, fields.encode("utf8"), bytes(record.move_log))
+        self.logger.info(f"Loaded {len(records)} games, {len(self._current_games)} hot")
 
-    def add_player(self, player):
+    def add_player(self, player, time_control=None):
         """Add player to the waiting queue.
 
         Parameters
         ----------
-        player : Player
+        player : PlayerRecord
             The player to add to the waiting queue.
+        time_control : String
+            Optional, only players with the same time control are paired.
+
+        Returns
+        -------
+        LiveGame
+            The new game if an opponent was waiting, else None.
 
         """
-        self._current_player_queue.add(player.id)
+        with self._queue_lock:
+            if self.storage.has_offer(player.id):
+                # Already matched, the game is being set up
+                return None
+            opponent = self.matchmaker.enqueue(
+                player, getattr(player, "rating", None), time_control
+            )
+            if opponent is None:
+                return None
+            self.storage.offer_game(opponent.id, None)
+        game = self._start_game(player, opponent, time_control)
+        with self._queue_lock:
+            # The opponent gets the game the next time they poll queue_up
+            self.storage.offer_game(opponent.id, game.guid)
+        return game
 
     def remove_player(self, player):
         """Remove a player from the waiting queue.
@@ -277,4 +1166,117 @@ class GameKeeper:
             The player to remove from the waiting queue.
 
         """
-        self._current_player_queue.discard(player.id)
+        self.matchmaker.remove(player.id)
+
+    def save_snapshot(self, path):
+        """Write the state of the keeper to a snapshot at [path].
+
+        Holds the flush lock while it goes over the games, so none is being
+        written meanwhile. Games with moves waiting to be written are left
+        out, on restore they are loaded from the storage.
+
+        Returns
+        -------
+        Integer
+            The size of the snapshot in bytes.
+
+        """
+        started = time.perf_counter()
+        # (guid, fields, move log) of the games in memory
+        current_games = []
+        # Loaded right away on restore: their clocks run and the bot may be
+        # to move
+        eager = []
+        with self._flush_lock:
+            watermark = self.storage.watermark()
+            with self._registry_lock:
+                current = list(self._current_games.values())
+                off_snapshot = set(self._off_snapshot)
+            for live in current:
+                with live.lock:
+                    if live.state != "in_progress":
+                        continue
+                    if live.unsaved_moves:
+                        eager.append(live.guid)
+                        continue
+                    fields = self.storage.record_fields(live.record)
+                    move_log = bytes(live.move_log)
+                    if self._keeps_running(live):
+                        eager.append(live.guid)
+                current_games.append((live.guid, fields, move_log))
+            warm = self.warm.items()
+        games = dict(warm)
+        games.update(
+            (guid, (json.dumps(fields).encode("utf8"), move_log))
+            for guid, fields, move_log in current_games
+        )
+        if self.snapshot is not None:
+            # The games of the snapshot restored from that were not asked for
+            for guid in self.snapshot:
+                if guid not in games and guid not in off_snapshot:
+                    games[guid] = self.snapshot.entry(guid)
+        state = {
+            "watermark": watermark,
+            "eager": eager,
+            "queue": [
+                [list(player), rating, time_control, waited]
+                for player, rating, time_control, waited in self.matchmaker.snapshot()
+            ],
+            "offers": list(self.storage.ready_offers().items()),
+            "sessions": [
+                [list(record), left] for record, left in self.sessions.snapshot()
+            ],
+        }
+        size = write_snapshot(path, state, games)
+        self.logger.info(
+            f"Snapshot of {len(games)} games, {size} bytes written in "
+            f"{time.perf_counter() - started:.3f}s"
+        )
+        return size
+
+    def _restore(self, path):
+        """Restore the keeper from the snapshot at [path].
+
+        Only the games written since the snapshot was taken and the games
+        it marks eager are loaded, each from the storage or the snapshot.
+        The other games of the snapshot are loaded from it when asked for.
+
+        Returns
+        -------
+        Boolean
+            False if there is no usable snapshot at [path].
+
+        """
+        started = time.perf_counter()
+        try:
+            snapshot = Snapshot(path)
+        except FileNotFoundError:
+            self.logger.info(f"No snapshot at {path}")
+            return False
+        except InvalidSnapshot as e:
+            self.logger.warning(f"Not restoring from the snapshot: {e}")
+            return False
+        state = snapshot.state
+        # The storage is ahead of the snapshot for these
+        written = self.storage.games_written_since(state["watermark"])
+        with self._registry_lock:
+            self._off_snapshot.update(record.guid for record in written)
+        self.snapshot = snapshot
+        for record in written:
+            if record.state == "in_progress" and self._owned(record.guid):
+                self._register(record)
+        for guid in state["eager"]:
+            self.live_game(guid)
+        self.matchmaker.restore(
+            (PlayerRecord(*player), rating, time_control, waited)
+            for player, rating, time_control, waited in state["queue"]
+        )
+        self.storage.restore_offers(dict(state["offers"]))
+        self.sessions.restore(
+            (PlayerRecord(*record), left) for record, left in state["sessions"]
+        )
+        self.logger.info(
+            f"Restored from {path} in {time.perf_counter() - started:.3f}s: "
+            f"{len(snapshot)} games in the snapshot, {len(written)} written since"
+        )
+        return True
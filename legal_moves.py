@@ -0,0 +1,100 @@
+"""The legal moves of positions, shared by all games.
+
+Openings and other common positions come up in many games, the legal
+moves of each are generated once and kept in a bounded LRU keyed by the
+position.
+
+The key is the transposition key python-chess detects repetitions with:
+the pieces, side to move, castling rights and en passant square. It
+identifies the same positions as a Zobrist hash but takes well under a
+microsecond; chess.polyglot.zobrist_hash takes about 20us, a third of
+generating the moves it would save, and can collide.
+"""
+
+import collections
+import threading
+
+from models.move_log import MOVE, move_value
+
+# Positions kept, an entry is about 0.5 KiB in the opening
+LEGAL_MOVE_CACHE_SIZE = 50000
+
+
+class LegalMoves:
+    """The legal moves of one position."""
+
+    __slots__ = ("moves", "packed")
+
+    def __init__(self, moves):
+        values = [move_value(move) for move in moves]
+        # The packed values rather than chess.Move objects: thousands of
+        # cached positions of Moves make every full collection of the
+        # garbage collector walk millions of objects.
+        self.moves = frozenset(values)
+        # As in the move log, two bytes a move
+        self.packed = b"".join(MOVE.pack(value) for value in values)
+
+    def __contains__(self, move):
+        return move_value(move) in self.moves
+
+    def __len__(self):
+        return len(self.moves)
+
+
+# What an ended game has
+NO_MOVES = LegalMoves([])
+
+
+class LegalMoveCache:
+    """A bounded LRU of LegalMoves, keyed by position."""
+
+    def __init__(self, size=LEGAL_MOVE_CACHE_SIZE):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, board):
+        """Return the LegalMoves of the position on a board.
+
+        Parameters
+        ----------
+        board : chess.Board
+            The position, its move stack does not matter.
+
+        Returns
+        -------
+        LegalMoves
+            The legal moves, from the cache if the position was seen before.
+
+        """
+        key = board._transposition_key()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        # Generated outside the lock, two threads may both make the entry
+        entry = LegalMoves(list(board.legal_moves))
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Size and hit rate of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "positions": len(self._entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -0,0 +1,200 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Rating used for players without one
+DEFAULT_RATING = 1500
+# Rating difference accepted right away
+BASE_WINDOW = 100
+# The window grows this many rating points per second a player waits..
+WIDEN_PER_SECOND = 25
+# ..up to this, after that anyone in the same time control bucket will do
+MAX_WINDOW = 1000
+
+
+class QueuedPlayer:
+    """A player waiting for a game."""
+
+    __slots__ = ("player", "rating", "time_control", "since")
+
+    def __init__(self, player, rating, time_control, since):
+        self.player = player
+        self.rating = rating
+        self.time_control = time_control
+        self.since = since
+
+
+class Matchmaker:
+    """Pairs queued players as soon as a fitting opponent is there.
+
+    Players wait in a bucket per time control, in order of arrival. A new
+    player is matched with the longest waiting player in the bucket whose
+    rating is close enough. The accepted rating difference widens the
+    longer a player waits, `sweep` pairs players whose windows grew
+    enough to meet.
+    """
+
+    def __init__(
+        self,
+        base_window=BASE_WINDOW,
+        widen_per_second=WIDEN_PER_SECOND,
+        max_window=MAX_WINDOW,
+        clock=time.monotonic,
+    ):
+        self.base_window = base_window
+        self.widen_per_second = widen_per_second
+        self.max_window = max_window
+        self.clock = clock
+        # time control => OrderedDict player id => QueuedPlayer
+        self._buckets = {}
+        # player id => time control, to find the bucket of a player
+        self._queued = {}
+        self._lock = threading.Lock()
+
+    def window(self, entry, now):
+        """The rating difference a queued player accepts at [now]."""
+        waited = now - entry.since
+        return min(self.max_window, self.base_window + self.widen_per_second * waited)
+
+    def _fits(self, first, second, now):
+        if first.player.id == second.player.id:
+            return False
+        difference = abs(first.rating - second.rating)
+        # The longer waiting player decides, so waiting long gets you a game
+        return difference <= max(self.window(first, now), self.window(second, now))
+
+    def enqueue(self, player, rating=None, time_control=None):
+        """Queue a player, or pair them right away.
+
+        Parameters
+        ----------
+        player : PlayerRecord
+            The player looking for a game.
+        rating : Integer
+            Optional rating, DEFAULT_RATING if not given.
+        time_control : String
+            Optional time control, only players with the same one meet.
+
+        Returns
+        -------
+        PlayerRecord
+            The opponent, or None when the player has to wait.
+
+        """
+        now = self.clock()
+        entry = QueuedPlayer(
+            player, DEFAULT_RATING if rating is None else rating, time_control, now
+        )
+        with self._lock:
+            if player.id in self._queued:
+                return None
+            bucket = self._buckets.setdefault(time_control, OrderedDict())
+            for other in bucket.values():
+                if self._fits(other, entry, now):
+                    self._remove(other.player.id)
+                    return other.player
+            bucket[player.id] = entry
+            self._queued[player.id] = time_control
+        return None
+
+    def remove(self, player_id):
+        """Take a player out of the queue, True if they were in it."""
+        with self._lock:
+            return self._remove(player_id)
+
+    def _remove(self, player_id):
+        if player_id not in self._queued:
+            return False
+        time_control = self._queued.pop(player_id)
+        bucket = self._buckets[time_control]
+        del bucket[player_id]
+        if not bucket:
+            del self._buckets[time_control]
+        return True
+
+    def sweep(self):
+        """Pair the players whose rating windows grew enough to meet.
+
+        Returns
+        -------
+        list
+            (player, opponent, time_control) of the pairs, both players
+            removed from the queue.
+
+        """
+        now = self.clock()
+        pairs = []
+        with self._lock:
+            for bucket in list(self._buckets.values()):
+                waiting = list(bucket.values())
+                matched = set()
+                for index, first in enumerate(waiting):
+                    if first.player.id in matched:
+                        continue
+                    for second in waiting[index + 1 :]:
+                        if second.player.id in matched:
+                            continue
+                        if self._fits(first, second, now):
+                            matched.add(first.player.id)
+                            matched.add(second.player.id)
+                            pairs.append(
+                                (first.player, second.player, first.time_control)
+                            )
+                            break
+                for player_id in matched:
+                    self._remove(player_id)
+        return pairs
+
+    def take_waiting(self, seconds):
+        """Take the players that waited longer than [seconds] out of the queue.
+
+        Returns
+        -------
+        list
+            The QueuedPlayer entries of the players taken out.
+
+        """
+        now = self.clock()
+        with self._lock:
+            waiting = [
+                entry
+                for bucket in self._buckets.values()
+                for entry in bucket.values()
+                if now - entry.since > seconds
+            ]
+            for entry in waiting:
+                self._remove(entry.player.id)
+        return waiting
+
+    def snapshot(self):
+        """Return (player, rating, time_control, seconds waited) of the
+        queued players, longest waiting first per time control."""
+        now = self.clock()
+        with self._lock:
+            return [
+                (entry.player, entry.rating, entry.time_control, now - entry.since)
+                for bucket in self._buckets.values()
+                for entry in bucket.values()
+            ]
+
+    def restore(self, entries):
+        """Queue the players of a snapshot again, as long as they waited.
+
+        Players already in the queue keep their place.
+        """
+        now = self.clock()
+        with self._lock:
+            for player, rating, time_control, waited in entries:
+                if player.id in self._queued:
+                    continue
+                bucket = self._buckets.setdefault(time_control, OrderedDict())
+                bucket[player.id] = QueuedPlayer(
+                    player, rating, time_control, now - waited
+                )
+                self._queued[player.id] = time_control
+
+    def __contains__(self, player_id):
+        return player_id in self._queued
+
+    def __len__(self):
+        return len(self._queued)
@@ -0,0 +1,283 @@
+"""Counters and latency histograms of the server, for the stats command.
+
+Everything is recorded under the command the current thread is running,
+see Metrics.command. Recording a value takes one lock and a bisect, cheap
+enough to stay on in production. The sampling profiler is off until
+started, with `--profile` or the stats command.
+"""
+
+import bisect
+import collections
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets in seconds, 50us doubling up to 13s
+BUCKETS = tuple(0.00005 * 2**i for i in range(19))
+# What is recorded outside of a command: flushes, match sweeps, flag falls
+BACKGROUND = "-"
+# Seconds between two samples of the profiler
+PROFILE_INTERVAL = 0.005
+# Frames kept of every sampled stack, from the command down
+PROFILE_DEPTH = 40
+
+
+class Histogram:
+    """Counts values per bucket of BUCKETS.
+
+    Not thread safe on its own, Metrics holds its lock while adding.
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """The upper bound of the bucket the pct percentile falls in."""
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return (
+                    min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+                )
+        return self.max
+
+    def summary(self):
+        """count, mean and percentiles, in milliseconds."""
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3),
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p90_ms": round(self.percentile(90) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class CommandStats:
+    """What is recorded for one command."""
+
+    __slots__ = ("latency", "errors", "db", "serialize")
+
+    def __init__(self):
+        self.latency = Histogram()
+        # Commands that raised or answered with an error
+        self.errors = 0
+        # Time of every query run for the command
+        self.db = Histogram()
+        # Time spent pickling and encoding responses
+        self.serialize = Histogram()
+
+    def summary(self):
+        return {
+            "requests": self.latency.count,
+            "errors": self.errors,
+            "latency": self.latency.summary(),
+            "db_queries": self.db.count,
+            "db_ms": round(self.db.total * 1000, 3),
+            "db_queries_per_request": round(
+                self.db.count / max(1, self.latency.count), 2
+            ),
+            "serialize": self.serialize.summary(),
+        }
+
+
+class SamplingProfiler:
+    """Samples the stacks of the threads running a command.
+
+    A thread looks every [interval] seconds at where the threads that
+    entered a command are, and counts the stacks it finds. The counts are
+    collapsed stacks, `command;file:function:line;..`, ready for a flame
+    graph.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        # thread id => command, of the threads running a command
+        self._threads = {}
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=None):
+        """Start sampling, the counts of an earlier run are dropped."""
+        if self._thread is not None:
+            return
+        if interval is not None:
+            self.interval = interval
+        self._stacks = collections.Counter()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="Profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling, the counts are kept for top()."""
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        self._threads.clear()
+
+    def enter(self, command):
+        self._threads[threading.get_ident()] = command
+
+    def leave(self):
+        self._threads.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, command in list(self._threads.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._stacks[(command,) + self._stack(frame)] += 1
+            self.samples += 1
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None and len(stack) < PROFILE_DEPTH:
+            code = frame.f_code
+            stack.append(
+                f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+            )
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def top(self, count=20):
+        """The [count] stacks sampled most, as (collapsed stack, samples)."""
+        return [
+            (";".join(stack), samples)
+            for stack, samples in self._stacks.most_common(count)
+        ]
+
+
+class Metrics:
+    """The counters and histograms of a server process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # command => CommandStats
+        self._commands = {}
+        self._local = threading.local()
+        self.started = time.time()
+        self.profiler = SamplingProfiler()
+
+    def _stats(self, command):
+        # The caller holds the lock
+        stats = self._commands.get(command)
+        if stats is None:
+            stats = self._commands[command] = CommandStats()
+        return stats
+
+    def current(self):
+        """The command the current thread runs, BACKGROUND if none."""
+        return getattr(self._local, "command", BACKGROUND)
+
+    @contextmanager
+    def command(self, name):
+        """Record the latency of a command run in the block.
+
+        Queries and serializing done in the block are recorded for it. Set
+        `failed` on the yielded object to count the command as an error.
+        """
+        outcome = _Outcome()
+        self._local.command = name
+        profiler = self.profiler
+        if profiler.running:
+            profiler.enter(name)
+        started = time.perf_counter()
+        try:
+            yield outcome
+        except Exception:
+            outcome.failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler.running:
+                profiler.leave()
+            self._local.command = BACKGROUND
+            with self._lock:
+                stats = self._stats(name)
+                stats.latency.add(elapsed)
+                if outcome.failed:
+                    stats.errors += 1
+
+    def db_query(self, seconds):
+        """Record a query of the current command."""
+        command = self.current()
+        with self._lock:
+            self._stats(command).db.add(seconds)
+
+    @contextmanager
+    def serialize(self):
+        """Record the time of pickling or encoding a response in the block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            command = self.current()
+            with self._lock:
+                self._stats(command).serialize.add(elapsed)
+
+    def snapshot(self, profile=20):
+        """Everything recorded, as a Hash that can be sent as json.
+
+        Parameters
+        ----------
+        profile : Integer
+            The number of profiled stacks to send along.
+
+        """
+        with self._lock:
+            commands = {
+                name: stats.summary() for name, stats in sorted(self._commands.items())
+            }
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "commands": commands,
+            "profiler": {
+                "running": self.profiler.running,
+                "samples": self.profiler.samples,
+                "stacks": self.profiler.top(profile),
+            },
+        }
+
+    def reset(self):
+        """Drop everything recorded."""
+        with self._lock:
+            self._commands = {}
+            self.started = time.time()
+
+
+class _Outcome:
+    __slots__ = ("failed",)
+
+    def __init__(self):
+        self.failed = False
+
+
+METRICS = Metrics()
@@ -0,0 +1,75 @@
+from orator.migrations import Migration
+import chess
+import pickle
+import struct
+
+# Same packing as models/move_log.py, copied so the migration stays as is
+# when the model code changes.
+MOVE = struct.Struct('>H')
+
+
+def pack_move(move):
+    return MOVE.pack(
+        move.from_square | move.to_square << 6 | (move.promotion or 0) << 12)
+
+
+def unpack_move(value):
+    return chess.Move(value & 0x3F, value >> 6 & 0x3F, (value >> 12) or None)
+
+
+class AddMoveLogToGames(Migration):
+
+    def up(self):
+        """
+        Run the migrations.
+        """
+        with self.schema.table('games') as table:
+            table.binary('move_log').nullable()
+            table.string('checkpoint_fen').nullable()
+            table.integer('checkpoint_ply').default(0)
+
+        with self.db.transaction():
+            games = self.db.table('games').where_not_null('board_seril').get()
+            for game in games:
+                # Boards pickled by older python-chess versions can't be
+                # used as a Board anymore, only their move stack is read.
+                pickled = pickle.loads(game['board_seril'])
+                moves = [chess.Move(move.from_square, move.to_square,
+                                    move.promotion)
+                         for move in pickled.move_stack]
+                replay = chess.Board(game['board_state'])
+                checkpoint_fen = None
+                checkpoint_ply = 0
+                for ply, move in enumerate(moves, 1):
+                    irreversible = replay.is_irreversible(move)
+                    replay.push(move)
+                    if irreversible:
+                        checkpoint_fen = replay.fen()
+                        checkpoint_ply = ply
+                self.db.table('games').where('id', game['id']).update({
+                    'move_log': b''.join(pack_move(move) for move in moves),
+                    'checkpoint_fen': checkpoint_fen,
+                    'checkpoint_ply': checkpoint_ply,
+                })
+
+        with self.schema.table('games') as table:
+            table.drop_column('board_seril')
+
+    def down(self):
+        """
+        Revert the migrations.
+        """
+        with self.schema.table('games') as table:
+            table.binary('board_seril').nullable()
+
+        with self.db.transaction():
+            for game in self.db.table('games').get():
+                board = chess.Board(game['board_state'])
+                for (value,) in MOVE.iter_unpack(game['move_log'] or b''):
+                    board.push(unpack_move(value))
+                self.db.table('games').where('id', game['id']).update({
+                    'board_seril': pickle.dumps(board),
+                })
+
+        with self.schema.table('games') as table:
+            table.drop_column('move_log', 'checkpoint_fen', 'checkpoint_ply')
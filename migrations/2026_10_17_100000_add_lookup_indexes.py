@@ -0,0 +1,32 @@
+from orator.migrations import Migration
+
+
+class AddLookupIndexes(Migration):
+
+    def up(self):
+        """
+        Run the migrations.
+        """
+        with self.schema.table('players') as table:
+            table.unique('guid', 'players_guid_unique')
+            table.unique('name', 'players_name_unique')
+
+        with self.schema.table('games') as table:
+            table.unique('guid', 'games_guid_unique')
+            table.index(['white_player_id', 'state'],
+                        'games_white_player_id_state_index')
+            table.index(['black_player_id', 'state'],
+                        'games_black_player_id_state_index')
+
+    def down(self):
+        """
+        Revert the migrations.
+        """
+        with self.schema.table('games') as table:
+            table.drop_index('games_black_player_id_state_index')
+            table.drop_index('games_white_player_id_state_index')
+            table.drop_unique('games_guid_unique')
+
+        with self.schema.table('players') as table:
+            table.drop_unique('players_name_unique')
+            table.drop_unique('players_guid_unique')
@@ -0,0 +1,22 @@
+from orator.migrations import Migration
+
+
+class AddClocksToGames(Migration):
+
+    def up(self):
+        """
+        Run the migrations.
+        """
+        with self.schema.table('games') as table:
+            # "{minutes}+{increment seconds}", untimed games have none
+            table.string('time_control').nullable()
+            # Milliseconds left, as of the last move written
+            table.integer('white_clock').nullable()
+            table.integer('black_clock').nullable()
+
+    def down(self):
+        """
+        Revert the migrations.
+        """
+        with self.schema.table('games') as table:
+            table.drop_column('time_control', 'white_clock', 'black_clock')
@@ -0,0 +1,49 @@
+from orator.migrations import Migration
+import chess
+import struct
+
+# Same packing as models/move_log.py, copied so the migration stays as is
+# when the model code changes.
+MOVE = struct.Struct('>H')
+
+
+def unpack_move(value):
+    return chess.Move(value & 0x3F, value >> 6 & 0x3F, (value >> 12) or None)
+
+
+WINNERS = {chess.WHITE: 'white_won', chess.BLACK: 'black_won', None: 'draw'}
+
+
+class FinishEndedGames(Migration):
+
+    def up(self):
+        """
+        Run the migrations.
+        """
+        # Games used to stay in_progress after mate or a draw on the board,
+        # write their result so they are not loaded as live games anymore.
+        with self.db.transaction():
+            games = self.db.table('games').where('state', 'in_progress').get()
+            for game in games:
+                if game['checkpoint_fen'] is not None:
+                    board = chess.Board(game['checkpoint_fen'])
+                    start = game['checkpoint_ply'] * MOVE.size
+                else:
+                    board = chess.Board(game['board_state'])
+                    start = 0
+                log = (game['move_log'] or b'')[start:]
+                for (value,) in MOVE.iter_unpack(log):
+                    board.push(unpack_move(value))
+                outcome = board.outcome()
+                if outcome is None:
+                    continue
+                self.db.table('games').where('id', game['id']).update({
+                    'state': WINNERS[outcome.winner],
+                })
+
+    def down(self):
+        """
+        Revert the migrations.
+        """
+        # The results are right, there is nothing to undo
+        pass
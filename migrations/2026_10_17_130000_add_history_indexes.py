@@ -0,0 +1,34 @@
+from orator.migrations import Migration
+
+
+class AddHistoryIndexes(Migration):
+
+    def up(self):
+        """
+        Run the migrations.
+        """
+        # The game history reads a player's games in updated_at order from
+        # these alone, they cover every column it filters on. They replace
+        # the (player, state) indexes, every move updates updated_at and so
+        # every index on it.
+        with self.schema.table('games') as table:
+            table.drop_index('games_white_player_id_state_index')
+            table.drop_index('games_black_player_id_state_index')
+            table.index(['white_player_id', 'updated_at', 'id', 'state',
+                         'guid'],
+                        'games_white_player_id_updated_at_index')
+            table.index(['black_player_id', 'updated_at', 'id', 'state',
+                         'guid', 'white_player_id'],
+                        'games_black_player_id_updated_at_index')
+
+    def down(self):
+        """
+        Revert the migrations.
+        """
+        with self.schema.table('games') as table:
+            table.drop_index('games_black_player_id_updated_at_index')
+            table.drop_index('games_white_player_id_updated_at_index')
+            table.index(['white_player_id', 'state'],
+                        'games_white_player_id_state_index')
+            table.index(['black_player_id', 'state'],
+                        'games_black_player_id_state_index')
@@ -0,0 +1,20 @@
+from orator.migrations import Migration
+
+
+class AddUpdatedAtIndex(Migration):
+
+    def up(self):
+        """
+        Run the migrations.
+        """
+        # A restart from a snapshot reads the games written since it was
+        # taken, without this it would scan every game ever played.
+        with self.schema.table('games') as table:
+            table.index('updated_at', 'games_updated_at_index')
+
+    def down(self):
+        """
+        Revert the migrations.
+        """
+        with self.schema.table('games') as table:
+            table.drop_index('games_updated_at_index')
@@ -0,0 +1,20 @@
+from orator.migrations import Migration
+
+
+class AddBotToPlayers(Migration):
+
+    def up(self):
+        """
+        Run the migrations.
+        """
+        # The players of the computer opponent, see bot.py. A player who
+        # registered a bot name before it was reserved stays a player.
+        with self.schema.table('players') as table:
+            table.boolean('bot').default(False)
+
+    def down(self):
+        """
+        Revert the migrations.
+        """
+        with self.schema.table('players') as table:
+            table.drop_column('bot')
@@ -1,13 +1,142 @@
+import os
+import sqlite3
+import threading
+import weakref
+
 from orator import DatabaseManager
 from orator import Model
+from orator.connections import SQLiteConnection
+from orator.connectors.sqlite_connector import SQLiteConnector
+
+from metrics import METRICS
+
+# Queries are only logged outside of production, logging formats every
+# query with its bindings.
+PRODUCTION = os.environ.get('CHESS_SERVER_ENV', 'development') == 'production'
 
 DB_CONFIG = {
     'sqlite3': {
         'driver': 'sqlite',
-        'database': 'chess_server.db',
-        'log_queries': True
+        # Benchmarks point this at a throwaway copy of the database
+        'database': os.environ.get('CHESS_SERVER_DB', 'chess_server.db'),
+        'log_queries': not PRODUCTION,
+        # Pooled connections move between threads
+        'check_same_thread': False,
+        # Seconds to wait for the write lock before "database is locked"
+        'timeout': float(os.environ.get('CHESS_SERVER_DB_TIMEOUT', 5)),
+        'pragmas': {
+            # Readers don't block the writer and the other way around
+            'journal_mode': os.environ.get('CHESS_SERVER_DB_JOURNAL', 'wal'),
+            # Every commit is synced to disk before a move is confirmed.
+            # The servers commit the moves of all games together, see
+            # write_coordinator.py.
+            'synchronous': os.environ.get('CHESS_SERVER_DB_SYNCHRONOUS',
+                                          'full'),
+            # Pages cached per connection, negative is in KiB
+            'cache_size': -8000,
+            'temp_store': 'memory',
+        },
+        # Idle connections kept for the next thread, 0 closes them
+        'pool_size': int(os.environ.get('CHESS_SERVER_DB_POOL', 16)),
     }
 }
 
-DATABASE = DatabaseManager(DB_CONFIG)
+
+class SQLitePool:
+    """Keeps the SQLite connections of finished threads for reuse.
+
+    Orator gives every thread its own connection. The threaded server runs
+    every request in a new thread, so without the pool each request would
+    open the database and set it up again.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Return an idle connection, or None if there is none."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return None
+
+    def give_back(self, connection):
+        """Keep a connection for the next thread, or close it."""
+        try:
+            if connection.in_transaction:
+                # Left behind by a thread that died in a transaction
+                connection.rollback()
+            connection.isolation_level = None
+        except sqlite3.ProgrammingError:
+            # Closed by DATABASE.disconnect
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def __len__(self):
+        return len(self._idle)
+
+
+class PooledSQLiteConnector(SQLiteConnector):
+    """Connects through a SQLitePool and applies the configured pragmas."""
+
+    RESERVED_KEYWORDS = SQLiteConnector.RESERVED_KEYWORDS + [
+        'pragmas', 'pool_size']
+
+    def __init__(self, pool, driver=None):
+        super().__init__(driver)
+        self.pool = pool
+
+    def _do_connect(self, config):
+        connection = self.pool.take()
+        if connection is None:
+            connection = super()._do_connect(config)
+            for pragma, value in config.get('pragmas', {}).items():
+                connection.execute(f'PRAGMA {pragma} = {value}')
+        # The sqlite3 connection, to hand back to the pool
+        self.api_connection = connection
+        return connection
+
+
+class MeteredSQLiteConnection(SQLiteConnection):
+    """Records the time of every query for the stats command."""
+
+    def log_query(self, query, bindings, time_=None):
+        if time_ is not None:
+            # Orator times queries in milliseconds
+            METRICS.db_query(time_ / 1000)
+        super().log_query(query, bindings, time_)
+
+
+class PooledDatabaseManager(DatabaseManager):
+    """A DatabaseManager whose SQLite connections outlive their thread.
+
+    The manager is thread local, a connection is handed back to the pool
+    when the thread that used it is gone.
+    """
+
+    def __init__(self, config, pool):
+        super().__init__(config)
+        self.pool = pool
+
+    def _make_connection(self, name):
+        config = self._get_config(name)
+        if config['driver'] != 'sqlite':
+            return super()._make_connection(name)
+        config.setdefault('name', name)
+        connector = PooledSQLiteConnector(self.pool).connect(config)
+        connection = MeteredSQLiteConnection(
+            connector, config['database'], config.get('prefix', ''), config)
+        weakref.finalize(connection, self.pool.give_back,
+                         connector.api_connection)
+        return connection
+
+
+POOL = SQLitePool(DB_CONFIG['sqlite3']['pool_size'])
+DATABASE = PooledDatabaseManager(DB_CONFIG, POOL)
 Model.set_connection_resolver(DATABASE)
@@ -2,7 +2,8 @@ from orator import Model
 from orator.orm import belongs_to
 from orator.orm import accessor
 import chess
-import pickle
+
+from .move_log import MOVE, pack_moves, replay
 
 
 class Game(Model):
@@ -11,25 +12,74 @@ class Game(Model):
     def __init__(self, _attributes=None, **attributes):
         super().__init__(_attributes=None, **attributes)
 
+    @property
+    def move_count(self):
+        return len(self.get_raw_attribute('move_log') or b'') // MOVE.size
+
     def load_board(self):
-        if self.board_seril is not None:
-            board = pickle.loads(self.get_raw_attribute("board_seril"))
-        else:
-            board = chess.Board(self.board_state)
-        return board
+        return replay(self.board_state, self.get_raw_attribute('move_log'),
+                      self.checkpoint_fen, self.checkpoint_ply)
 
-    def save_board(self, board):
-        self.board_seril = pickle.dumps(board)
-        self.save()
+    def append_moves(self, board, moves, state=None, clocks=None):
+        """Append moves to the move log of the game.
+
+        Only the new moves are written, the log is extended in place.
+
+        Args:
+            board (chess.Board): The board after the moves were made.
+            moves (list): The chess.Move objects made since the last save.
+            state (str): Optional, the state of the game to write along.
+            clocks (tuple): Optional, milliseconds (white, black) have left.
+        """
+        if not moves and state is None and clocks is None:
+            return
+        ply = self.move_count
+        checkpoint_fen = self.checkpoint_fen
+        checkpoint_ply = self.checkpoint_ply or 0
+        board = board.copy()
+        for index in range(len(moves) - 1, -1, -1):
+            fen = board.fen()
+            if board.is_irreversible(board.pop()):
+                checkpoint_fen = fen
+                checkpoint_ply = ply + index + 1
+                break
+        if state is None:
+            state = self.state
+        if clocks is None:
+            clocks = (self.white_clock, self.black_clock)
+        blob = pack_moves(moves)
+        now = self.fresh_timestamp()
+        self.get_connection().update(
+            # || yields text in SQLite, cast it back to keep a blob
+            "UPDATE games SET "
+            "move_log = CAST(COALESCE(move_log, X'') || ? AS BLOB), "
+            'checkpoint_fen = ?, checkpoint_ply = ?, state = ?, '
+            'white_clock = ?, black_clock = ?, updated_at = ? '
+            'WHERE id = ?',
+            [blob, checkpoint_fen, checkpoint_ply, state, clocks[0],
+             clocks[1], self.from_datetime(now), self.id])
+        self.move_log = (self.get_raw_attribute('move_log') or b'') + blob
+        self.checkpoint_fen = checkpoint_fen
+        self.checkpoint_ply = checkpoint_ply
+        self.state = state
+        self.white_clock, self.black_clock = clocks
+        self.updated_at = now
+        self.sync_original()
 
-    def setup_new(self):
-        # Initialize a new game.
+    def setup_new(self, time_control=None, clock=None):
+        # Initialize a new game. Timed games get a time control and the
+        # milliseconds both players start with.
         from uuid import uuid4
 
         self.guid = str(uuid4())
         board_start = chess.STARTING_FEN
         self.board_state = board_start
-        self.board_seril = pickle.dumps(chess.Board(board_start))
+        self.move_log = b''
+        self.checkpoint_fen = None
+        self.checkpoint_ply = 0
+        self.time_control = time_control
+        self.white_clock = clock
+        self.black_clock = clock
         self.state = 'in_progress'
         self.save()
 
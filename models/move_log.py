@@ -0,0 +1,51 @@
+import struct
+
+import chess
+
+# One move is packed in 16 bits: from square, to square and promotion piece.
+MOVE = struct.Struct('>H')
+
+
+def move_value(move):
+    """The 16 bit value a chess.Move is packed as."""
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def pack_move(move):
+    """Pack a chess.Move into two bytes."""
+    return MOVE.pack(move_value(move))
+
+
+def unpack_move(value):
+    """Turn a packed 16 bit value back into a chess.Move."""
+    return chess.Move(value & 0x3F, value >> 6 & 0x3F, (value >> 12) or None)
+
+
+def pack_moves(moves):
+    return b''.join(pack_move(move) for move in moves)
+
+
+def unpack_moves(blob, start=0):
+    """Unpack the moves of a move log, skipping the first `start` moves."""
+    if not blob:
+        return []
+    return [unpack_move(value)
+            for (value,) in MOVE.iter_unpack(blob[start * MOVE.size:])]
+
+
+def replay(start_fen, blob, checkpoint_fen=None, checkpoint_ply=0):
+    """Rebuild the board of a game from its move log.
+
+    Replays the moves made after the last checkpoint. Checkpoints are only
+    taken after irreversible moves, so no earlier position can repeat and
+    the repetition rules still work on the replayed board.
+    """
+    if checkpoint_fen is not None:
+        board = chess.Board(checkpoint_fen)
+        moves = unpack_moves(blob, checkpoint_ply)
+    else:
+        board = chess.Board(start_fen)
+        moves = unpack_moves(blob)
+    for move in moves:
+        board.push(move)
+    return board
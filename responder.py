@@ -1,181 +1,373 @@
 # from threading import Thread, currentThread
 # from socket import SHUT_RDWR
+import hmac
+import json
 import logging
+import os
 import pickle
+import queue
 import socketserver
+import threading
+from concurrent import futures
 
-from models.game import Game
-from models.player import Player
-from game_keeper import GameNotFound, IllegalMove, NotPlayersTurn
+from framing import (
+    FRAME_MAGIC,
+    MAX_PUSHES,
+    PUSH_REQUEST_ID,
+    FrameError,
+    FrameReader,
+    PushOverflow,
+    pack_frame,
+)
+
+import wire
+from bot import BOT_NAMES
+from clock import InvalidTimeControl
+from game_keeper import GameFinished, GameNotFound, IllegalMove, NotPlayersTurn
+from metrics import METRICS
+from storage import HISTORY_FIELDS, InvalidCursor
+from write_coordinator import WriteTimeout
+
+# Most games a history command returns per page
+MAX_HISTORY_PAGE = 1000
+# Responses counted as errors in the stats
+ERROR_RESPONSES = (b"exception|", b"invalid", b"NOT LOGGED IN!")
+# The stats command answers to this token only, it is off if unset
+ADMIN_TOKEN = os.environ.get("CHESS_SERVER_ADMIN_TOKEN", "")
 
 
 class NotLoggedIn(Exception):
     """Raised when a used is not logged in for certain functions."""
 
 
-class Responder(socketserver.BaseRequestHandler):
-    """The responder to client requests."""
+class CommandHandler:
+    """Runs client commands against a GameKeeper.
 
-    def __init__(self, request, client_address, server):
+    This holds the `_handle_*` command set without any socket handling, so
+    the same commands can be served by the threaded and the asyncio server.
+    """
+
+    def __init__(self, game_keeper):
         self.logger = logging.getLogger("Responder")
-        # self.logger.debug('__init__')
-        socketserver.BaseRequestHandler.__init__(self, request, client_address, server)
-        self.game_keeper = server.game_keeper
+        self.game_keeper = game_keeper
         self.last_log_line = ""
+        # Set by connections that can take pushed frames, called with bytes
+        self.push = None
+        self.subscriptions = set()
 
     def _get_player(self, text):
         guid = text.split("|")[-1]
         # self.logger.debug(f"Checking player guid {guid}")
-        p = Player.where("guid", guid).first()
-        if p is None:
+        record = self.game_keeper.sessions.get(guid)
+        if record is not None:
+            return record
+        record = self.game_keeper.storage.player_by_guid(guid)
+        if record is None:
             raise NotLoggedIn("Not logged in!")
-        return p
+        return self.game_keeper.sessions.put(record)
 
-    def handle(self):
-        """Handle incomming commands.
+    def _options(self, text):
+        """Parse the optional `key=value` fields before the player guid of a
+        command."""
+        fields = text.split("|")[1:-1]
+        return dict(field.split("=", 1) for field in fields if "=" in field)
 
-        Returns
-        -------
-        reponse to client.
+    def _player_games(self, text, finished=None):
+        """Respond to a game history command.
 
+        Without a limit all games are sent, as "|" separated guids. With
+        one the text response ends with a `next={cursor}` field while there
+        are more pages; pass it back as `after` for the next page. The
+        summary fields are only sent in the json format.
         """
+        # text == {cmd}[|limit=..][|after=..][|fields=..,..][|format=..]|{playerguid}
+        player = self._get_player(text)
+        options = self._options(text)
+        fmt = options.get("format", "text")
+        fields = tuple(field for field in options.get("fields", "").split(",") if field)
+        if any(field not in HISTORY_FIELDS for field in fields):
+            return "exception|unknown-field".encode("utf8")
+        if fields and fmt == "text":
+            return "exception|fields-need-json".encode("utf8")
+        limit = None
+        if "limit" in options:
+            try:
+                limit = min(int(options["limit"]), MAX_HISTORY_PAGE)
+            except ValueError as e:
+                return "exception|invalid-limit".encode("utf8")
+            if limit < 1:
+                return "exception|invalid-limit".encode("utf8")
         try:
-            data = self.request.recv(4096)
-            text = data.decode("utf-8")
-        except ConnectionResetError as e:
-            self.logger.error("Client disconnected before sending command!")
-            return
+            games, cursor = self.game_keeper.storage.player_games(
+                player.id, finished, limit, options.get("after"), fields
+            )
+        except InvalidCursor as e:
+            return "exception|invalid-cursor".encode("utf8")
+        if fmt == "text":
+            guids = [game["guid"] for game in games]
+            if cursor is not None:
+                guids.append(f"next={cursor}")
+            return "|".join(guids).encode("utf8")
+        try:
+            with METRICS.serialize():
+                return wire.encode_history(games, cursor, fmt)
+        except wire.UnknownFormat as e:
+            return "exception|unknown-format".encode("utf8")
+
+    def dispatch(self, text):
+        """Run a command and return the response for the client.
+
+        Parameters
+        ----------
+        text : String
+            The raw command, `{cmd}|{args..}`.
+
+        Returns
+        -------
+        bytes
+            The response to send to the client.
 
+        """
         if len(text) < 1:
-            self.request.sendall("invalid".encode("utf8"))
-            self.request.close()
-            return
-        try:
-            cmd = text.split("|")[0]
-            method_name = f"_handle_{cmd}"
-            method = getattr(self, method_name)
-            # self.logger.debug(f"exec: {method_name}")
-            return method(text)
-        except NotLoggedIn as e:
-            self.request.sendall("NOT LOGGED IN!".encode("utf8"))
-        except AttributeError as e:
+            return "invalid".encode("utf8")
+        cmd = text.split("|")[0]
+        method = getattr(self, f"_handle_{cmd}", None)
+        if method is None:
             self.logger.error(f"ERROR! Raw command: {text}")
             self.logger.debug("Unknown command!")
-            self.request.sendall("invalid".encode("utf8"))
-            self.request.close()
-            return
+            return "invalid".encode("utf8")
+        with METRICS.command(cmd) as outcome:
+            try:
+                response = method(text)
+            except NotLoggedIn as e:
+                response = "NOT LOGGED IN!".encode("utf8")
+            except AttributeError as e:
+                self.logger.error(f"ERROR! Raw command: {text}")
+                response = "invalid".encode("utf8")
+            outcome.failed = response.startswith(ERROR_RESPONSES)
+        return response
 
     def _handle_dequeue(self, text):
         player = self._get_player(text)
-        if self.server.game_keeper.dequeue_player(player):
-            self.request.sendall("dequeued".encode("utf8"))
+        if self.game_keeper.dequeue_player(player):
+            return "dequeued".encode("utf8")
         else:
-            self.request.sendall("player_not_in_queue".encode("utf8"))
+            return "player_not_in_queue".encode("utf8")
 
     def _handle_getboardstate(self, text):
+        # text == getboardstate|{gameguid}[|etag=..][|format=..][|since=..]|{playerguid}
         player = self._get_player(text)
         gguid = text.split("|")[1]
-        state = self.server.game_keeper.get_game_state(gguid)
-        self.request.sendall(pickle.dumps(state))
+        options = self._options(text)
+        fmt = options.get("format", "pickle")
+        state = self.game_keeper.get_game_state(gguid)
+        if state and options.get("etag") == state["etag"]:
+            return "not_modified".encode("utf8")
+        if fmt == "pickle":
+            with METRICS.serialize():
+                return pickle.dumps(state)
+        if not state:
+            return "exception|game-not-found".encode("utf8")
+        moves = None
+        if "since" in options:
+            try:
+                since = int(options["since"])
+            except ValueError as e:
+                return "exception|invalid-since".encode("utf8")
+            moves = self.game_keeper.get_moves(gguid, since)
+        try:
+            with METRICS.serialize():
+                return wire.encode_state(state, fmt, moves)
+        except wire.UnknownFormat as e:
+            return "exception|unknown-format".encode("utf8")
 
     def _handle_getboard(self, text):
+        # text == getboard|{gameguid}[|format=..][|since=..]|{playerguid}
+        self._get_player(text)
+        gguid = text.split("|")[1]
+        options = self._options(text)
+        fmt = options.get("format", "pickle")
+        if fmt == "pickle":
+            board = self.game_keeper.get_board(gguid)
+            with METRICS.serialize():
+                return pickle.dumps(board)
+        try:
+            since = int(options.get("since", 0))
+        except ValueError as e:
+            return "exception|invalid-since".encode("utf8")
+        moves = self.game_keeper.get_moves(gguid, since)
+        if moves is None:
+            return "exception|game-not-found".encode("utf8")
+        try:
+            with METRICS.serialize():
+                return wire.encode_board(moves, fmt)
+        except wire.UnknownFormat as e:
+            return "exception|unknown-format".encode("utf8")
+
+    def _handle_legal_moves(self, text):
+        # text == legal_moves|{gameguid}[|format=..]|{playerguid}
         self._get_player(text)
         gguid = text.split("|")[1]
-        board = self.server.game_keeper.get_board(gguid)
-        self.request.sendall(pickle.dumps(board))
+        fmt = self._options(text).get("format", "packed")
+        legal = self.game_keeper.get_legal_moves(gguid)
+        if legal is None:
+            return "exception|game-not-found".encode("utf8")
+        version, moves = legal
+        try:
+            with METRICS.serialize():
+                return wire.encode_legal_moves(gguid, version, moves, fmt)
+        except wire.UnknownFormat as e:
+            return "exception|unknown-format".encode("utf8")
+
+    def _handle_batch(self, text):
+        # text == batch|{gameguid},{gameguid},..[|format=..]|{playerguid}
+        self._get_player(text)
+        gguids = [gguid for gguid in text.split("|")[1].split(",") if gguid]
+        if len(gguids) > wire.MAX_BATCH:
+            return "exception|batch-too-large".encode("utf8")
+        fmt = self._options(text).get("format", "pickle")
+        states = self.game_keeper.get_game_states(gguids)
+        try:
+            with METRICS.serialize():
+                return wire.encode_states(states, fmt)
+        except wire.UnknownFormat as e:
+            return "exception|unknown-format".encode("utf8")
 
     def _handle_move(self, text):
         # text == move|{gameguid}|{move}|{playerguid}
         _, gguid, move, pguid = text.split("|")
         player = self._get_player(text)
         try:
-            self.server.game_keeper.make_move(gguid, player, move)
+            self.game_keeper.make_move(gguid, player, move)
             # move has been made
-            self.request.sendall("move_made".encode("utf8"))
+            return "move_made".encode("utf8")
         except GameNotFound as e:
-            self.request.sendall("exception|game-not-found".encode("utf8"))
-            self.request.close()
+            return "exception|game-not-found".encode("utf8")
         except IllegalMove as e:
-            self.request.sendall("exception|illegal_move".encode("utf8"))
-            self.request.close()
+            return "exception|illegal_move".encode("utf8")
         except NotPlayersTurn as e:
-            self.request.sendall("exception|not-players-turn".encode("utf8"))
-            self.request.close()
+            return "exception|not-players-turn".encode("utf8")
+        except GameFinished as e:
+            return "exception|game-over".encode("utf8")
+        except WriteTimeout as e:
+            # Made, but not in the database yet
+            return "exception|move-not-saved".encode("utf8")
+
+    def _handle_subscribe(self, text):
+        # text == subscribe|{gameguid}|{playerguid}
+        _, gguid, pguid = text.split("|")
+        self._get_player(text)
+        if self.push is None:
+            return "exception|needs-framed-connection".encode("utf8")
+        try:
+            self.game_keeper.subscribe(gguid, self._push_move)
+        except GameNotFound as e:
+            return "exception|game-not-found".encode("utf8")
+        except GameFinished as e:
+            return "exception|game-over".encode("utf8")
+        self.subscriptions.add(gguid)
+        return "subscribed".encode("utf8")
+
+    def _handle_unsubscribe(self, text):
+        # text == unsubscribe|{gameguid}|{playerguid}
+        _, gguid, pguid = text.split("|")
+        self._get_player(text)
+        self.game_keeper.unsubscribe(gguid, self._push_move)
+        self.subscriptions.discard(gguid)
+        return "unsubscribed".encode("utf8")
+
+    def _push_move(self, event):
+        # pushed == move|{gameguid}|{move}|{fen}|{game_over}|{result}
+        # or, when a clock ran out,
+        #           flag|{gameguid}|{white or black}|{fen}|True|{result}
+        self.push(
+            f"{event['kind']}|{event['guid']}|{event['move']}|{event['fen']}|"
+            f"{event['game_over']}|{event['result']}".encode("utf8")
+        )
+
+    def close_subscriptions(self):
+        """Unsubscribe from all games, for when the connection closes."""
+        for gguid in self.subscriptions:
+            self.game_keeper.unsubscribe(gguid, self._push_move)
+        self.subscriptions = set()
 
     def _handle_current_games(self, text):
         # self.logger.debug('Client wants a list of current_games')
-        p = self._get_player(text)
-        games = p.games_as_white.all() + p.games_as_black.all()
-        games = [g for g in games if g.state == "in_progress"]
-        guids = [g.guid for g in games]
-        self.request.sendall("|".join(guids).encode("utf8"))
+        return self._player_games(text, finished=False)
 
     def _handle_all_games(self, text):
         # self.logger.debug('Client wants a list of all games')
-        p = self._get_player(text)
-        games = p.games_as_white.all() + p.games_as_black.all()
-        guids = [g.guid for g in games]
-        self.request.sendall("|".join(guids).encode("utf8"))
+        return self._player_games(text)
 
     def _handle_done_games(self, text):
         # self.logger.debug('Client wants a list of old games')
-        p = self._get_player(text)
-        games = p.games_as_white.all() + p.games_as_black.all()
-        games = [g for g in games if g.state != "in_progress"]
-        guids = [g.guid for g in games]
-        self.request.sendall("|".join(guids).encode("utf8"))
+        return self._player_games(text, finished=True)
 
     def _handle_myturn(self, text):
         _, gguid, pguid = text.split("|")
         player = self._get_player(text)
-        game = Game.where("guid", gguid).first()
-        if game.player_to_play.id == player.id:
-            self.request.sendall("True".encode("utf8"))
+        game = self.game_keeper.live_game(gguid)
+        if game.player_to_play_id == player.id:
+            return "True".encode("utf8")
         else:
-            self.request.sendall("False".encode("utf8"))
+            return "False".encode("utf8")
 
     def _handle_myside(self, text):
         _, gguid, pguid = text.split("|")
         player = self._get_player(text)
-        game = Game.where("guid", gguid).first()
+        game = self.game_keeper.live_game(gguid)
         if game.white_player_id == player.id:
-            self.request.sendall("White".encode("utf8"))
+            return "White".encode("utf8")
         else:
-            self.request.sendall("Black".encode("utf8"))
+            return "Black".encode("utf8")
 
     def _handle_opponent_name(self, text):
         _, gguid, pguid = text.split("|")
         player = self._get_player(text)
-        game = Game.where("guid", gguid).first()
-        if game.black_player.id == player.id:
-            self.request.sendall(f"{game.white_player.name}".encode("utf8"))
+        game = self.game_keeper.live_game(gguid)
+        if game.black_player_id == player.id:
+            return f"{game.white_name}".encode("utf8")
         else:
-            self.request.sendall(f"{game.black_player.name}".encode("utf8"))
+            return f"{game.black_name}".encode("utf8")
 
     def _handle_queue_up(self, text):
         self.logger.debug("Client requesting a random game.")
+        # text == queue_up[|tc={minutes}+{increment}][|bot={level}]|{playerguid}
         p = self._get_player(text)
-        game = self.server.game_keeper.new_game(p)
+        options = self._options(text)
+        opponent = None
+        if "bot" in options:
+            # A game against the bot player of a level, right away
+            if self.game_keeper.bot is None:
+                return "exception|no-bot".encode("utf8")
+            try:
+                opponent = self.game_keeper.bot.player(int(options["bot"]))
+            except (KeyError, ValueError) as e:
+                return "exception|invalid-level".encode("utf8")
+        try:
+            game = self.game_keeper.new_game(
+                p, opponent, time_control=options.get("tc")
+            )
+        except InvalidTimeControl as e:
+            return "exception|invalid-time-control".encode("utf8")
         if game is None:
-            self.request.sendall("queued_for_game".encode("utf8"))
+            return "queued_for_game".encode("utf8")
         else:
-            self.request.sendall(f"{game.guid}".encode("utf8"))
+            return f"{game.guid}".encode("utf8")
 
     def _handle_login(self, text):
         self.logger.debug("Recieved login request.")
         # login|username|hashed_password
         usr = text.split("|")[1]
         pwd = text.split("|")[2]
-        self.logger.debug(f"Username: {usr} // pswd: {pwd} checking...")
-        try:
-            player = (
-                Player.where("name", usr).where("hashed_password", pwd).first_or_fail()
-            )
-            self.logger.debug("Found player!")
-            self.request.sendall(player.guid.encode("utf8"))
-        except:
+        self.logger.debug(f"Username: {usr} checking...")
+        player = self.game_keeper.storage.login(usr, pwd)
+        if player is None:
             self.logger.debug("Found no player named that way...")
-            self.request.sendall("invalid".encode("utf8"))
+            return "invalid".encode("utf8")
+        self.logger.debug("Found player!")
+        self.game_keeper.sessions.put(player)
+        return player.guid.encode("utf8")
 
     def _handle_register(self, text):
         import hashlib
@@ -185,26 +377,139 @@ class Responder(socketserver.BaseRequestHandler):
         usr = text.split("|")[1]
         pwd1 = text.split("|")[2]
         pwd2 = text.split("|")[3]
-        if Player.where("name", usr).count() > 0:
-            self.request.sendall("username_taken".encode("utf8"))
-            self.request.close()
-            return
+        storage = self.game_keeper.storage
+        if storage.name_taken(usr) or usr in BOT_NAMES:
+            return "username_taken".encode("utf8")
 
         if pwd1 != pwd2:
-            self.request.sendall("invalid_password".encode("utf8"))
-            self.request.close()
-            return
+            return "invalid_password".encode("utf8")
 
-        player = Player()
-        player.name = usr
-        player.hashed_password = hashlib.sha224(pwd1.encode("utf8")).hexdigest()
-        player.save()  # Needed to get an ID in the DB
-        player.guid = hashlib.sha224(
-            (str(player.id) + player.name + player.hashed_password).encode("utf8")
-        ).hexdigest()
-        if player.save():
-            self.request.sendall(f"register_success|{player.guid}".encode("utf8"))
-            self.request.close()
+        hashed_password = hashlib.sha224(pwd1.encode("utf8")).hexdigest()
+        player = storage.register(usr, hashed_password)
+        if player is not None:
+            self.game_keeper.sessions.put(player)
+            return f"register_success|{player.guid}".encode("utf8")
         else:
-            self.request.sendall("register_failed!".encode("utf8"))
-            self.request.close()
+            return "register_failed!".encode("utf8")
+
+    def _handle_stats(self, text):
+        # text == stats[|profile=start|stop][|reset=1]|{admin token}
+        token = text.split("|")[-1]
+        if not ADMIN_TOKEN or not hmac.compare_digest(
+            token.encode("utf8"), ADMIN_TOKEN.encode("utf8")
+        ):
+            return "invalid".encode("utf8")
+        options = self._options(text)
+        if options.get("profile") == "start":
+            METRICS.profiler.start()
+        elif options.get("profile") == "stop":
+            METRICS.profiler.stop()
+        stats = METRICS.snapshot()
+        stats["game_keeper"] = self.game_keeper.counts()
+        stats["game_cache"] = self.game_keeper.cache_stats()
+        stats["legal_move_cache"] = self.game_keeper.legal_move_cache.stats()
+        if self.game_keeper.bot is not None:
+            stats["bot"] = self.game_keeper.bot.stats()
+        if self.game_keeper.writer is not None:
+            stats["writer"] = self.game_keeper.writer.stats()
+        if options.get("reset"):
+            METRICS.reset()
+        return json.dumps(stats, separators=(",", ":")).encode("utf8")
+
+
+class Responder(CommandHandler, socketserver.BaseRequestHandler):
+    """The responder to client requests."""
+
+    def __init__(self, request, client_address, server):
+        CommandHandler.__init__(self, server.game_keeper)
+        # self.logger.debug('__init__')
+        socketserver.BaseRequestHandler.__init__(self, request, client_address, server)
+
+    def handle(self):
+        """Handle incomming commands.
+
+        A connection either sends one plain text command and gets one
+        response, or opens with `FRAME_MAGIC` and then sends any number of
+        length prefixed frames over the same connection.
+
+        """
+        try:
+            data = self.request.recv(4096)
+        except ConnectionResetError as e:
+            self.logger.error("Client disconnected before sending command!")
+            return
+
+        if data.startswith(FRAME_MAGIC):
+            self.handle_framed(data[len(FRAME_MAGIC) :])
+            return
+
+        self.request.sendall(self.dispatch(data.decode("utf-8")))
+
+    def handle_framed(self, buffered):
+        """Serve frames until the client closes the connection.
+
+        Every frame is run on the worker pool of the server, so a slow
+        command does not hold up the other requests on the connection.
+        The response carries the request id of the frame it answers.
+        Pushed frames are queued and sent by a thread of the connection,
+        a client that does not read them is unsubscribed instead of holding
+        up the player that made the move.
+
+        """
+        reader = FrameReader(self.request, buffered)
+        send_lock = threading.Lock()
+        pending = set()
+        pushes = queue.Queue(MAX_PUSHES)
+        closed = threading.Event()
+
+        def respond(request_id, payload):
+            try:
+                response = self.dispatch(payload.decode("utf-8"))
+            except Exception as e:
+                self.logger.exception(f"Command failed: {e}")
+                response = "exception|server-error".encode("utf8")
+            with send_lock:
+                self.request.sendall(pack_frame(request_id, response))
+
+        def push(payload):
+            # Called from the thread that made the move
+            if closed.is_set():
+                raise ConnectionResetError("Subscriber disconnected")
+            try:
+                pushes.put_nowait(payload)
+            except queue.Full:
+                raise PushOverflow(f"{MAX_PUSHES} pushed frames not sent")
+
+        def send_pushes():
+            while True:
+                payload = pushes.get()
+                if payload is None:
+                    return
+                try:
+                    with send_lock:
+                        self.request.sendall(pack_frame(PUSH_REQUEST_ID, payload))
+                except OSError as e:
+                    self.logger.debug(f"Stopping pushes: {e}")
+                    closed.set()
+                    return
+
+        threading.Thread(target=send_pushes, name="Pusher", daemon=True).start()
+        self.push = push
+        try:
+            while True:
+                frame = reader.read_frame()
+                if frame is None:
+                    break
+                pending.add(self.server.frame_workers.submit(respond, *frame))
+                pending = {f for f in pending if not f.done()}
+        except (ConnectionResetError, FrameError) as e:
+            self.logger.error(f"Dropping framed connection: {e}")
+        # Let running commands finish before the socket is closed
+        futures.wait(pending)
+        closed.set()
+        self.close_subscriptions()
+        try:
+            pushes.put_nowait(None)
+        except queue.Full:
+            # The pusher is stuck on the socket, closing it stops the pusher
+            pass
@@ -1,20 +1,19 @@
 # Init datbase connection
+import argparse
 import logging
+import signal
 import socketserver
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-from game_keeper import GameKeeper
 from responder import Responder
-from time_lord import TimeLord
-
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(relativeCreated)6d %(threadName)s %(name)-12s %(levelname)-8s %(message)s",
-)
+from services import Services, add_arguments, configure_logging
 
 # Multithreaded Python server : TCP Server Socket Program Stub
 TCP_IP = "127.0.0.1"  # '0.0.0.0'
 TCP_PORT = 2004
+# Threads that run the commands received over framed connections
+FRAME_WORKERS = 16
 
 
 class ChessServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
@@ -23,14 +22,19 @@ class ChessServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     # much faster rebinding
     allow_reuse_address = True
 
-    def __init__(self, server_address, RequestHandlerClass, game_keeper):
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format="%(relativeCreated)6d %(threadName)s %(name)-12s %(levelname)-8s %(message)s",
-        )
+    def __init__(
+        self,
+        server_address,
+        RequestHandlerClass,
+        game_keeper,
+        frame_workers=FRAME_WORKERS,
+    ):
         self.logger = logging.getLogger("ChessServer")
         self.logger.debug("__init__")
         self.game_keeper = game_keeper
+        self.frame_workers = ThreadPoolExecutor(
+            max_workers=frame_workers, thread_name_prefix="FrameWorker"
+        )
         socketserver.TCPServer.__init__(self, server_address, RequestHandlerClass)
 
     def serve_forever(self, poll_interval=0.5):
@@ -39,21 +43,29 @@ class ChessServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
         socketserver.TCPServer.serve_forever(self, poll_interval)
         return
 
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        self.frame_workers.shutdown(wait=False)
+
 
 if __name__ == "__main__":
-    # Set level to error logging for orator
-    logging.getLogger("orator.connection.queries").setLevel(logging.ERROR)
-    logging.getLogger("orator.database_manager").setLevel(logging.ERROR)
-
-    GAME_KEEPER = GameKeeper()
-    GAME_KEEPER.load_games()
-    TIME_LORD = TimeLord()
-    SERVER = ChessServer((TCP_IP, TCP_PORT), Responder, GAME_KEEPER)
+    parser = argparse.ArgumentParser(description="threaded chess server")
+    parser.add_argument("--host", default=TCP_IP)
+    parser.add_argument("--port", type=int, default=TCP_PORT)
+    add_arguments(parser)
+    args = parser.parse_args()
+    # Terminated like interrupted, so the finally below writes the moves
+    # left and the snapshot, sharding.py terminates its workers
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    configure_logging(args.log_level)
+    SERVICES = Services(args)
+    SERVICES.start()
     try:
-        TIME_LORD.start(GAME_KEEPER)
-        SERVER.logger.info(f"Server booted, tasks: {len(TIME_LORD.TASKS)}")
+        SERVER = ChessServer((args.host, args.port), Responder, SERVICES.game_keeper)
+        SERVER.logger.info(f"Server booted, tasks: {len(SERVICES.time_lord.TASKS)}")
         SERVER.serve_forever()
     except KeyboardInterrupt:
         sys.exit(0)
     finally:
-        TIME_LORD.stop()
+        SERVICES.stop()
@@ -0,0 +1,143 @@
+"""What runs next to the connections of a server.
+
+The threaded and the asyncio server keep their games the same way: a
+GameKeeper with the TimeLord, the WriteCoordinator, the Bot and the
+snapshots around it. Both entry points take the same flags for them and
+start and stop them through Services.
+"""
+
+import logging
+
+from bot import Bot
+from game_cache import HOT_GAMES, WARM_GAMES
+from game_keeper import GameKeeper
+from metrics import METRICS
+from sharding import owned_by
+from snapshot import SNAPSHOT_INTERVAL, SNAPSHOT_PATH, snapshot_path
+from time_lord import TimeLord
+from write_coordinator import COMMIT_BATCH, COMMIT_WINDOW, WriteCoordinator
+
+LOG_FORMAT = (
+    "%(relativeCreated)6d %(threadName)s %(name)-12s %(levelname)-8s %(message)s"
+)
+
+
+def add_arguments(parser):
+    """Add the flags of the Services to the argparse [parser] of a server."""
+    parser.add_argument(
+        "--shard",
+        type=int,
+        default=0,
+        help="shard of the games to keep, see sharding.py",
+    )
+    parser.add_argument("--shards", type=int, default=1, help="number of shards")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs every command")
+    parser.add_argument(
+        "--profile", action="store_true", help="sample the stacks of the commands"
+    )
+    parser.add_argument(
+        "--bot-workers",
+        type=int,
+        default=0,
+        help="processes thinking for the bot players, no bot if 0",
+    )
+    parser.add_argument(
+        "--bot-after",
+        type=float,
+        help="seconds a queued player waits before a bot takes the game",
+    )
+    parser.add_argument(
+        "--commit-window",
+        type=float,
+        default=COMMIT_WINDOW * 1000,
+        help="milliseconds moves wait for others to be committed with",
+    )
+    parser.add_argument(
+        "--commit-batch",
+        type=int,
+        default=COMMIT_BATCH,
+        help="moves that are committed right away",
+    )
+    parser.add_argument(
+        "--hot-games",
+        type=int,
+        default=HOT_GAMES,
+        help="games kept with their board, the least recently used are demoted",
+    )
+    parser.add_argument(
+        "--warm-games",
+        type=int,
+        default=WARM_GAMES,
+        help="demoted games kept in memory as compact records",
+    )
+    parser.add_argument(
+        "--snapshot",
+        default=SNAPSHOT_PATH,
+        help="file the games are restored from and snapshot to, none if empty",
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        type=float,
+        default=SNAPSHOT_INTERVAL,
+        help="seconds between snapshots",
+    )
+
+
+def configure_logging(level):
+    logging.basicConfig(level=level.upper(), format=LOG_FORMAT)
+    # Set level to error logging for orator
+    logging.getLogger("orator.connection.queries").setLevel(logging.ERROR)
+    logging.getLogger("orator.database_manager").setLevel(logging.ERROR)
+
+
+class Services:
+    """The GameKeeper of a server and everything that runs with it."""
+
+    def __init__(self, args):
+        """Set up the GameKeeper and load its games.
+
+        Parameters
+        ----------
+        args : argparse.Namespace
+            The flags added by add_arguments.
+
+        """
+        self.game_keeper = GameKeeper(
+            owns=owned_by(args.shard, args.shards) if args.shards > 1 else None,
+            hot_games=args.hot_games,
+            warm_games=args.warm_games,
+        )
+        self.snapshot = snapshot_path(args.snapshot, args.shard, args.shards)
+        self.snapshot_interval = args.snapshot_interval
+        self.game_keeper.load_games(self.snapshot)
+        self.time_lord = TimeLord()
+        self.writer = WriteCoordinator(args.commit_window / 1000, args.commit_batch)
+        self.bot = None
+        if args.bot_workers > 0:
+            self.bot = Bot(args.bot_workers, args.bot_after)
+        self.profile = args.profile
+
+    def start(self):
+        self.writer.start(self.game_keeper)
+        if self.bot is not None:
+            self.bot.start(self.game_keeper)
+        if self.profile:
+            METRICS.profiler.start()
+        self.time_lord.start(self.game_keeper)
+        if self.snapshot is not None:
+            self.time_lord.TASKS.append(
+                self.time_lord.every(
+                    self.snapshot_interval,
+                    self.game_keeper.save_snapshot,
+                    self.snapshot,
+                )
+            )
+
+    def stop(self):
+        """Write what is left and take the last snapshot."""
+        self.time_lord.stop()
+        self.writer.stop()
+        if self.snapshot is not None:
+            self.game_keeper.save_snapshot(self.snapshot)
+        if self.bot is not None:
+            self.bot.stop()
@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import namedtuple
+
+# Seconds a looked up player stays valid without going back to the database
+SESSION_TTL = 15 * 60
+
+PlayerRecord = namedtuple("PlayerRecord", ["id", "name", "guid"])
+
+
+def record_for(player):
+    """Build a PlayerRecord from a Player model."""
+    return PlayerRecord(player.id, player.name, player.guid)
+
+
+class SessionCache:
+    """Maps player guids to PlayerRecords for authenticated commands.
+
+    Entries expire after `ttl` seconds and are dropped as soon as the
+    player is changed in the database.
+    """
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, guid):
+        """Return the record for a guid, or None if it is not cached."""
+        entry = self._sessions.get(guid)
+        if entry is None:
+            return None
+        record, expires = entry
+        if expires < time.monotonic():
+            self.invalidate(guid)
+            return None
+        return record
+
+    def put(self, record):
+        """Cache a record and return it."""
+        with self._lock:
+            self._sessions[record.guid] = (record, time.monotonic() + self.ttl)
+        return record
+
+    def invalidate(self, guid):
+        with self._lock:
+            self._sessions.pop(guid, None)
+
+    def invalidate_player(self, player_id):
+        """Drop every session of a player, whatever guid it was cached on."""
+        with self._lock:
+            for guid, (record, _) in list(self._sessions.items()):
+                if record.id == player_id:
+                    del self._sessions[guid]
+
+    def purge_expired(self):
+        """Drop all expired sessions."""
+        now = time.monotonic()
+        with self._lock:
+            for guid, (_, expires) in list(self._sessions.items()):
+                if expires < now:
+                    del self._sessions[guid]
+
+    def snapshot(self):
+        """Return (record, seconds left) of the sessions not expired."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (record, expires - now)
+                for record, expires in self._sessions.values()
+                if expires > now
+            ]
+
+    def restore(self, entries):
+        """Cache the sessions of a snapshot again, for the time they had left."""
+        now = time.monotonic()
+        with self._lock:
+            for record, left in entries:
+                self._sessions[record.guid] = (record, now + left)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SessionObserver:
+    """Orator model observer that keeps a SessionCache in sync with Player."""
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+
+    def saved(self, player):
+        self.sessions.invalidate_player(player.id)
+
+    def deleted(self, player):
+        self.sessions.invalidate_player(player.id)
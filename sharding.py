@@ -0,0 +1,386 @@
+"""Play the games on several worker processes, sharded by game guid.
+
+Every worker is an async_server.py with a GameKeeper of its own, started
+with --shard/--shards so it only keeps the games whose guid hashes to it.
+The workers share the database. The ShardRouter takes the client
+connections and forwards every command to the worker it belongs to:
+
+- the commands about one game go to the shard owning its guid,
+- a batch is split over the shards owning its games and the responses are
+  merged again,
+- queue_up and dequeue go to the lobby shard, so all queued players are
+  matched by one matchmaker. The games it makes are written to the
+  database and loaded by their shard on the first command about them,
+- the other commands only need the player, they are spread over the
+  shards by player guid.
+
+Shards are host:port addresses. Without --shards the workers are started
+here on consecutive ports; with it the router runs on its own in front of
+workers started elsewhere. Workers on other hosts need the same database,
+with SQLite that means the same host.
+
+    python sharding.py --workers 4
+    python sharding.py --shards 127.0.0.1:2101,127.0.0.1:2102
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import zlib
+
+import wire
+from framing import FRAME_HEADER, FRAME_MAGIC, MAX_FRAME_SIZE, pack_frame
+
+TCP_IP = "127.0.0.1"  # '0.0.0.0'
+TCP_PORT = 2004
+# The workers started by main listen from this port up
+WORKER_PORT = 2101
+ASYNC_SERVER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "async_server.py"
+)
+
+# Commands with the game guid as first argument
+GAME_COMMANDS = (
+    "getboardstate",
+    "getboard",
+    "move",
+    "subscribe",
+    "unsubscribe",
+    "myturn",
+    "myside",
+    "opponent_name",
+    "legal_moves",
+)
+# Commands served by the lobby shard, it keeps the queue
+LOBBY_COMMANDS = ("queue_up", "dequeue")
+LOBBY_SHARD = 0
+
+SHARD_DOWN = "exception|shard-unavailable".encode("utf8")
+
+
+def shard_for(guid, count):
+    """The index of the shard a guid belongs to, out of [count] shards.
+
+    crc32 instead of hash(), every process has to agree on it.
+    """
+    return zlib.crc32(guid.encode("utf8")) % count
+
+
+def owned_by(shard, count):
+    """The GameKeeper owns predicate of shard [shard] out of [count]."""
+
+    def owns(guid):
+        return shard_for(guid, count) == shard
+
+    return owns
+
+
+def parse_address(address):
+    """Split "host:port" into (host, port)."""
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+class ShardRouter:
+    """Forward client connections to the shard owning their commands.
+
+    Plain text commands are forwarded on a connection of their own. A
+    framed client gets one framed connection to every shard it talks to,
+    frames go through as they are: the request ids are unique on the client
+    connection so they are on the shard connections too, and the pushes of
+    the subscriptions come back on the connection of the game's shard.
+    """
+
+    def __init__(self, shards, lobby=LOBBY_SHARD):
+        """Initialize a router.
+
+        Parameters
+        ----------
+        shards : list
+            (host, port) of every shard, in shard order.
+        lobby : Integer
+            The index of the shard keeping the queue.
+
+        """
+        self.logger = logging.getLogger("ShardRouter")
+        self.logger.debug("__init__")
+        self.shards = shards
+        self.lobby = lobby
+
+    def shard_of(self, text):
+        """The index of the shard to run a command on."""
+        fields = text.split("|")
+        if fields[0] in GAME_COMMANDS and len(fields) > 2:
+            return shard_for(fields[1], len(self.shards))
+        if fields[0] in LOBBY_COMMANDS:
+            return self.lobby
+        if fields[0] == "stats":
+            # stats[|shard={index}]..|{admin token}, every shard has its own
+            for field in fields[1:-1]:
+                if field.startswith("shard="):
+                    try:
+                        return int(field[len("shard=") :]) % len(self.shards)
+                    except ValueError:
+                        # Not a shard, the lobby answers
+                        break
+            return self.lobby
+        return shard_for(fields[-1], len(self.shards))
+
+    async def forward(self, shard, data):
+        """Run a plain text command on a shard and return its response."""
+        host, port = self.shards[shard]
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError as e:
+            self.logger.error(f"Shard {shard} at {host}:{port} is down: {e}")
+            return SHARD_DOWN
+        try:
+            writer.write(data)
+            await writer.drain()
+            return await reader.read()
+        except ConnectionResetError as e:
+            self.logger.error(f"Shard {shard} dropped the connection: {e}")
+            return SHARD_DOWN
+        finally:
+            writer.close()
+
+    async def route(self, data):
+        """Run a plain text command on the shards it needs."""
+        text = data.decode("utf-8")
+        if text.startswith("batch|"):
+            return await self.batch(text)
+        return await self.forward(self.shard_of(text), data)
+
+    async def batch(self, text):
+        """Split a batch over the shards owning its games, merge the
+        responses."""
+        # text == batch|{gameguid},{gameguid},..[|format=..]|{playerguid}
+        fields = text.split("|")
+        gguids = [gguid for gguid in fields[1].split(",") if gguid]
+        if len(gguids) > wire.MAX_BATCH:
+            return "exception|batch-too-large".encode("utf8")
+        by_shard = {}
+        for gguid in gguids:
+            by_shard.setdefault(shard_for(gguid, len(self.shards)), []).append(gguid)
+        if len(by_shard) < 2:
+            shard = next(iter(by_shard), self.shard_of(text))
+            return await self.forward(shard, text.encode("utf8"))
+        parts = await asyncio.gather(
+            *(
+                self.forward(
+                    shard, "|".join(["batch", ",".join(gguids)] + fields[2:]).encode()
+                )
+                for shard, gguids in by_shard.items()
+            )
+        )
+        for part in parts:
+            # Errors are text, no encoding of the states starts like this
+            if part in (SHARD_DOWN, b"invalid", b"NOT LOGGED IN!") or part.startswith(
+                b"exception|"
+            ):
+                return part
+        options = dict(field.split("=", 1) for field in fields[2:-1] if "=" in field)
+        return wire.merge_states(parts, options.get("format", "pickle"))
+
+    async def handle_client(self, reader, writer):
+        """Handle one client connection, framed or plain text."""
+        try:
+            data = await reader.read(4096)
+            if data.startswith(FRAME_MAGIC):
+                await self.handle_framed(reader, writer, data[len(FRAME_MAGIC) :])
+            elif data:
+                writer.write(await self.route(data))
+                await writer.drain()
+        except (ConnectionResetError, asyncio.IncompleteReadError) as e:
+            self.logger.debug(f"Client went away: {e}")
+        finally:
+            writer.close()
+
+    async def handle_framed(self, reader, writer, buffered):
+        """Forward frames until the client closes the connection."""
+        # shard => StreamWriter of the framed connection to it
+        upstream = {}
+        tasks = set()
+
+        def start(coroutine):
+            task = asyncio.ensure_future(coroutine)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        async def pump(shard, shard_reader):
+            # Responses and pushes of a shard, back to the client
+            try:
+                while True:
+                    header = await shard_reader.readexactly(FRAME_HEADER.size)
+                    length, _ = FRAME_HEADER.unpack(header)
+                    writer.write(header + await shard_reader.readexactly(length))
+                    await writer.drain()
+            except (ConnectionResetError, asyncio.IncompleteReadError) as e:
+                self.logger.debug(f"Shard {shard} went away: {e}")
+            finally:
+                if upstream.get(shard) is not None:
+                    upstream.pop(shard).close()
+
+        async def connect(shard):
+            host, port = self.shards[shard]
+            try:
+                shard_reader, shard_writer = await asyncio.open_connection(host, port)
+            except OSError as e:
+                self.logger.error(f"Shard {shard} at {host}:{port} is down: {e}")
+                return None
+            shard_writer.write(FRAME_MAGIC)
+            upstream[shard] = shard_writer
+            start(pump(shard, shard_reader))
+            return shard_writer
+
+        async def batch(request_id, text):
+            writer.write(pack_frame(request_id, await self.batch(text)))
+            await writer.drain()
+
+        async def read_exactly(size):
+            nonlocal buffered
+            if len(buffered) >= size:
+                data, buffered = buffered[:size], buffered[size:]
+                return data
+            data = buffered + await reader.readexactly(size - len(buffered))
+            buffered = b""
+            return data
+
+        try:
+            while True:
+                try:
+                    header = await read_exactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                length, request_id = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    self.logger.error(f"Dropping client, frame of {length} bytes")
+                    break
+                payload = await read_exactly(length)
+                text = payload.decode("utf-8")
+                if text.startswith("batch|"):
+                    start(batch(request_id, text))
+                    continue
+                shard = self.shard_of(text)
+                shard_writer = upstream.get(shard) or await connect(shard)
+                if shard_writer is None:
+                    writer.write(pack_frame(request_id, SHARD_DOWN))
+                    continue
+                shard_writer.write(header + payload)
+        finally:
+            # Closing the shard connections ends their subscriptions
+            for shard_writer in list(upstream.values()):
+                shard_writer.close()
+            for task in list(tasks):
+                task.cancel()
+
+    async def serve_forever(self, host=TCP_IP, port=TCP_PORT, reuse_port=False):
+        server = await asyncio.start_server(
+            self.handle_client, host, port, reuse_port=reuse_port
+        )
+        self.logger.info(f"Routing to {len(self.shards)} shards")
+        async with server:
+            await server.serve_forever()
+
+
+def start_workers(count, host=TCP_IP, port=WORKER_PORT, extra_args=()):
+    """Start [count] shard workers on consecutive ports.
+
+    Returns
+    -------
+    tuple
+        (processes, addresses) of the workers, in shard order.
+
+    """
+    processes = []
+    addresses = []
+    for shard in range(count):
+        addresses.append((host, port + shard))
+        processes.append(
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    ASYNC_SERVER,
+                    "--host",
+                    host,
+                    "--port",
+                    str(port + shard),
+                    "--shard",
+                    str(shard),
+                    "--shards",
+                    str(count),
+                ]
+                + list(extra_args)
+            )
+        )
+    return processes, addresses
+
+
+def run_router(shards, host, port, reuse_port=False):
+    """Run a ShardRouter until interrupted, the target of router processes."""
+    try:
+        asyncio.run(ShardRouter(shards).serve_forever(host, port, reuse_port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sharded chess server")
+    parser.add_argument("--host", default=TCP_IP)
+    parser.add_argument("--port", type=int, default=TCP_PORT)
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="shard workers to start"
+    )
+    parser.add_argument("--worker-port", type=int, default=WORKER_PORT)
+    parser.add_argument(
+        "--shards", help="host:port,.. of running shards, no workers are started"
+    )
+    parser.add_argument(
+        "--routers",
+        type=int,
+        default=1,
+        help="router processes, sharing the port with SO_REUSEPORT",
+    )
+    # The other arguments are passed on to the workers, see async_server.py
+    args, worker_args = parser.parse_known_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(relativeCreated)6d %(processName)s %(name)-12s %(levelname)-8s %(message)s",
+    )
+
+    # Terminated like interrupted, through the finally below, so the routers
+    # and workers are not orphaned. Router processes inherit this.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    WORKERS = []
+    if args.shards:
+        SHARDS = [parse_address(address) for address in args.shards.split(",")]
+    else:
+        WORKERS, SHARDS = start_workers(
+            args.workers, args.host, args.worker_port, worker_args
+        )
+    ROUTERS = [
+        multiprocessing.Process(
+            target=run_router,
+            args=(SHARDS, args.host, args.port, True),
+            name=f"Router-{index}",
+        )
+        for index in range(1, args.routers)
+    ]
+    try:
+        for router in ROUTERS:
+            router.start()
+        run_router(SHARDS, args.host, args.port, args.routers > 1)
+    finally:
+        for process in ROUTERS + WORKERS:
+            process.terminate()
+        for router in ROUTERS:
+            router.join()
+        for worker in WORKERS:
+            worker.wait()
@@ -0,0 +1,162 @@
+"""Snapshots of a GameKeeper, for a restart that does not load every game.
+
+A snapshot holds the games in memory, each as the storage fields of its
+record and its move log, along with the matchmaking queue, the games
+offered to queued players and the sessions. The games are indexed by
+guid in sorted order at the end of the file. Opening a snapshot maps the
+file and reads the small state part only, a game is found with a binary
+search of the index once it is asked for. How long a restart takes does
+not depend on the number of games in it.
+
+Layout, all numbers big endian:
+
+    header   magic, game count, state length, index offset
+    state    JSON, see GameKeeper.save_snapshot
+    games    per game its fields (JSON) followed by its move log
+    index    per game, by guid: guid, offset, fields length, log length
+"""
+
+import json
+import mmap
+import os
+import struct
+
+# Written next to the database, a shard adds its number
+SNAPSHOT_PATH = os.environ.get("CHESS_SERVER_SNAPSHOT", "chess_server.snapshot")
+# Seconds between the snapshots the servers write while running
+SNAPSHOT_INTERVAL = 60
+MAGIC = b"CHSNAP01"
+HEADER = struct.Struct(">8sIIQ")
+INDEX_ENTRY = struct.Struct(">36sQII")
+
+
+class InvalidSnapshot(Exception):
+    """Raise when a snapshot file is not one this version wrote."""
+
+
+def snapshot_path(path, shard=0, shards=1):
+    """The snapshot of a shard, the shards of a server each write their own."""
+    if not path or shards == 1:
+        return path or None
+    return f"{path}.{shard}"
+
+
+def _key(guid):
+    # As INDEX_ENTRY packs it, so the index sorts and compares the same
+    return guid.encode("ascii").ljust(36, b"\0")
+
+
+def write_snapshot(path, state, games):
+    """Write a snapshot to [path], replacing the one there at once.
+
+    Parameters
+    ----------
+    path : String
+        The snapshot file.
+    state : Hash
+        Everything but the games, stored as JSON.
+    games : Hash
+        guid => (fields, move log) with the fields JSON encoded already.
+
+    Returns
+    -------
+    Integer
+        The size of the snapshot in bytes.
+
+    """
+    state_blob = json.dumps(state).encode("utf8")
+    chunks = []
+    index = []
+    offset = HEADER.size + len(state_blob)
+    for guid in sorted(games, key=_key):
+        fields, move_log = games[guid]
+        index.append(INDEX_ENTRY.pack(_key(guid), offset, len(fields), len(move_log)))
+        chunks.append(fields)
+        chunks.append(move_log)
+        offset += len(fields) + len(move_log)
+    header = HEADER.pack(MAGIC, len(index), len(state_blob), offset)
+    written = path + ".tmp"
+    with open(written, "wb") as snapshot:
+        snapshot.write(header)
+        snapshot.write(state_blob)
+        snapshot.writelines(chunks)
+        snapshot.writelines(index)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    # A restart reads either the old snapshot or the new one, never half
+    os.replace(written, path)
+    return offset + len(index) * INDEX_ENTRY.size
+
+
+class Snapshot:
+    """A snapshot file mapped into memory, read one game at a time.
+
+    The file stays mapped until close, replacing it on disk with a newer
+    snapshot does not change what this one reads.
+    """
+
+    def __init__(self, path):
+        """Map the snapshot at [path].
+
+        Raises
+        ------
+        FileNotFoundError
+            If there is no snapshot.
+        InvalidSnapshot
+            If the file is not a complete snapshot.
+
+        """
+        self.path = path
+        with open(path, "rb") as snapshot:
+            size = os.fstat(snapshot.fileno()).st_size
+            if size < HEADER.size:
+                raise InvalidSnapshot(f"{path} is too short for a snapshot")
+            self._map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, state_length, self._index = HEADER.unpack_from(self._map)
+        if (
+            magic != MAGIC
+            or self._index + self._count * INDEX_ENTRY.size != size
+            or HEADER.size + state_length > self._index
+        ):
+            self._map.close()
+            raise InvalidSnapshot(f"{path} is not a complete snapshot")
+        try:
+            self.state = json.loads(self._map[HEADER.size : HEADER.size + state_length])
+        except ValueError as e:
+            self._map.close()
+            raise InvalidSnapshot(f"{path} has a broken state: {e}")
+
+    def _entry(self, position):
+        return INDEX_ENTRY.unpack_from(
+            self._map, self._index + position * INDEX_ENTRY.size
+        )
+
+    def entry(self, guid):
+        """Return (fields, move log) of a game as bytes, or None."""
+        if len(guid) > 36 or not guid.isascii():
+            # Not a guid a snapshot can hold
+            return None
+        key = _key(guid)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            found, offset, fields_length, log_length = self._entry(middle)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                end = offset + fields_length
+                return self._map[offset:end], self._map[end : end + log_length]
+        return None
+
+    def __iter__(self):
+        """The guids of the games, in index order."""
+        for position in range(self._count):
+            yield self._entry(position)[0].rstrip(b"\0").decode("ascii")
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._map.close()
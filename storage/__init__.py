@@ -0,0 +1,17 @@
+"""Where the GameKeeper keeps players and games.
+
+The GameKeeper and the commands only talk to a Storage, never to the
+models. SQLiteStorage keeps them in the Orator models,
+MemoryStorage in plain dicts for tests and benchmarks.
+"""
+
+from storage.base import (
+    HISTORY_FIELDS,
+    GameRecord,
+    InvalidCursor,
+    Storage,
+    history_cursor,
+    parse_history_cursor,
+)
+from storage.memory import MemoryStorage
+from storage.sqlite import SQLiteStorage
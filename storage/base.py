@@ -0,0 +1,290 @@
+import threading
+from contextlib import contextmanager
+
+from models.move_log import replay
+
+# Summary fields player_games can return along with the guids
+HISTORY_FIELDS = ("state", "started", "last_move", "white", "black", "time_control")
+
+
+class InvalidCursor(Exception):
+    """Raise when a history cursor can not be parsed."""
+
+
+def history_cursor(last_move, game_id):
+    """The cursor of the page after the game with [last_move] and [game_id].
+
+    Clients hand it back as is, it is not meant to be read.
+    """
+    return f"{last_move}/{game_id}"
+
+
+def parse_history_cursor(cursor):
+    """Return (last_move, game id) of a cursor made by history_cursor."""
+    try:
+        last_move, game_id = cursor.rsplit("/", 1)
+        return last_move, int(game_id)
+    except (AttributeError, ValueError):
+        raise InvalidCursor(f"Invalid history cursor {cursor}")
+
+
+class GameRecord:
+    """A stored game, as a Storage hands it out.
+
+    `handle` belongs to the storage that made the record, for it to find
+    the game again when moves are appended.
+    """
+
+    __slots__ = (
+        "id",
+        "guid",
+        "white_player_id",
+        "black_player_id",
+        "white_name",
+        "black_name",
+        "state",
+        "started",
+        "last_move",
+        "start_fen",
+        "move_log",
+        "checkpoint_fen",
+        "checkpoint_ply",
+        "time_control",
+        "white_clock",
+        "black_clock",
+        "handle",
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def load_board(self):
+        """Replay the move log on a new board."""
+        return replay(
+            self.start_fen, self.move_log, self.checkpoint_fen, self.checkpoint_ply or 0
+        )
+
+
+class Storage:
+    """The storage interface of the GameKeeper.
+
+    Pending games for queued players are handed over in memory here, a
+    storage shared by several servers has to override the handoff methods.
+    The GameKeeper calls them while it holds its queue lock.
+    """
+
+    def __init__(self):
+        # player id => guid of the game made for them, None while it is
+        # being set up
+        self._offers = {}
+        self._offers_lock = threading.Lock()
+
+    # Players
+
+    def player_by_guid(self, guid):
+        """Return the PlayerRecord for a player guid, or None."""
+        raise NotImplementedError
+
+    def player_by_name(self, name):
+        """Return the PlayerRecord of the first player with a name, or None."""
+        raise NotImplementedError
+
+    def login(self, name, hashed_password):
+        """Return the PlayerRecord for a name and password hash, or None."""
+        raise NotImplementedError
+
+    def name_taken(self, name):
+        """Is there a player with this name already?"""
+        raise NotImplementedError
+
+    def register(self, name, hashed_password, bot=False):
+        """Store a new player, returns its PlayerRecord or None on failure.
+
+        Fails if the name is taken. [bot] marks a player of the computer
+        opponent.
+        """
+        raise NotImplementedError
+
+    def bot_by_name(self, name):
+        """Return the PlayerRecord of the bot player with a name, or None."""
+        raise NotImplementedError
+
+    def bot_ids(self):
+        """Return the set of the ids of all bot players."""
+        raise NotImplementedError
+
+    def watch_players(self, sessions):
+        """Invalidate the cached [sessions] of players that change."""
+
+    # Games
+
+    def create_game(self, white, black, time_control=None, clock=None):
+        """Store a new game between two PlayerRecords.
+
+        Parameters
+        ----------
+        white : PlayerRecord
+            The player with the white pieces.
+        black : PlayerRecord
+            The player with the black pieces.
+        time_control : String
+            Optional, the time control of a timed game.
+        clock : Integer
+            Milliseconds both players start with in a timed game.
+
+        Returns
+        -------
+        GameRecord
+            The new game.
+
+        """
+        raise NotImplementedError
+
+    def load_game(self, guid):
+        """Return the GameRecord of a guid, or None."""
+        raise NotImplementedError
+
+    def load_games(self, guids):
+        """Return the GameRecords of several guids, unknown ones left out."""
+        raise NotImplementedError
+
+    def live_games(self):
+        """Return the GameRecords of all games in progress."""
+        raise NotImplementedError
+
+    @contextmanager
+    def transaction(self):
+        """Make the writes in the block in one transaction, if there are any."""
+        yield
+
+    def append_moves(self, record, board, moves, state=None, clocks=None):
+        """Append moves to the move log of a game.
+
+        Parameters
+        ----------
+        record : GameRecord
+            The game, as loaded from this storage.
+        board : chess.Board
+            The board after the moves were made.
+        moves : list
+            The chess.Move objects made since the last append.
+        state : String
+            Optional, the state of the game to store along.
+        clocks : tuple
+            Optional, milliseconds (white, black) have left.
+
+        """
+        raise NotImplementedError
+
+    # Snapshots, see snapshot.py
+
+    def watermark(self):
+        """Mark the current point in time of the stored games.
+
+        Returns
+        -------
+        String
+            Pass it to games_written_since to find the games written after.
+
+        """
+        raise NotImplementedError
+
+    def games_written_since(self, watermark):
+        """Return the GameRecords of the games created or written since
+        [watermark], a mark returned by watermark.
+
+        Games written in the same instant as the mark was taken may be
+        returned too.
+        """
+        raise NotImplementedError
+
+    def record_fields(self, record):
+        """The stored fields of a game but its move log, JSON serializable.
+
+        restore_record builds the GameRecord from them again. The caller
+        makes sure no moves of the game are being written.
+        """
+        return {
+            name: getattr(record, name)
+            for name in GameRecord.__slots__
+            if name not in ("move_log", "handle")
+        }
+
+    def restore_record(self, fields, move_log):
+        """Build a GameRecord from its record_fields and move log, without
+        reading the game from the storage."""
+        return GameRecord(move_log=move_log, **fields)
+
+    def player_games(self, player_id, finished=None, limit=None, after=None, fields=()):
+        """Return a page of the games of a player, the last moved first.
+
+        Parameters
+        ----------
+        player_id : Integer
+            The id of the player.
+        finished : Boolean
+            True for ended games only, False for games in progress only,
+            None for all games.
+        limit : Integer
+            Optional, the most games to return. All games if None.
+        after : String
+            Optional, the cursor returned with the previous page.
+        fields : tuple
+            Names out of HISTORY_FIELDS to return along with the guids.
+
+        Returns
+        -------
+        tuple
+            (games, cursor). games is a list of Hashes with the guid and
+            the fields, cursor the `after` of the next page or None if this
+            was the last one.
+
+        """
+        raise NotImplementedError
+
+    # Queue handoff
+
+    def offer_game(self, player_id, guid):
+        """Keep the game made for a queued player, None while being set up."""
+        with self._offers_lock:
+            self._offers[player_id] = guid
+
+    def has_offer(self, player_id):
+        """Is a game made or being made for the player?"""
+        return player_id in self._offers
+
+    def claim_game(self, player_id):
+        """Take the guid of the game made for a player, None if not ready."""
+        with self._offers_lock:
+            guid = self._offers.get(player_id)
+            if guid is not None:
+                del self._offers[player_id]
+            return guid
+
+    def withdraw_offer(self, player_id):
+        """Drop a game being set up for a player, after the setup failed."""
+        with self._offers_lock:
+            if player_id in self._offers and self._offers[player_id] is None:
+                del self._offers[player_id]
+
+    def offer_count(self):
+        return len(self._offers)
+
+    def ready_offers(self):
+        """Return player id => guid of the games made for queued players.
+
+        Offers still being set up are left out, their setup is lost with
+        the process.
+        """
+        with self._offers_lock:
+            return {
+                player_id: guid
+                for player_id, guid in self._offers.items()
+                if guid is not None
+            }
+
+    def restore_offers(self, offers):
+        """Offer the games of a ready_offers result again."""
+        with self._offers_lock:
+            self._offers.update(offers)
@@ -0,0 +1,166 @@
+import hashlib
+import itertools
+import threading
+from datetime import datetime
+from uuid import uuid4
+
+import chess
+
+from models.move_log import pack_moves
+from sessions import PlayerRecord
+from storage.base import GameRecord, Storage, history_cursor, parse_history_cursor
+
+
+def _now():
+    return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _summary(record, fields):
+    summary = {"guid": record.guid}
+    for field in fields:
+        if field in ("white", "black"):
+            summary[field] = getattr(record, f"{field}_name")
+        else:
+            summary[field] = getattr(record, field)
+    return summary
+
+
+class MemoryStorage(Storage):
+    """Keeps players and games in dicts, gone when the process ends.
+
+    For tests and benchmarks that should not touch a database.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # guid => (PlayerRecord, hashed password)
+        self._players = {}
+        # guid => GameRecord
+        self._games = {}
+        # Ids of the bot players
+        self._bots = set()
+
+    def player_by_guid(self, guid):
+        entry = self._players.get(guid)
+        return entry[0] if entry is not None else None
+
+    def player_by_name(self, name):
+        for player, _ in list(self._players.values()):
+            if player.name == name:
+                return player
+        return None
+
+    def login(self, name, hashed_password):
+        for player, password in list(self._players.values()):
+            if player.name == name and password == hashed_password:
+                return player
+        return None
+
+    def name_taken(self, name):
+        return any(player.name == name for player, _ in list(self._players.values()))
+
+    def bot_by_name(self, name):
+        player = self.player_by_name(name)
+        return player if player is not None and player.id in self._bots else None
+
+    def bot_ids(self):
+        return set(self._bots)
+
+    def register(self, name, hashed_password, bot=False):
+        with self._lock:
+            if self.name_taken(name):
+                return None
+            player_id = next(self._ids)
+            guid = hashlib.sha224(
+                (str(player_id) + name + hashed_password).encode("utf8")
+            ).hexdigest()
+            player = PlayerRecord(player_id, name, guid)
+            self._players[guid] = (player, hashed_password)
+            if bot:
+                self._bots.add(player_id)
+        return player
+
+    def create_game(self, white, black, time_control=None, clock=None):
+        now = _now()
+        record = GameRecord(
+            id=next(self._ids),
+            guid=str(uuid4()),
+            white_player_id=white.id,
+            black_player_id=black.id,
+            white_name=white.name,
+            black_name=black.name,
+            state="in_progress",
+            started=now,
+            last_move=now,
+            start_fen=chess.STARTING_FEN,
+            move_log=b"",
+            checkpoint_ply=0,
+            time_control=time_control,
+            white_clock=clock,
+            black_clock=clock,
+        )
+        with self._lock:
+            self._games[record.guid] = record
+        return self._copy(record)
+
+    def _copy(self, record):
+        # Callers get their own record, like they would from a database
+        return GameRecord(**{name: getattr(record, name) for name in record.__slots__})
+
+    def load_game(self, guid):
+        record = self._games.get(guid)
+        return self._copy(record) if record is not None else None
+
+    def load_games(self, guids):
+        return [self._copy(self._games[guid]) for guid in guids if guid in self._games]
+
+    def live_games(self):
+        return [
+            self._copy(record)
+            for record in list(self._games.values())
+            if record.state == "in_progress"
+        ]
+
+    def watermark(self):
+        return _now()
+
+    def games_written_since(self, watermark):
+        return [
+            self._copy(record)
+            for record in list(self._games.values())
+            if record.last_move >= watermark
+        ]
+
+    def record_fields(self, record):
+        # The record of the caller is not kept up to date by append_moves
+        return super().record_fields(self._games[record.guid])
+
+    def append_moves(self, record, board, moves, state=None, clocks=None):
+        with self._lock:
+            stored = self._games[record.guid]
+            stored.move_log += pack_moves(moves)
+            if state is not None:
+                stored.state = state
+            if clocks is not None:
+                stored.white_clock, stored.black_clock = clocks
+            stored.last_move = _now()
+
+    def player_games(self, player_id, finished=None, limit=None, after=None, fields=()):
+        position = parse_history_cursor(after) if after is not None else None
+        games = []
+        for record in list(self._games.values()):
+            if player_id not in (record.white_player_id, record.black_player_id):
+                continue
+            if finished is not None and finished == (record.state == "in_progress"):
+                continue
+            if position is not None and (record.last_move, record.id) >= position:
+                continue
+            games.append(record)
+        games.sort(key=lambda record: (record.last_move, record.id), reverse=True)
+        cursor = None
+        if limit is not None and len(games) > limit:
+            games = games[:limit]
+            cursor = history_cursor(games[-1].last_move, games[-1].id)
+        return [_summary(record, fields) for record in games], cursor
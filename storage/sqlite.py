@@ -0,0 +1,221 @@
+import hashlib
+import sqlite3
+import threading
+
+from orator.exceptions.query import QueryException
+
+from models.game import Game
+from models.player import Player
+from sessions import SessionObserver, record_for
+from storage.base import GameRecord, Storage, history_cursor, parse_history_cursor
+
+# The games of a player, the last moved first. Both halves are read from
+# the covering (player, updated_at, ..) index of their color in order and
+# stop at the page size, so only the outer query sorts, at most two pages.
+HISTORY_QUERY = """
+SELECT h.guid, h.id, h.updated_at{fields}
+FROM (
+    SELECT * FROM (
+        SELECT id, guid, updated_at FROM games
+        WHERE white_player_id = ?{where}
+        ORDER BY updated_at DESC, id DESC LIMIT ?
+    )
+    UNION ALL
+    SELECT * FROM (
+        SELECT id, guid, updated_at FROM games
+        WHERE black_player_id = ? AND white_player_id != ?{where}
+        ORDER BY updated_at DESC, id DESC LIMIT ?
+    )
+) AS h{joins}
+ORDER BY h.updated_at DESC, h.id DESC LIMIT ?
+"""
+HISTORY_JOINS = """
+JOIN games AS g ON g.id = h.id
+JOIN players AS w ON w.id = g.white_player_id
+JOIN players AS b ON b.id = g.black_player_id"""
+# Orator turns the constraints of all relations off while it eager loads
+# one, a thread building a relation meanwhile gets them back on and a
+# broken query. Eager loads take turns.
+EAGER_LOAD_LOCK = threading.Lock()
+# Column of every HISTORY_FIELDS field
+HISTORY_COLUMNS = {
+    "state": "g.state",
+    "started": "g.created_at",
+    "last_move": "g.updated_at",
+    "white": "w.name",
+    "black": "b.name",
+    "time_control": "g.time_control",
+}
+
+
+def _record(game, names=None):
+    """Build a GameRecord from a Game model with its players loaded, or
+    from the (white, black) [names] of its players."""
+    if names is None:
+        names = (game.white_player.name, game.black_player.name)
+    return GameRecord(
+        id=game.id,
+        guid=game.guid,
+        white_player_id=game.white_player_id,
+        black_player_id=game.black_player_id,
+        white_name=names[0],
+        black_name=names[1],
+        state=game.state,
+        started=game.created_at.to_datetime_string(),
+        last_move=game.updated_at.to_datetime_string(),
+        start_fen=game.board_state,
+        move_log=game.get_raw_attribute("move_log") or b"",
+        checkpoint_fen=game.checkpoint_fen,
+        checkpoint_ply=game.checkpoint_ply,
+        time_control=game.time_control,
+        white_clock=game.white_clock,
+        black_clock=game.black_clock,
+        handle=game,
+    )
+
+
+class SQLiteStorage(Storage):
+    """Keeps players and games in the database of the Orator models."""
+
+    def player_by_guid(self, guid):
+        player = Player.where("guid", guid).first()
+        return record_for(player) if player is not None else None
+
+    def player_by_name(self, name):
+        player = Player.where("name", name).order_by("id").first()
+        return record_for(player) if player is not None else None
+
+    def login(self, name, hashed_password):
+        player = (
+            Player.where("name", name).where("hashed_password", hashed_password).first()
+        )
+        return record_for(player) if player is not None else None
+
+    def bot_by_name(self, name):
+        player = Player.where("name", name).where("bot", True).first()
+        return record_for(player) if player is not None else None
+
+    def bot_ids(self):
+        return {player.id for player in Player.where("bot", True).get()}
+
+    def name_taken(self, name):
+        return Player.where("name", name).count() > 0
+
+    def register(self, name, hashed_password, bot=False):
+        player = Player()
+        player.name = name
+        player.hashed_password = hashed_password
+        player.bot = bot
+        try:
+            player.save()  # Needed to get an ID in the DB
+        except QueryException as e:
+            if isinstance(e.previous, sqlite3.IntegrityError):
+                # Registered by someone else since the name was checked
+                return None
+            raise
+        player.guid = hashlib.sha224(
+            (str(player.id) + player.name + player.hashed_password).encode("utf8")
+        ).hexdigest()
+        if not player.save():
+            return None
+        return record_for(player)
+
+    def watch_players(self, sessions):
+        Player.observe(SessionObserver(sessions))
+
+    def create_game(self, white, black, time_control=None, clock=None):
+        game = Game()
+        game.white_player_id = white.id
+        game.black_player_id = black.id
+        # Sets up a new game and saves to the DB
+        game.setup_new(time_control, clock)
+        # Fill in what the database defaulted
+        with EAGER_LOAD_LOCK:
+            game = Game.with_("white_player", "black_player").find(game.id)
+        return _record(game)
+
+    def load_game(self, guid):
+        with EAGER_LOAD_LOCK:
+            game = (
+                Game.with_("white_player", "black_player").where("guid", guid).first()
+            )
+        return _record(game) if game is not None else None
+
+    def load_games(self, guids):
+        query = Game.with_("white_player", "black_player").where_in("guid", guids)
+        with EAGER_LOAD_LOCK:
+            games = query.get()
+        return [_record(game) for game in games]
+
+    def live_games(self):
+        query = Game.with_("white_player", "black_player").where("state", "in_progress")
+        with EAGER_LOAD_LOCK:
+            games = query.get()
+        return [_record(game) for game in games]
+
+    def watermark(self):
+        # How updated_at is written
+        return Game().from_datetime(Game().fresh_timestamp())
+
+    def games_written_since(self, watermark):
+        query = Game.with_("white_player", "black_player").where(
+            "updated_at", ">=", watermark
+        )
+        with EAGER_LOAD_LOCK:
+            games = query.get()
+        return [_record(game) for game in games]
+
+    def record_fields(self, record):
+        # The model is written along with the database, the record is not
+        row = dict(record.handle.get_attributes())
+        del row["move_log"]
+        return {"row": row, "names": [record.white_name, record.black_name]}
+
+    def restore_record(self, fields, move_log):
+        game = Game().new_from_builder(dict(fields["row"], move_log=move_log))
+        return _record(game, fields["names"])
+
+    def transaction(self):
+        # The connection of this thread, the models write through it too
+        return Game.resolve_connection().transaction()
+
+    def append_moves(self, record, board, moves, state=None, clocks=None):
+        record.handle.append_moves(board, moves, state, clocks)
+
+    def player_games(self, player_id, finished=None, limit=None, after=None, fields=()):
+        where = ""
+        bindings = []
+        if finished is True:
+            where += " AND state != 'in_progress'"
+        elif finished is False:
+            where += " AND state = 'in_progress'"
+        if after is not None:
+            where += " AND (updated_at, id) < (?, ?)"
+            bindings = list(parse_history_cursor(after))
+        # One more than asked for, to know if there is a next page
+        page = -1 if limit is None else limit + 1
+        query = HISTORY_QUERY.format(
+            where=where,
+            fields="".join(
+                f", {HISTORY_COLUMNS[field]} AS {field}" for field in fields
+            ),
+            joins=HISTORY_JOINS if fields else "",
+        )
+        rows = Game.resolve_connection().select(
+            query,
+            [player_id]
+            + bindings
+            + [page]
+            + [player_id, player_id]
+            + bindings
+            + [page]
+            + [page],
+        )
+        cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            cursor = history_cursor(rows[-1]["updated_at"], rows[-1]["id"])
+        return [
+            dict({"guid": row["guid"]}, **{field: row[field] for field in fields})
+            for row in rows
+        ], cursor
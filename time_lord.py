@@ -1,15 +1,170 @@
-from repeated_timer import RepeatedTimer
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# Seconds between pairing the players whose rating windows grew to meet
+MATCH_SWEEP_INTERVAL = 1
+# Seconds between writing the moves made in memory to the database
+FLUSH_INTERVAL = 1
+# Seconds between purging expired sessions
+PURGE_SESSIONS_INTERVAL = 60
+# Seconds between demoting the games over the hot budget of the GameKeeper
+DEMOTE_INTERVAL = 10
+# Rebuild the heap when more than this part of it is cancelled calls
+COMPACT_RATIO = 0.5
+
+
+class ScheduledCall:
+    """A call the TimeLord makes at a deadline, every [interval] if set."""
+
+    __slots__ = ("deadline", "function", "args", "interval", "cancelled")
+
+    def __init__(self, deadline, function, args, interval=None):
+        self.deadline = deadline
+        self.function = function
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
 
 
 class TimeLord(object):
-    """Keeps track of timed functions in the server."""
+    """Keeps track of timed functions in the server.
 
-    TASKS = []
+    All calls, the periodic tasks as well as the one off deadlines like the
+    flag fall of every timed game, are kept in one heap and made from a
+    single thread. Scheduling and cancelling are O(log n), so the deadlines
+    of many thousands of games cost no threads. Cancelled calls stay in the
+    heap until they come up or the heap is rebuilt.
 
-    def start(self, GAME_KEEPER):
-        self.TASKS.append(RepeatedTimer(20, GAME_KEEPER.create_games_for_queue))
-        self.TASKS.append(RepeatedTimer(10, GAME_KEEPER.check_current_games))
+    The calls are made on the TimeLord thread one after the other, they
+    should not block for long.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.logger = logging.getLogger("TimeLord")
+        self.clock = clock
+        self.TASKS = []
+        self.GAME_KEEPER = None
+        self._heap = []
+        self._cancelled = 0
+        # Breaks ties between calls with the same deadline
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self, GAME_KEEPER=None):
+        """Start the TimeLord thread and the periodic tasks of a GameKeeper."""
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="TimeLord", daemon=True)
+        self._thread.start()
+        if GAME_KEEPER is None:
+            return
+        self.GAME_KEEPER = GAME_KEEPER
+        for interval, function in (
+            (MATCH_SWEEP_INTERVAL, GAME_KEEPER.create_games_for_queue),
+            (FLUSH_INTERVAL, GAME_KEEPER.flush_games),
+            (PURGE_SESSIONS_INTERVAL, GAME_KEEPER.sessions.purge_expired),
+            (DEMOTE_INTERVAL, GAME_KEEPER.demote_idle),
+        ):
+            self.TASKS.append(self.every(interval, function))
+        GAME_KEEPER.attach_time_lord(self)
 
     def stop(self):
-        for task in self.TASKS:
-            task.stop()
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        # Don't lose the moves made since the last flush
+        if self.GAME_KEEPER is not None:
+            self.GAME_KEEPER.flush_games()
+
+    def call_at(self, deadline, function, *args):
+        """Call [function] once the clock reaches [deadline].
+
+        Returns
+        -------
+        ScheduledCall
+            Pass it to cancel to take the call back.
+
+        """
+        return self._push(ScheduledCall(deadline, function, args))
+
+    def call_later(self, delay, function, *args):
+        """Call [function] in [delay] seconds."""
+        return self.call_at(self.clock() + delay, function, *args)
+
+    def every(self, interval, function, *args):
+        """Call [function] every [interval] seconds, starting in [interval]."""
+        call = ScheduledCall(self.clock() + interval, function, args, interval)
+        return self._push(call)
+
+    def cancel(self, call):
+        """Take back a scheduled call, if it was not made yet."""
+        with self._condition:
+            if call.cancelled:
+                return
+            call.cancelled = True
+            self._cancelled += 1
+            if self._cancelled > len(self._heap) * COMPACT_RATIO:
+                self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def __len__(self):
+        """The count of calls waiting, cancelled calls included."""
+        return len(self._heap)
+
+    def _push(self, call):
+        with self._condition:
+            entry = (call.deadline, next(self._sequence), call)
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                # Earlier than what the thread waits for
+                self._condition.notify()
+        return call
+
+    def _next_due(self):
+        """Wait for the next due call and take it off the heap.
+
+        Returns None when the TimeLord is stopped.
+        """
+        with self._condition:
+            while self._running:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                deadline, _, call = self._heap[0]
+                if call.cancelled:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                    continue
+                delay = deadline - self.clock()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                if call.interval is None:
+                    # Made, so cancelling it later is a no-op
+                    call.cancelled = True
+                else:
+                    # Keep to the interval, unless we are a whole one behind
+                    call.deadline = max(deadline + call.interval, self.clock())
+                    heapq.heappush(
+                        self._heap, (call.deadline, next(self._sequence), call)
+                    )
+                return call
+            return None
+
+    def _run(self):
+        while True:
+            call = self._next_due()
+            if call is None:
+                return
+            try:
+                call.function(*call.args)
+            except Exception as e:
+                self.logger.exception(f"Timed call {call.function} failed: {e}")
@@ -0,0 +1,280 @@
+"""Encodings for the board and state responses.
+
+Clients pick one per request with a `format={name}` field:
+
+pickle
+    The pickled chess.Board / state dict, the default for old clients.
+json
+    Compact JSON. Every document carries `"v": WIRE_VERSION`.
+packed
+    Binary, see STATE_HEADER and BOARD_HEADER. Moves are packed two bytes
+    each, the same way the move log stores them.
+
+The batch command sends the states of several games in one response, see
+encode_states and merge_states.
+
+With a `since={version}` field the json and packed encodings only carry
+the moves made after that version instead of the whole game.
+"""
+
+import json
+import pickle
+import struct
+
+from models.move_log import unpack_moves
+
+WIRE_VERSION = 1
+FORMATS = ("pickle", "json", "packed")
+
+# wire version, game version, since, flags, result, fen length
+STATE_HEADER = struct.Struct(">BIIHBB")
+# wire version, game version, since, start fen length, fen length
+BOARD_HEADER = struct.Struct(">BIIBB")
+
+# wire version, game version; before the packed legal moves
+LEGAL_MOVES_HEADER = struct.Struct(">BI")
+
+# guid length, packed state length; before every game in a packed batch
+BATCH_ENTRY = struct.Struct(">BH")
+# Most games one batch command asks for, so a batch with its options
+# fits in the 4096 bytes the servers read a plain text command in
+MAX_BATCH = 100
+
+# Bit of every boolean in the packed state flags
+STATE_FLAGS = (
+    "game_over",
+    "checkmate",
+    "stalemate",
+    "insufficient_material",
+    "seventyfive_moves",
+    "fivefold_repetition",
+    "can_claim_draw",
+    "can_claim_fifty_moves",
+    "can_claim_threefold_repetition",
+    "timeout",
+)
+RESULTS = {None: 0, "White won": 1, "Black won": 2, "Draw": 3}
+
+
+class UnknownFormat(Exception):
+    """Raise when a client asks for a format we don't have."""
+
+
+def _check_format(fmt):
+    if fmt not in FORMATS:
+        raise UnknownFormat(f"Unknown wire format {fmt}")
+
+
+def _dump_json(document):
+    document["v"] = WIRE_VERSION
+    return json.dumps(document, separators=(",", ":")).encode("utf8")
+
+
+def encode_state(state, fmt, moves=None):
+    """Encode a game state dict.
+
+    Parameters
+    ----------
+    state : Hash
+        The state as returned by GameKeeper.get_game_state.
+    fmt : String
+        One of FORMATS.
+    moves : Hash
+        Optional, the result of GameKeeper.get_moves to send along.
+
+    Returns
+    -------
+    bytes
+        The encoded state.
+
+    """
+    _check_format(fmt)
+    if fmt == "pickle":
+        return pickle.dumps(state)
+    if fmt == "json":
+        document = dict(state)
+        if moves is not None:
+            document["since"] = moves["since"]
+            document["moves"] = [m.uci() for m in unpack_moves(moves["moves"])]
+        return _dump_json(document)
+    flags = 0
+    for bit, name in enumerate(STATE_FLAGS):
+        if state[name]:
+            flags |= 1 << bit
+    fen = state["fen"].encode("utf8")
+    since = moves["since"] if moves is not None else state["version"]
+    packed_moves = moves["moves"] if moves is not None else b""
+    return (
+        STATE_HEADER.pack(
+            WIRE_VERSION,
+            state["version"],
+            since,
+            flags,
+            RESULTS[state["result"]],
+            len(fen),
+        )
+        + fen
+        + packed_moves
+    )
+
+
+def encode_states(states, fmt):
+    """Encode the states of several games, for the batch command.
+
+    pickle and json send a guid => state mapping. packed sends for every
+    game the guid and the packed state, each prefixed with its length.
+    """
+    _check_format(fmt)
+    if fmt == "pickle":
+        return pickle.dumps(states)
+    if fmt == "json":
+        return _dump_json({"games": states})
+    parts = []
+    for guid, state in states.items():
+        guid = guid.encode("utf8")
+        packed = encode_state(state, fmt)
+        parts.append(BATCH_ENTRY.pack(len(guid), len(packed)) + guid + packed)
+    return b"".join(parts)
+
+
+def merge_states(parts, fmt):
+    """Merge the batch responses of several servers into one.
+
+    The shard router splits a batch over the shards owning the games, this
+    joins their encode_states responses again.
+    """
+    _check_format(fmt)
+    if fmt == "pickle":
+        states = {}
+        for part in parts:
+            states.update(pickle.loads(part))
+        return pickle.dumps(states)
+    if fmt == "json":
+        states = {}
+        for part in parts:
+            states.update(json.loads(part)["games"])
+        return _dump_json({"games": states})
+    return b"".join(parts)
+
+
+def encode_history(games, cursor, fmt):
+    """Encode a page of a game history, for current_games and co.
+
+    Parameters
+    ----------
+    games : list
+        Hashes with the guid and summary fields of every game.
+    cursor : String
+        The cursor of the next page, None on the last page.
+    fmt : String
+        "pickle" or "json", there is no packed history.
+
+    Returns
+    -------
+    bytes
+        The encoded page.
+
+    """
+    _check_format(fmt)
+    if fmt == "pickle":
+        return pickle.dumps({"games": games, "next": cursor})
+    if fmt == "json":
+        return _dump_json({"games": games, "next": cursor})
+    raise UnknownFormat("There is no packed game history")
+
+
+def encode_legal_moves(guid, version, legal_moves, fmt):
+    """Encode the legal moves of a game, for the legal_moves command.
+
+    Parameters
+    ----------
+    guid : String
+        The id of the game.
+    version : Integer
+        The version of the game the moves are legal in.
+    legal_moves : LegalMoves
+        The legal moves, see GameKeeper.get_legal_moves.
+    fmt : String
+        One of FORMATS. packed sends the moves two bytes each after
+        LEGAL_MOVES_HEADER, pickle and json a list of uci moves.
+
+    Returns
+    -------
+    bytes
+        The encoded moves.
+
+    """
+    _check_format(fmt)
+    if fmt == "packed":
+        return LEGAL_MOVES_HEADER.pack(WIRE_VERSION, version) + legal_moves.packed
+    document = {
+        "guid": guid,
+        "version": version,
+        "moves": [move.uci() for move in unpack_moves(legal_moves.packed)],
+    }
+    if fmt == "pickle":
+        return pickle.dumps(document)
+    return _dump_json(document)
+
+
+def decode_packed_legal_moves(data):
+    """Decode packed legal moves, returns (version, [chess.Move, ..])."""
+    _, version = LEGAL_MOVES_HEADER.unpack_from(data)
+    return version, unpack_moves(data[LEGAL_MOVES_HEADER.size :])
+
+
+def decode_packed_state(data):
+    """Decode a packed state, the inverse of encode_state(.., "packed")."""
+    wire_version, version, since, flags, result, fen_length = STATE_HEADER.unpack_from(
+        data
+    )
+    offset = STATE_HEADER.size
+    state = {name: bool(flags & 1 << bit) for bit, name in enumerate(STATE_FLAGS)}
+    state["version"] = version
+    state["since"] = since
+    state["result"] = {code: name for name, code in RESULTS.items()}[result]
+    state["fen"] = data[offset : offset + fen_length].decode("utf8")
+    state["moves"] = unpack_moves(data[offset + fen_length :])
+    return state
+
+
+def encode_board(moves, fmt):
+    """Encode a board for the json and packed formats.
+
+    Parameters
+    ----------
+    moves : Hash
+        The result of GameKeeper.get_moves.
+    fmt : String
+        "json" or "packed", pickle needs the board itself.
+
+    Returns
+    -------
+    bytes
+        The encoded board.
+
+    """
+    _check_format(fmt)
+    if fmt == "pickle":
+        raise UnknownFormat("Pickled boards are made from the chess.Board")
+    if fmt == "json":
+        return _dump_json(
+            {
+                "guid": moves["guid"],
+                "version": moves["version"],
+                "since": moves["since"],
+                "start_fen": moves["start_fen"],
+                "fen": moves["fen"],
+                "moves": [m.uci() for m in unpack_moves(moves["moves"])],
+            }
+        )
+    start_fen = moves["start_fen"].encode("utf8")
+    fen = moves["fen"].encode("utf8")
+    return (
+        BOARD_HEADER.pack(
+            WIRE_VERSION, moves["version"], moves["since"], len(start_fen), len(fen)
+        )
+        + start_fen
+        + fen
+        + moves["moves"]
+    )
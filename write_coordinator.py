@@ -0,0 +1,229 @@
+"""Group commit of the moves made in all games.
+
+A player only gets `move_made` once the move is in the database. A commit
+of its own for every move would sync the database file once per move, so
+the WriteCoordinator collects the moves of all games for a short window,
+writes the games they were made in with one transaction and then wakes
+every player waiting on one of them. When a commit fails its games are
+written one by one, so one game that can not be written does not hold up
+the others.
+"""
+
+import logging
+import threading
+import time
+
+# Seconds the first move of a commit waits for others to join it. The moves
+# made while a commit is written go together in the next one anyway; on a
+# single core waiting longer only added latency, see bench_group_commit.py
+COMMIT_WINDOW = 0.0
+# Moves that make a commit start before the window is over
+COMMIT_BATCH = 256
+# Seconds a move waits for its commit before the player gets an error
+COMMIT_TIMEOUT = 10
+# Seconds to wait before retrying a failed commit
+RETRY_DELAY = 0.1
+# Commits a game that fails on its own is tried in, then its waiting
+# players get WriteTimeout. Its moves stay in memory to be flushed later.
+MAX_ATTEMPTS = 3
+
+
+class WriteTimeout(Exception):
+    """Raised when a move was made but could not be written in time."""
+
+
+class _Waiter:
+    """A move waiting for the commit of its game."""
+
+    def __init__(self, guid):
+        self.guid = guid
+        self.done = threading.Event()
+        # Set along with done when the game was given up on
+        self.failed = False
+
+
+class WriteCoordinator:
+    """Writes the new moves of the games of a GameKeeper in group commits.
+
+    Commits are made one after the other on the thread of the coordinator.
+    While one is written the moves made meanwhile wait for the next, so
+    under load the batches grow with the time a commit takes.
+    """
+
+    def __init__(
+        self, window=COMMIT_WINDOW, max_batch=COMMIT_BATCH, timeout=COMMIT_TIMEOUT
+    ):
+        self.logger = logging.getLogger("WriteCoordinator")
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.game_keeper = None
+        # _Waiters of the moves waiting for the next commit
+        self._pending = []
+        # guid => failed commits of a game on its own, only used on the
+        # thread of the coordinator
+        self._attempts = {}
+        # When the first of the pending moves came in
+        self._since = None
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+        self.commits = 0
+        self.moves = 0
+        self.commit_seconds = 0.0
+        self.failures = 0
+        # Games given up on after MAX_ATTEMPTS
+        self.dropped = 0
+
+    def start(self, game_keeper):
+        """Start the thread and confirm the moves of [game_keeper]."""
+        self.game_keeper = game_keeper
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="WriteCoordinator", daemon=True
+        )
+        self._thread.start()
+        game_keeper.attach_writer(self)
+
+    def stop(self):
+        """Stop the thread, the pending moves are written first."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def commit(self, guid):
+        """Wait until the moves made in a game so far are in the database.
+
+        Parameters
+        ----------
+        guid : String
+            The id of the game a move was just made in.
+
+        Raises
+        ------
+        WriteTimeout
+            If the move was not written within the timeout, or its game
+            failed to be written MAX_ATTEMPTS times. It stays in memory
+            and is written later.
+
+        """
+        waiter = _Waiter(guid)
+        with self._condition:
+            running = self._running
+            if running:
+                if not self._pending:
+                    self._since = time.monotonic()
+                    self._condition.notify()
+                self._pending.append(waiter)
+                if len(self._pending) >= self.max_batch:
+                    self._condition.notify()
+        if not running:
+            # Stopped, write it right away
+            self.game_keeper.write_games([guid])
+            return
+        if not waiter.done.wait(self.timeout):
+            raise WriteTimeout(f"Move in {guid} not written in {self.timeout}s")
+        if waiter.failed:
+            raise WriteTimeout(f"Move in {guid} could not be written")
+
+    def _next_batch(self):
+        """Wait for the window of the pending moves to close and take them.
+
+        Returns None when the coordinator is stopped and nothing is left.
+        """
+        with self._condition:
+            while True:
+                if not self._pending:
+                    if not self._running:
+                        return None
+                    self._condition.wait()
+                    continue
+                wait = self._since + self.window - time.monotonic()
+                if self._running and wait > 0 and len(self._pending) < self.max_batch:
+                    self._condition.wait(wait)
+                    continue
+                batch, self._pending = self._pending, []
+                return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            try:
+                self.game_keeper.write_games({waiter.guid for waiter in batch})
+            except Exception as e:
+                self.logger.warning(
+                    f"Commit of {len(batch)} moves failed, writing their games "
+                    f"one by one: {e}"
+                )
+                with self._condition:
+                    self.failures += 1
+                self._write_each(batch)
+                continue
+            self._confirm(batch, time.perf_counter() - started)
+
+    def _write_each(self, batch):
+        """Commit the games of a failed batch one at a time.
+
+        The moves of the games that fail again wait for the next commit,
+        until their game failed MAX_ATTEMPTS times.
+        """
+        by_game = {}
+        for waiter in batch:
+            by_game.setdefault(waiter.guid, []).append(waiter)
+        retry = []
+        for guid, waiters in by_game.items():
+            started = time.perf_counter()
+            try:
+                self.game_keeper.write_games([guid])
+            except Exception as e:
+                attempts = self._attempts.get(guid, 0) + 1
+                if attempts < MAX_ATTEMPTS:
+                    self._attempts[guid] = attempts
+                    retry.extend(waiters)
+                    continue
+                self._attempts.pop(guid, None)
+                self.logger.exception(f"Giving up on writing game {guid}: {e}")
+                for waiter in waiters:
+                    waiter.failed = True
+                    waiter.done.set()
+                with self._condition:
+                    self.dropped += 1
+                continue
+            self._attempts.pop(guid, None)
+            self._confirm(waiters, time.perf_counter() - started)
+        if retry:
+            with self._condition:
+                # Again with the next commit
+                if not self._pending:
+                    self._since = time.monotonic()
+                self._pending[:0] = retry
+            time.sleep(RETRY_DELAY)
+
+    def _confirm(self, waiters, elapsed):
+        for waiter in waiters:
+            waiter.done.set()
+        with self._condition:
+            self.commits += 1
+            self.moves += len(waiters)
+            self.commit_seconds += elapsed
+
+    def stats(self):
+        """Commits made, their size and how long they took."""
+        with self._condition:
+            commits = max(1, self.commits)
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch": self.max_batch,
+                "commits": self.commits,
+                "moves": self.moves,
+                "moves_per_commit": round(self.moves / commits, 2),
+                "mean_commit_ms": round(self.commit_seconds / commits * 1000, 3),
+                "failures": self.failures,
+                "dropped": self.dropped,
+                "pending": len(self._pending),
+            }